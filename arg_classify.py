@@ -0,0 +1,114 @@
+#! /usr/bin/env python3
+
+import socket
+import functools
+from typing import Iterable
+
+
+ARG_FLAG    = 'op_flag'   # -v, --help
+# TODO -I../lib
+# ARG_OP     = 'op'     # --input bla, --files f1 f2
+ARG_OP_ARG  = 'op_arg' # --quality=9, if=/dev/null
+ARG_NUMBER  = 'op_num'
+ARG_STRING  = 'op_str'
+ARG_PATH    = 'op_path'
+ARG_FILE    = 'op_file'
+ARG_DIR     = 'op_dir'
+ARG_URL     = 'op_url'
+ARG_IP      = 'op_ip'
+ARG_UNKNOWN = 'op_unknown'
+
+URL_PREFIXES = ['http://', 'https://', 'ftp://', 'file://', 'data://']
+
+# no string rule matched, in the per-batch dict
+UNMATCHED = 'unmatched'
+
+
+def is_number(n):
+    is_number = True
+    try:
+        num = float(n)
+    except ValueError:
+        is_number = False
+    return is_number
+
+
+def is_ip(s):
+    parts = s.split(':')
+    if len(parts) <= 2:
+        try:
+            ignore = socket.inet_aton(parts[0])
+            return True
+        except OSError:
+            return False
+
+    return False
+
+
+class ArgClassifier:
+    # The rules of classify_args() that only look at the argument string,
+    # cached for the last `cache_size` distinct arguments. Builds pass the
+    # same flags and files millions of times.
+    #
+    # Arguments none of these rules match are ARG_UNKNOWN, or whatever
+    # `fallback(arg)` says, which is not cached so that it can look at
+    # the file system. Arguments that are not strings, i.e. raw bytes
+    # that failed to decode, are reported through `notice` and left out,
+    # as classify_args() always did.
+
+    def __init__(self, url_prefixes: Iterable[str] = URL_PREFIXES, cache_size: int = 65536,
+                 notice = print):
+        self.url_prefixes = tuple(url_prefixes)
+        self.notice = notice
+        self.kind = functools.lru_cache(maxsize=cache_size)(self.string_kind)
+
+
+    def string_kind(self, arg: str):
+        if arg.startswith('-'):
+            if '=' in arg:
+                return ARG_OP_ARG
+            return ARG_FLAG
+        if arg.startswith(self.url_prefixes):
+            return ARG_URL
+        if is_number(arg):
+            return ARG_NUMBER
+        if '=' in arg:
+            # dd if=/dev/zero
+            return ARG_OP_ARG
+        if is_ip(arg):
+            return ARG_IP
+        # TODO subcommands like `perf report`
+        return None
+
+
+    def classify(self, args: list, fallback = None) -> list[tuple[str, str]]:
+        # (kind, arg) for each argument
+        return self.classify_batch([args], fallback)[0]
+
+
+    def classify_batch(self, arg_lists: Iterable[list], fallback = None) -> list[list[tuple[str, str]]]:
+        # Same as classify() on each list. The distinct arguments of the
+        # batch are looked up once, with a plain dict in front of the cache.
+        kinds = {}
+        get = kinds.get
+        kind = self.kind
+        results = []
+
+        for args in arg_lists:
+            classified = []
+            for arg in args:
+                k = get(arg)
+                if k is None:
+                    try:
+                        k = kind(arg) or UNMATCHED
+                    except TypeError:
+                        self.notice(f'classify_args error: {arg}')
+                        self.notice(f'in \n {args}')
+                        continue
+                    kinds[arg] = k
+                if k is UNMATCHED:
+                    k = fallback(arg) if fallback is not None else ARG_UNKNOWN
+                classified.append((k, arg))
+            results.append(classified)
+
+        return results
@@ -24,12 +24,37 @@
 #define F_FAIL_PATH       2
 #define F_INCOMPLETE_ARGS 3
 #define F_INCOMPLETE_ENVS 4
-
+#define F_PREFILTERED     5
+
+// What is captured of the environment, ENV_MODE is set by userspace.
+// ENV_MODE_HASH captures all of it, userspace keeps only the hash.
+#define ENV_MODE_ALL       0
+#define ENV_MODE_ALLOWLIST 1
+#define ENV_MODE_HASH      2
+#define ENV_MODE_OFF       3
+#ifndef ENV_MODE
+#define ENV_MODE ENV_MODE_ALL
+#endif
+#define ENV_NAME_MAX 32
+
+// Strings of one exec in PACKED_RECORD mode
+#define PACKED_DATA_SIZE (1 << 14)
+#define PACKED_DATA_MASK (PACKED_DATA_SIZE - 1)
+// keep room for the working dir after the envs
+#define PACKED_ENV_LIMIT (PACKED_DATA_SIZE - MAX_PATH_DEPTH * MAX_PATH_READ)
+
+#ifndef PACKED_RECORD
 // Creates a ringbuf called events with N pages of space, shared across all CPUs
 BPF_RINGBUF_OUTPUT(events_basic, 512);
 BPF_RINGBUF_OUTPUT(events_arg, 512);
 BPF_RINGBUF_OUTPUT(events_env, 512);
 BPF_RINGBUF_OUTPUT(events_path_part, 512);
+#else
+BPF_RINGBUF_OUTPUT(events_packed, 1024);
+#endif
+
+// execs that could not be submitted at all, read by userspace
+BPF_ARRAY(drop_counts, u64, 1);
 
 struct data_basic {
     u64  pid_tgid;
@@ -57,6 +82,100 @@ struct data_path_part {
     char path[MAX_PATH_READ];
 };
 
+// PACKED_RECORD mode submits one record per execve(): the fixed part,
+// then `len` bytes of `data` holding `argc` args, `envc` envs and
+// `depth` working dir components (leaf first), each NUL-terminated.
+// Only the used part of `data` goes through the ring buffer.
+// A string starts where the previous one ends, bpf_probe_read_*_str()
+// returns the length including the NUL. Offsets into `data` are masked
+// to stay below PACKED_DATA_SIZE, with room for one more string behind.
+
+struct data_packed {
+    u64  pid_tgid;
+    u32  flags;
+    u16  argc;
+    u16  envc;
+    u16  depth;
+    u16  len;
+    char comm[TASK_COMM_LEN];
+    char filename[PATH_SIZE];
+    char data[PACKED_DATA_SIZE + MAX_STR_SIZE];
+};
+
+#ifdef PACKED_RECORD
+// too large for the stack
+BPF_PERCPU_ARRAY(packed_scratch, struct data_packed, 1);
+#endif
+
+#ifdef PREFILTER
+// Executables matched by the prefix and suffix rules of exec-filter.rules,
+// filled in by userspace. Their args, envs and working dir are not read,
+// only the basic record is submitted, with F_PREFILTERED set.
+#define PREFILTER_PREFIX_LEN   64
+#define PREFILTER_SUFFIX_LEN   32
+#define PREFILTER_MAX_SUFFIXES 16
+
+struct prefilter_key {
+    u32  prefixlen;     // in bits
+    char data[PREFILTER_PREFIX_LEN];
+};
+
+struct prefilter_suffix {
+    u32  len;
+    char data[PREFILTER_SUFFIX_LEN];
+};
+
+BPF_LPM_TRIE(prefilter_prefixes, struct prefilter_key, u8, 64);
+BPF_ARRAY(prefilter_suffixes, struct prefilter_suffix, PREFILTER_MAX_SUFFIXES);
+
+// `len` is the length of `filename` without the NUL
+static __always_inline int prefiltered(const char * filename, int len) {
+    struct prefilter_key key = {};
+    key.prefixlen = PREFILTER_PREFIX_LEN * 8;
+    __builtin_memcpy(key.data, filename, PREFILTER_PREFIX_LEN);
+    if (prefilter_prefixes.lookup(&key) != NULL) {
+        return 1;
+    }
+
+    for (int i = 0; i < PREFILTER_MAX_SUFFIXES; i++) {
+        int k = i;
+        struct prefilter_suffix * s = prefilter_suffixes.lookup(&k);
+        if (s == NULL || s->len == 0) break;
+        if (s->len > PREFILTER_SUFFIX_LEN || s->len > len) continue;
+
+        int start = len - s->len;
+        int match = 1;
+        for (int j = 0; j < PREFILTER_SUFFIX_LEN; j++) {
+            if (j >= s->len) break;
+            if (filename[(start + j) & (PATH_SIZE - 1)] != s->data[j]) {
+                match = 0;
+                break;
+            }
+        }
+        if (match) return 1;
+    }
+
+    return 0;
+}
+#endif
+
+#if ENV_MODE == ENV_MODE_ALLOWLIST
+// FNV-1a hashes of the allowed names, filled in by userspace.
+// Names are hashed up to their first ENV_NAME_MAX bytes, userspace checks
+// the exact names again.
+BPF_HASH(env_allowlist, u32, u8, 64);
+
+static __always_inline int env_allowed(const char * env) {
+    u32 h = 2166136261;
+    for (int i = 0; i < ENV_NAME_MAX; i++) {
+        char ch = env[i];
+        if (ch == '=' || ch == 0) break;
+        h = (h ^ (u8)ch) * 16777619;
+    }
+    return env_allowlist.lookup(&h) != NULL;
+}
+#endif
+
 // From BCC virtiostat
 /* local strcmp function, max length 8 to protect instruction loops */
 #define CMPMAX	8
@@ -82,12 +201,15 @@ static void set_flag(u32 * flags, int flag) {
     *flags = ((1 << flag) | fgs);
 }
 
+#ifndef PACKED_RECORD
+
 // Convenience macro for auto-attaching probes.
 TRACEPOINT_PROBE(syscalls, sys_enter_execve) {
     struct data_basic * data_b = events_basic.ringbuf_reserve(sizeof(struct data_basic));
     if (data_b == NULL) {
         data_b = events_basic.ringbuf_reserve(sizeof(struct data_basic));
         if (data_b == NULL) {
+            drop_counts.atomic_increment(0);
             return 0;
         }
     }
@@ -99,12 +221,20 @@ TRACEPOINT_PROBE(syscalls, sys_enter_execve) {
     struct fs_struct   * fs = (struct fs_struct *)(t->fs);
 
     bpf_get_current_comm(data_b->comm, sizeof(data_b->comm));
-    bpf_probe_read_user_str(data_b->filename, sizeof(data_b->filename), args->filename);
+    int filename_len = bpf_probe_read_user_str(data_b->filename, sizeof(data_b->filename), args->filename);
 
     u64 pid_tgid = bpf_get_current_pid_tgid() ^ bpf_ktime_get_ns();
     data_b->pid_tgid = pid_tgid;
     data_b->flags = 0ul;
 
+#ifdef PREFILTER
+    if (filename_len > 0 && prefiltered(data_b->filename, filename_len - 1)) {
+        set_flag(&data_b->flags, F_PREFILTERED);
+        events_basic.ringbuf_submit(data_b, 0 /* flags */);
+        return 0;
+    }
+#endif
+
     // read commandline arguments
     int c = MAX_ARGS;
     while (c > 0) {
@@ -138,6 +268,7 @@ TRACEPOINT_PROBE(syscalls, sys_enter_execve) {
         set_flag(&data_b->flags, F_INCOMPLETE_ARGS);
     }
 
+#if ENV_MODE != ENV_MODE_OFF
     // read environment variables
     c = MAX_ENVS;
     while (c > 0) {
@@ -158,12 +289,19 @@ TRACEPOINT_PROBE(syscalls, sys_enter_execve) {
 
         envvars++;
         c--;
+#if ENV_MODE == ENV_MODE_ALLOWLIST
+        if (!env_allowed(data_e->envs)) {
+            events_env.ringbuf_discard(data_e, 0);
+            continue;
+        }
+#endif
         events_env.ringbuf_submit(data_e, 0);
     }
 
     if (c == 0 && *envvars != NULL) {
         set_flag(&data_b->flags, F_INCOMPLETE_ENVS);
     }
+#endif
 
     // read working dir
     c = MAX_PATH_DEPTH;
@@ -202,3 +340,128 @@ TRACEPOINT_PROBE(syscalls, sys_enter_execve) {
 
     return 0;
 }
+
+#else
+
+TRACEPOINT_PROBE(syscalls, sys_enter_execve) {
+    int zero = 0;
+    struct data_packed * p = packed_scratch.lookup(&zero);
+    if (p == NULL) {
+        return 0;
+    }
+
+    char ** arguments = args->argv;
+    char ** envvars = args->envp;
+    struct task_struct * t  = (struct task_struct *)bpf_get_current_task();
+    struct fs_struct   * fs = (struct fs_struct *)(t->fs);
+
+    bpf_get_current_comm(p->comm, sizeof(p->comm));
+    int filename_len = bpf_probe_read_user_str(p->filename, sizeof(p->filename), args->filename);
+
+    p->pid_tgid = bpf_get_current_pid_tgid() ^ bpf_ktime_get_ns();
+    p->flags = 0ul;
+    p->argc = 0;
+    p->envc = 0;
+    p->depth = 0;
+
+    u32 off = 0;
+    int n;
+
+#ifdef PREFILTER
+    if (filename_len > 0 && prefiltered(p->filename, filename_len - 1)) {
+        set_flag(&p->flags, F_PREFILTERED);
+        p->len = 0;
+        if (events_packed.ringbuf_output(p, offsetof(struct data_packed, data), 0) != 0) {
+            drop_counts.atomic_increment(0);
+        }
+        return 0;
+    }
+#endif
+
+    // read commandline arguments
+    int c = MAX_ARGS;
+    while (c > 0) {
+        if (*arguments == NULL) break;
+        if (off >= PACKED_ENV_LIMIT) break;
+
+        n = bpf_probe_read_user_str(&p->data[off & PACKED_DATA_MASK], MAX_STR_SIZE, *arguments);
+        if (n < 0) {
+            set_flag(&p->flags, F_FAIL_ARG);
+            break;
+        }
+        off += n;
+        p->argc++;
+
+        arguments++;
+        c--;
+    }
+
+    if (*arguments != NULL) {
+        set_flag(&p->flags, F_INCOMPLETE_ARGS);
+    }
+
+#if ENV_MODE != ENV_MODE_OFF
+    // read environment variables
+    c = MAX_ENVS;
+    while (c > 0) {
+        if (*envvars == NULL) break;
+        if (off >= PACKED_ENV_LIMIT) break;
+
+        n = bpf_probe_read_user_str(&p->data[off & PACKED_DATA_MASK], MAX_STR_SIZE, *envvars);
+        if (n < 0) {
+            set_flag(&p->flags, F_FAIL_ENV);
+            break;
+        }
+
+        envvars++;
+        c--;
+#if ENV_MODE == ENV_MODE_ALLOWLIST
+        // the next string overwrites it
+        if (!env_allowed(&p->data[off & PACKED_DATA_MASK])) continue;
+#endif
+        off += n;
+        p->envc++;
+    }
+
+    if (*envvars != NULL) {
+        set_flag(&p->flags, F_INCOMPLETE_ENVS);
+    }
+#endif
+
+    // read working dir
+    c = MAX_PATH_DEPTH;
+    struct dentry * d = fs->pwd.dentry;
+    struct dentry * d_root = fs->root.dentry;
+    while (c > 0) {
+        if (d == d_root || d == d->d_parent) break;
+        if (off >= PACKED_DATA_SIZE) {
+            set_flag(&p->flags, F_FAIL_PATH);
+            break;
+        }
+
+        const char * name = d->d_name.name;
+        n = bpf_probe_read_kernel_str(&p->data[off & PACKED_DATA_MASK], MAX_PATH_READ, name);
+        if (n < 0) {
+            set_flag(&p->flags, F_FAIL_PATH);
+            break;
+        }
+        off += n;
+        p->depth++;
+
+        d = d->d_parent;
+        c--;
+    }
+
+    p->len = off;
+    u32 size = offsetof(struct data_packed, data) + off;
+    if (size > sizeof(struct data_packed)) {
+        size = sizeof(struct data_packed);
+    }
+    if (events_packed.ringbuf_output(p, size, 0) != 0) {
+        drop_counts.atomic_increment(0);
+    }
+
+    return 0;
+}
+
+#endif
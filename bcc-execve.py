@@ -11,88 +11,53 @@
 ####################################################
 
 
-from bcc import BPF
+import os
 import time
+import signal
 import argparse
 import yaml
 from trace_datum import *
+from trace_io import *
+from trace_consumer import *
+from trace_sources import *
+from exec_rules import *
 
 
-g_trace_data: dict[int, TraceDatum] = {}
-
-def get_trace_datum(pid_tgid, creator) -> TraceDatum:
-    if pid_tgid in g_trace_data.keys():
-        return g_trace_data[pid_tgid]
-    else:
-        d = TraceDatum()
-        d.pid_tgid = pid_tgid
-        d.creator = creator
-        g_trace_data[pid_tgid] = d
-        return d
-
-
-def record_basic(ctx, data, size):
-    event = b['events_basic'].event(data)
-    ids = event.pid_tgid
-    comm = event.comm.decode('utf-8')
-    filename = event.filename.decode('utf-8')
-
-    d = get_trace_datum(ids, 'record_basic')
-    d.comm = comm
-    d.file_path = filename
-    d.flags = event.flags
-
-
-def record_arg(ctx, data, size):
-    event = b['events_arg'].event(data)
-    ids = event.pid_tgid
-    arg = ""
-    try:
-        arg = event.args.decode('utf-8')
-    except UnicodeDecodeError:
-        arg = event.args
-
-    d = get_trace_datum(ids, 'record_arg')
-    d.args.append(arg)
-
-
-def record_env(ctx, data, size):
-    event = b['events_env'].event(data)
-    ids = event.pid_tgid
-    env = ""
-    try:
-        env = event.envs.decode('utf-8')
-    except UnicodeDecodeError:
-        env = event.envs
-
-    d = get_trace_datum(ids, 'record_env')
-    d.envs.append(env)
-
-
-def record_path_part(ctx, data, size):
-    event = b['events_path_part'].event(data)
-    ids = event.pid_tgid
-    path = event.path.decode('utf-8')
-
-    d = get_trace_datum(ids, 'record_path_part')
-    d.path_parts.append(path)
-
+g_consumer: TraceConsumer = None
+g_source = None
+g_stop = False
 
 def write_results(output_file):
-    for d in g_trace_data.values():
-        d.prepare()
+    g_consumer.close()
+    if g_capture is not None:
+        g_capture.close()
 
-    with open(output_file, 'w') as f:
-        result = {'package' : package, 
-                  'version' : version, 
-                  'data'    : list(filter(lambda d: d.check_fields(), g_trace_data.values())) }
-        yaml.dump(result, f)
+    print(f'traced {g_consumer.written} execs')
+    print(f'evicted {g_consumer.evicted} incomplete execs')
+    if g_consumer.evicted_writer is not None:
+        print(f'evicted execs saved to {g_consumer.evicted_writer.path}')
+
+    if log_file != output_file:
+        print(f'converting {log_file} to {output_file}')
+        log = BinaryTraceReader(log_file)
+        with open_trace_writer(output_file, log.read_header(), 'yaml') as w:
+            for d in log:
+                w.write(d)
+        os.remove(log_file)
 
 
 def print_results():
     pass
 
 
+def on_stop(signum, frame):
+    # Only note it, the main loop stops after the poll. An exception raised
+    # here would mostly be raised in a ring buffer callback, where ctypes
+    # prints and ignores it. Polls time out after max_timeout, 1 s.
+    global g_stop
+    g_stop = True
+
+
 ###
 ### start of program
 ###
@@ -107,6 +72,27 @@ parser = argparse.ArgumentParser(
 parser.add_argument('-o', '--output', required=True, help='save the traces to file')
 parser.add_argument('-p', '--package', required=True, help='package name')
 parser.add_argument('-v', '--version', required=True, help='package version')
+parser.add_argument('-f', '--format', choices=['yaml', 'bin'],
+                    help=f'trace file format, by default binary if the output ends with {TRACE_EXT} or {TRACE_EXT}.gz')
+parser.add_argument('--inflight-ttl', type=float, default=10.0,
+                    help='seconds after which an exec without its basic record is dropped')
+parser.add_argument('--inflight-max', type=int, default=65536,
+                    help='max number of execs waiting for their basic record')
+parser.add_argument('--evicted', help='save dropped incomplete execs to this binary trace file')
+parser.add_argument('--packed', action='store_true',
+                    help='submit each exec as a single ring buffer record')
+parser.add_argument('--prefilter', nargs='?', const=G_RULES_PATH,
+                    help='only record the basic info of execs matched by these rules, exec-filter.rules by default')
+parser.add_argument('--env-mode', choices=ENV_MODES, default='all',
+                    help='record all env vars, only those in --env-allowlist, a hash of all of them, or none')
+parser.add_argument('--env-allowlist', default='',
+                    help='comma-separated names of the env vars to record in allowlist mode')
+parser.add_argument('--capture', help='also save the raw ring buffer records to this file')
+parser.add_argument('--replay', help='read events from a capture file instead of tracing')
+parser.add_argument('--rate', type=float, default=0,
+                    help='events per second to replay, as fast as possible by default')
+parser.add_argument('--stats', type=float, default=0,
+                    help='print event rates, fail flag rates and drops every this many seconds')
 
 args = parser.parse_args()
 output_file = ''
@@ -115,26 +101,64 @@ if args.output != None:
 
 package  = args.package
 version  = args.version
-
-# load BPF program
-b = BPF(src_file="bcc-execve.c")
-
-# register callbacks
-# If things go well, this is the last callback in a sequence of events during an execve().
-b["events_basic"].open_ring_buffer(record_basic)
-b["events_arg"].open_ring_buffer(record_arg)
-b["events_env"].open_ring_buffer(record_env)
-b["events_path_part"].open_ring_buffer(record_path_part)
-
-yaml.add_constructor(G_TRACEDATUM_TAG, trace_datum_constructor)
-
-while True:
-    try:
-        b.ring_buffer_poll()
-        time.sleep(0.1)
-    except KeyboardInterrupt:
-        if output_file == '':
-            print_results()
-        else:
-            write_results(output_file)
-        exit()
+output_format = args.format
+
+# Completed execs are appended to a binary log as they arrive.
+# The log is the output itself unless YAML was asked for,
+# in which case it gets converted when tracing stops.
+if output_format == 'bin' or (output_format is None and is_binary_path(output_file)):
+    log_file = output_file
+else:
+    log_file = f'{output_file}.log{TRACE_EXT}'
+
+env_allowlist = [n for n in args.env_allowlist.split(',') if n != '']
+if args.env_mode == 'allowlist' and env_allowlist == []:
+    print('--env-mode allowlist needs --env-allowlist')
+    exit(-1)
+
+header = {'package'  : package,
+          'version'  : version,
+          'env_mode' : args.env_mode}
+if args.env_mode == 'allowlist':
+    header['env_allowlist'] = env_allowlist
+
+writer = BinaryTraceWriter(log_file, header)
+
+evicted_writer = None
+if args.evicted is not None:
+    evicted_writer = BinaryTraceWriter(args.evicted, {**header, 'evicted' : True})
+
+g_consumer = TraceConsumer(writer, args.inflight_ttl, args.inflight_max, evicted_writer,
+                           args.env_mode, env_allowlist)
+
+prefilter = None
+if args.prefilter is not None:
+    prefilter = load_rules(args.prefilter)
+
+g_capture = None
+if args.capture is not None:
+    g_capture = EventCapture(args.capture)
+
+if args.replay is not None:
+    g_source = ReplayEventSource(g_consumer, read_capture(args.replay), args.rate)
+else:
+    # load BPF program
+    g_source = BccEventSource(g_consumer, 'bcc-execve.c', args.packed, g_capture,
+                              prefilter=prefilter)
+
+signal.signal(signal.SIGTERM, on_stop)
+signal.signal(signal.SIGINT, on_stop)
+
+stats = TraceStats(g_consumer, g_source)
+next_report = time.monotonic() + args.stats
+
+while not g_source.done and not g_stop:
+    g_source.poll()
+    if args.stats > 0 and time.monotonic() >= next_report:
+        print(stats.report())
+        next_report += args.stats
+
+if output_file == '':
+    print_results()
+else:
+    write_results(output_file)
@@ -0,0 +1,114 @@
+#! /usr/bin/env python3
+
+####################################################
+#
+#
+# micro-benchmark of argument classification
+#
+# Author: Mao Yifu, maoif@ios.ac.cn
+#
+#
+####################################################
+
+import time
+import random
+import argparse
+from arg_classify import *
+from trace_io import open_trace
+
+
+# classify_args() of datagen.py before ArgClassifier
+
+def legacy_is_url(s):
+    for prefix in ['http://', 'https://', 'ftp://', 'file://', 'data://']:
+        if s.startswith(prefix):
+            return True
+    return False
+
+
+def legacy_classify_args(args: list[str]):
+    results = []
+    length = len(args)
+
+    for i in range(length):
+        arg = args[i]
+
+        try:
+            if arg.startswith('--') or arg.startswith('-'):
+                if '=' in arg:
+                    results.append({ ARG_OP_ARG : arg })
+                else:
+                    results.append({ ARG_FLAG : arg })
+            elif legacy_is_url(arg):
+                results.append({ ARG_URL : arg })
+            elif is_number(arg):
+                results.append({ ARG_NUMBER : arg })
+            elif '=' in arg:
+                results.append({ ARG_OP_ARG : arg })
+            elif is_ip(arg):
+                results.append({ ARG_IP : arg })
+            else:
+                results.append({ ARG_UNKNOWN : arg })
+        except TypeError:
+            print(f'classify_args error: {arg}')
+            print(f'in \n {args}')
+
+    return results
+
+
+def synthetic_args(n: int, args: int) -> list:
+    # compiler and linker lines, most arguments repeat
+    words = ['-O2', '-g', '-Wall', '-fPIC', '-c', '-o', '-DNDEBUG', '-I../include', '--std=c11',
+             'CC=gcc', '2', '0.5', '127.0.0.1', 'localhost:8080', 'http://example.org/x',
+             'Makefile', 'install']
+    rnd = random.Random(0)
+    execs = []
+    for i in range(n):
+        a = [rnd.choice(words) for _ in range(args)]
+        a.append(f'src/file{rnd.randrange(2000)}.c')
+        execs.append(['cc'] + a)
+    return execs
+
+
+def trace_args(path: str, n: int) -> list:
+    execs = [d.args for d in open_trace(path)]
+    return (execs * (n // max(len(execs), 1) + 1))[:n]
+
+
+def bench(name: str, fn, execs: list, nargs: int):
+    start = time.perf_counter()
+    results = fn(execs)
+    elapsed = time.perf_counter() - start
+    print(f'{name:<20} {nargs / elapsed:>12,.0f} args/s')
+    return results
+
+
+###
+### start of program
+###
+
+parser = argparse.ArgumentParser(
+    prog='bench-classify',
+    description='Measure how many arguments per second are classified.')
+parser.add_argument('trace', nargs='?', help='take the args from this raw trace file')
+parser.add_argument('-n', type=int, default=200000, help='execs per measurement')
+parser.add_argument('--args', type=int, default=12, help='args per synthetic exec')
+
+args = parser.parse_args()
+
+if args.trace is not None:
+    execs = trace_args(args.trace, args.n)
+else:
+    execs = synthetic_args(args.n, args.args)
+nargs = sum(len(a) - 1 for a in execs)
+print(f'{len(execs):,} execs, {nargs:,} args')
+
+classifier = ArgClassifier()
+
+def as_dicts(classified):
+    return [[{ kind : arg } for kind, arg in c] for c in classified]
+
+expected = bench('legacy', lambda e: [legacy_classify_args(a[1:]) for a in e], execs, nargs)
+assert bench('cached', lambda e: as_dicts(classifier.classify(a[1:]) for a in e), execs, nargs) == expected
+classifier = ArgClassifier()
+assert bench('batched', lambda e: as_dicts(classifier.classify_batch(a[1:] for a in e)), execs, nargs) == expected
@@ -0,0 +1,98 @@
+#! /usr/bin/env python3
+
+####################################################
+#
+#
+# overhead of recording one invocation of a wrapped binary
+#
+# Author: Mao Yifu, maoif@ios.ac.cn
+#
+#
+####################################################
+
+import os
+import sys
+import time
+import socket
+import argparse
+import tempfile
+import subprocess
+
+
+g_here = os.path.dirname(os.path.abspath(__file__))
+
+
+def run(cmd: list, n: int, env: dict) -> float:
+    # seconds per invocation, run one after another like a test suite does
+    start = time.perf_counter()
+    for i in range(n):
+        subprocess.run(cmd + [str(i)], env=env, check=True, stdout=subprocess.DEVNULL)
+    return (time.perf_counter() - start) / n
+
+
+def wait_for_socket(path: str, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            s.connect(path)
+            return
+        except OSError:
+            time.sleep(0.05)
+        finally:
+            s.close()
+    raise TimeoutError(f'no collector on {path}')
+
+
+def count_lines(path: str) -> int:
+    n = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            with open(os.path.join(root, name), 'rb') as f:
+                n += sum(1 for _ in f)
+    return n
+
+
+###
+### start of program
+###
+
+parser = argparse.ArgumentParser(
+    prog='bench-collector',
+    description='Measure the time fuzz recording adds to each invocation of a wrapped binary.')
+parser.add_argument('-n', type=int, default=200, help='invocations per measurement')
+
+args = parser.parse_args()
+
+with tempfile.TemporaryDirectory() as perf_dir:
+    # the spool is measured as is, without the collector fuzz-client starts
+    env = dict(os.environ, TREC_PERF_DIR=perf_dir, TREC_FUZZ_AUTOSTART='OFF')
+    with open(os.path.join(perf_dir, 'input.txt'), 'w') as f:
+        f.write('input\n')
+    # what a wrapped binary of a test suite typically gets, the exe is a
+    # real one as it is for a wrapped binary, and is no file arg to copy
+    argv = ['pkg', '1.0', os.path.realpath(sys.executable), '-v', '--level=3', os.path.join(perf_dir, 'input.txt'),
+            perf_dir, 'http://localhost/x']
+    py = [sys.executable]
+
+    base = run(py + ['-c', 'pass'], args.n, env)
+    print(f'{"python startup":<28} {base * 1e3:>8.2f} ms/invocation')
+
+    for name, script in [('perf-fuzz-gen', 'perf-fuzz-gen.py'), ('fuzz-client, spool', 'fuzz-client.py')]:
+        t = run(py + [os.path.join(g_here, script)] + argv, args.n, env)
+        print(f'{name:<28} {t * 1e3:>8.2f} ms/invocation, {(t - base) * 1e3:>6.2f} ms over startup')
+
+    sock = os.path.join(perf_dir, 'fuzz', 'collector.sock')
+    collector = subprocess.Popen(py + [os.path.join(g_here, 'fuzz-collector.py'), '--interval', '0.1'],
+                                 env=env, stdout=subprocess.DEVNULL)
+    try:
+        wait_for_socket(sock)
+        t = run(py + [os.path.join(g_here, 'fuzz-client.py')] + argv, args.n, env)
+        print(f'{"fuzz-client, collector":<28} {t * 1e3:>8.2f} ms/invocation, {(t - base) * 1e3:>6.2f} ms over startup')
+    finally:
+        collector.terminate()
+        collector.wait()
+
+    # the spooled ones are collected at startup
+    records = count_lines(os.path.join(perf_dir, 'fuzz', 'corpus'))
+    print(f'{records} records in the corpus, {3 * args.n} expected')
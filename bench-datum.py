@@ -0,0 +1,103 @@
+#! /usr/bin/env python3
+
+####################################################
+#
+#
+# memory footprint of decoded TraceDatums
+#
+# Author: Mao Yifu, maoif@ios.ac.cn
+#
+#
+####################################################
+
+import gc
+import argparse
+import tracemalloc
+from trace_io import *
+
+
+# TraceDatum before __slots__ and interning
+
+class LegacyDatum:
+
+    def __init__(self):
+        self.pid_tgid = False
+        self.comm = False
+        self.file_path = False
+        self.args = []
+        self.envs = []
+        self.path_parts = []
+        self.working_dir = False
+        self.creator = ""
+        self.flags = 0
+        self.fail_arg = False
+        self.fail_env = False
+        self.fail_path = False
+        self.incomplete_args = False
+        self.incomplete_envs = False
+
+
+def legacy_decode_datum(buf) -> LegacyDatum:
+    pid_tgid, flags, nargs, nenvs = RECORD_FIXED.unpack_from(buf, 0)
+    pos = RECORD_FIXED.size
+
+    d = LegacyDatum()
+    d.pid_tgid = pid_tgid
+    d.flags = flags
+    d.comm, pos = decode_str(buf, pos)
+    d.file_path, pos = decode_str(buf, pos)
+    d.working_dir, pos = decode_str(buf, pos)
+    for _ in range(nargs):
+        a, pos = decode_str(buf, pos)
+        d.args.append(a)
+    for _ in range(nenvs):
+        e, pos = decode_str(buf, pos)
+        d.envs.append(e)
+    return d
+
+
+def synthetic_records(n: int, args: int, envs: int) -> list[bytes]:
+    # a build: few callers and dirs, the same environment everywhere
+    records = []
+    env = [f'RPM_BUILD_VAR_{i}=/home/abuild/rpmbuild/BUILD/value{i}' for i in range(envs)]
+    for i in range(n):
+        d = TraceDatum()
+        d.pid_tgid = i + 1
+        d.comm = ['make', 'gcc', 'sh', 'cmake'][i % 4]
+        d.file_path = f'./tool{i % 97}'
+        d.working_dir = f'/home/abuild/rpmbuild/BUILD/pkg/src/dir{i % 50}'
+        d.args = [d.file_path] + [f'--option{j}={i}' for j in range(1, args)]
+        d.envs = env
+        records.append(encode_datum(d))
+    return records
+
+
+def measure(decode, records: list[bytes]) -> int:
+    gc.collect()
+    tracemalloc.start()
+    data = [decode(r) for r in records]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del data
+    return size
+
+
+###
+### start of program
+###
+
+parser = argparse.ArgumentParser(
+    prog='bench-datum',
+    description='Measure the memory taken by decoded TraceDatums.')
+parser.add_argument('-n', type=int, default=20000, help='datums to decode, the result is scaled to 1M')
+parser.add_argument('--args', type=int, default=8, help='args per exec')
+parser.add_argument('--envs', type=int, default=60, help='envs per exec')
+
+args = parser.parse_args()
+
+records = synthetic_records(args.n, args.args, args.envs)
+scale = 1000000 / args.n
+
+for name, decode in [('before', legacy_decode_datum), ('after', decode_datum)]:
+    size = measure(decode, records)
+    print(f'{name:<8} {size / args.n:>8,.0f} bytes/datum, {size * scale / 2**30:>6.2f} GiB per 1M datums')
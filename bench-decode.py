@@ -0,0 +1,145 @@
+#! /usr/bin/env python3
+
+####################################################
+#
+#
+# micro-benchmark of ring buffer event decoding
+#
+# Author: Mao Yifu, maoif@ios.ac.cn
+#
+#
+####################################################
+
+import time
+import ctypes
+import argparse
+from trace_events import *
+
+
+# what BCC generates for `b[...].event()`
+class DataBasic(ctypes.Structure):
+    _fields_ = [('pid_tgid', ctypes.c_uint64),
+                ('flags', ctypes.c_uint32),
+                ('comm', ctypes.c_char * TASK_COMM_LEN),
+                ('filename', ctypes.c_char * PATH_SIZE)]
+
+
+class DataArg(ctypes.Structure):
+    _fields_ = [('pid_tgid', ctypes.c_uint64),
+                ('args', ctypes.c_char * MAX_STR_SIZE)]
+
+
+class DataPathPart(ctypes.Structure):
+    _fields_ = [('pid_tgid', ctypes.c_uint64),
+                ('path', ctypes.c_char * MAX_PATH_READ)]
+
+
+class Table:
+    # the parts of bcc.table.RingBuf used by the callbacks
+
+    def __init__(self, event_class):
+        self.event_class = event_class
+        self._event_class = None
+
+
+    def event(self, data):
+        if self._event_class == None:
+            self._event_class = self.event_class
+        return ctypes.cast(data, ctypes.POINTER(self._event_class)).contents
+
+
+class Tables:
+
+    def __init__(self):
+        self.tables = {}
+
+
+    def __getitem__(self, key):
+        if key not in self.tables:
+            self.tables[key] = Table({'events_basic': DataBasic,
+                                      'events_arg': DataArg,
+                                      'events_path_part': DataPathPart}[key])
+        return self.tables[key]
+
+
+b = Tables()
+batch = EventBatch()
+
+
+# the callbacks of bcc-execve.py, before and after, without touching any datum
+
+def legacy_basic(ctx, data, size):
+    event = b['events_basic'].event(data)
+    return event.pid_tgid, event.flags, event.comm.decode('utf-8'), event.filename.decode('utf-8')
+
+
+def legacy_arg(ctx, data, size):
+    event = b['events_arg'].event(data)
+    ids = event.pid_tgid
+    arg = ""
+    try:
+        arg = event.args.decode('utf-8')
+    except UnicodeDecodeError:
+        arg = event.args
+    return ids, arg
+
+
+def legacy_path_part(ctx, data, size):
+    event = b['events_path_part'].event(data)
+    return event.pid_tgid, event.path.decode('utf-8')
+
+
+def record_basic(ctx, data, size):
+    batch.basics.append(decode_basic(record_view(data, size)))
+
+
+def record_arg(ctx, data, size):
+    batch.args.append(decode_arg(record_view(data, size)))
+
+
+def record_path_part(ctx, data, size):
+    batch.path_parts.append(decode_path_part(record_view(data, size)))
+
+
+def record(struct_type, **fields):
+    r = struct_type(**fields)
+    return r, ctypes.addressof(r), ctypes.sizeof(r)
+
+
+def bench(name: str, fn, data: int, size: int, n: int):
+    start = time.perf_counter()
+    for _ in range(n):
+        fn(None, data, size)
+    elapsed = time.perf_counter() - start
+    batch.apply(lambda ids, creator: TraceDatum())
+    print(f'{name:<24} {n / elapsed:>12,.0f} events/s')
+
+
+###
+### start of program
+###
+
+parser = argparse.ArgumentParser(
+    prog='bench-decode',
+    description='Measure how many ring buffer events per second can be decoded.')
+parser.add_argument('-n', type=int, default=200000, help='events per measurement')
+
+args = parser.parse_args()
+n = args.n
+
+basic, basic_addr, basic_size = record(DataBasic, pid_tgid=42, flags=0,
+                                       comm=b'make', filename=b'./build/tool')
+arg, arg_addr, arg_size = record(DataArg, pid_tgid=42, args=b'--output=build/out.o')
+part, part_addr, part_size = record(DataPathPart, pid_tgid=42, path=b'BUILD')
+
+# both ways must agree
+assert legacy_basic(None, basic_addr, basic_size) == decode_basic(ctypes.string_at(basic_addr, basic_size))
+assert legacy_arg(None, arg_addr, arg_size) == decode_arg(ctypes.string_at(arg_addr, arg_size))
+assert legacy_path_part(None, part_addr, part_size) == decode_path_part(ctypes.string_at(part_addr, part_size))
+
+bench('basic, ctypes', legacy_basic, basic_addr, basic_size, n)
+bench('basic, in place', record_basic, basic_addr, basic_size, n)
+bench('arg/env, ctypes', legacy_arg, arg_addr, arg_size, n)
+bench('arg/env, in place', record_arg, arg_addr, arg_size, n)
+bench('path part, ctypes', legacy_path_part, part_addr, part_size, n)
+bench('path part, in place', record_path_part, part_addr, part_size, n)
@@ -0,0 +1,135 @@
+#! /usr/bin/env python3
+
+####################################################
+#
+#
+# micro-benchmark of the executable filter rules
+#
+# Author: Mao Yifu, maoif@ios.ac.cn
+#
+#
+####################################################
+
+import time
+import random
+import argparse
+from exec_rules import *
+from trace_io import open_trace
+
+
+def synthetic_paths(n: int, exes: list) -> list:
+    # about half system tools, the rest build products and scripts
+    system = ['/usr/bin/gcc', '/usr/bin/ld', '/bin/sh', '/usr/lib/gcc/cc1', '/usr/bin/sed',
+              '/var/lib/dpkg/info/x.postinst', '/tmp/cc-wrapper']
+    noise = ['./configure', './conftest', 'libtool.sh', 'build-aux/config.guess',
+             '/home/abuild/rpmbuild/BUILD/pkg/./exec.cmd']
+    rnd = random.Random(0)
+    paths = []
+    for _ in range(n):
+        r = rnd.random()
+        if r < 0.5:
+            paths.append(rnd.choice(system))
+        elif r < 0.6:
+            paths.append('/home/abuild/rpmbuild/BUILD/pkg/' + rnd.choice(noise))
+        else:
+            paths.append(rnd.choice(exes))
+    return paths
+
+
+def trace_paths(path: str, n: int, execs: list = None) -> list:
+    # with `execs`, also collect (working dir, filename) of each exec
+    paths = []
+    for d in open_trace(path):
+        exe = d.file_path
+        if not exe.startswith('/'):
+            exe = d.working_dir + '/' + exe
+        paths.append(exe)
+        if execs is not None:
+            execs.append((d.working_dir, d.file_path))
+    # repeat the trace up to `n` paths
+    return (paths * (n // max(len(paths), 1) + 1))[:n]
+
+
+def reference_keep(rules: ExecRules, allowlist: list):
+    # what filter_result() did before ExecMatcher
+    def keep(exe):
+        if not allowlist == []:
+            if exe not in allowlist:
+                return False
+        return not filtered(rules, exe)
+    return keep
+
+
+def rule_execs(rules: ExecRules) -> list:
+    # (working dir, filename) around each rule, absolute and relative
+    wd = '/home/abuild/rpmbuild/BUILD/pkg'
+    execs = []
+    for p in rules.prefixes:
+        execs += [(wd, p), (wd, p + 'tool'), (wd, p.lstrip('/')), ('/', p.lstrip('/') + 'tool')]
+    for s in rules.suffixes:
+        execs += [(wd, s), (wd, 'tool' + s), (wd, wd + '/' + s), (wd, s.lstrip('./'))]
+    for i in rules.infixes:
+        execs += [(wd, i), (wd, 'a' + i + 'b'), (wd, wd + '/' + i)]
+    return execs
+
+
+def check_prefilter(rules: ExecRules, execs: list) -> int:
+    # The kernel only records the basic info of the execs prefiltered()
+    # matches, those had better be left out of the datasets anyway.
+    # Returns how many were matched.
+    n = 0
+    for wd, filename in set(execs):
+        if not prefiltered(rules, filename.encode('utf-8', 'surrogateescape')):
+            continue
+        exe = filename if filename.startswith('/') else wd + '/' + filename
+        assert filtered(rules, exe), f'prefiltered but kept: {filename} in {wd}'
+        n += 1
+    return n
+
+
+def bench(name: str, keep, paths: list) -> list:
+    start = time.perf_counter()
+    kept = [keep(p) for p in paths]
+    elapsed = time.perf_counter() - start
+    print(f'{name:<28} {len(paths) / elapsed:>12,.0f} matches/s')
+    return kept
+
+
+###
+### start of program
+###
+
+parser = argparse.ArgumentParser(
+    prog='bench-rules',
+    description='Measure how many executable paths per second the filter rules match.')
+parser.add_argument('trace', nargs='?', help='take the paths from this raw trace file')
+parser.add_argument('-n', type=int, default=2000000, help='paths per measurement')
+parser.add_argument('--rules', default=G_RULES_PATH, help='rule file')
+parser.add_argument('--refinement', type=int, default=200,
+                    help='size of the refinement list in the second round, 0 to skip it')
+
+args = parser.parse_args()
+
+rules = load_rules(args.rules)
+exes = [f'/home/abuild/rpmbuild/BUILD/pkg/build/tool{i}' for i in range(1000)]
+execs = rule_execs(rules)
+if args.trace is not None:
+    paths = trace_paths(args.trace, args.n, execs)
+else:
+    paths = synthetic_paths(args.n, exes)
+    execs += [('/home/abuild/rpmbuild/BUILD/pkg', p) for p in set(paths)]
+
+print(f'{len(paths):,} paths, {len(rules.prefixes)} prefix, {len(rules.suffixes)} suffix, '
+      f'{len(rules.infixes)} infix rules')
+
+n = check_prefilter(rules, execs)
+print(f'prefilter: {len(set(execs))} execs checked, {n} matched, all filtered')
+
+expected = bench('loops', reference_keep(rules, []), paths)
+assert bench('compiled', ExecMatcher(rules).keep, paths) == expected
+
+if args.refinement > 0:
+    refinement = exes[:args.refinement]
+    print(f'with a refinement of {len(refinement)} executables')
+    expected = bench('loops, list scan', reference_keep(rules, refinement), paths)
+    assert bench('compiled, set', ExecMatcher(rules, refinement).keep, paths) == expected
@@ -0,0 +1,90 @@
+#! /usr/bin/env python3
+
+####################################################
+#
+#
+# throughput benchmark of the tracer's userspace side
+#
+# Author: Mao Yifu, maoif@ios.ac.cn
+#
+#
+####################################################
+
+import os
+import time
+import argparse
+import tempfile
+import tracemalloc
+from trace_io import *
+from trace_consumer import *
+from trace_sources import *
+
+
+def percentile(values: list[float], p: float) -> float:
+    if values == []:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run(events: list, rate: float, output: str, measure_memory: bool):
+    writer = BinaryTraceWriter(output, {'package' : 'bench', 'version' : '0'})
+    consumer = TraceConsumer(writer)
+    source = ReplayEventSource(consumer, events, rate)
+
+    latencies = []
+    consumer.on_complete = lambda d: latencies.append(time.monotonic() - source.batch_time)
+
+    if measure_memory:
+        tracemalloc.start()
+
+    start = time.monotonic()
+    while not source.done:
+        source.poll()
+    consumer.close()
+    elapsed = time.monotonic() - start
+
+    peak = 0
+    if measure_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    latencies.sort()
+    return consumer, elapsed, latencies, peak
+
+
+###
+### start of program
+###
+
+parser = argparse.ArgumentParser(
+    prog='bench-tracer',
+    description='Replay synthetic execve() events through the tracer without BPF.')
+parser.add_argument('-n', '--execs', type=int, default=20000, help='number of execs')
+parser.add_argument('--args', type=int, default=8, help='args per exec')
+parser.add_argument('--envs', type=int, default=40, help='envs per exec')
+parser.add_argument('--depth', type=int, default=5, help='working dir depth')
+parser.add_argument('--rate', type=float, default=0,
+                    help='events per second, as fast as possible by default')
+parser.add_argument('--replay', help='replay a capture made with bcc-execve.py --capture instead')
+
+args = parser.parse_args()
+
+# generated up front, so that only the consumer is measured
+if args.replay is not None:
+    events = list(read_capture(args.replay))
+else:
+    events = list(synthetic_events(args.execs, args.args, args.envs, args.depth))
+
+with tempfile.TemporaryDirectory() as tmp:
+    output = os.path.join(tmp, f'bench{TRACE_EXT}')
+
+    consumer, elapsed, latencies, _ = run(events, args.rate, output, False)
+    print(f'events:      {len(events)}')
+    print(f'execs:       {consumer.completed} completed, {consumer.written} written, {consumer.evicted} evicted')
+    print(f'throughput:  {consumer.completed / elapsed:,.0f} execs/s, {len(events) / elapsed:,.0f} events/s')
+    print(f'latency:     p50 {percentile(latencies, 0.5) * 1000:.2f} ms, '
+          f'p99 {percentile(latencies, 0.99) * 1000:.2f} ms, '
+          f'max {percentile(latencies, 1.0) * 1000:.2f} ms')
+
+    _, _, _, peak = run(events, args.rate, output, True)
+    print(f'peak memory: {peak / 1024 / 1024:.1f} MiB')
@@ -0,0 +1,351 @@
+#! /usr/bin/env python3
+
+####################################################
+#
+#
+# merge the datasets of many packages into one perf and one fuzz dataset
+#
+# Author: Mao Yifu, maoif@ios.ac.cn
+#
+#
+####################################################
+
+import os
+import json
+import time
+import heapq
+import argparse
+import tempfile
+import yaml
+from trace_io import TraceLoader
+from dataset_io import *
+from fuzz_files import parse_size
+from fuzz_corpus import fuzz_entry
+
+
+g_script_name = 'corpus-merge'
+g_state_name = 'merge-state.json'
+g_state_version = 1
+# runs merged at once, more are merged in several passes
+g_fan_in = 64
+
+
+def notice(msg: str = ''):
+    print(f'[{g_script_name}] {msg}')
+
+
+def find_inputs(paths: list[str]) -> dict:
+    # absolute path -> (kind, package) of the -perf and -fuzz datasets of
+    # datagen and the .refinement files of perf-wrapper among `paths`
+    files = []
+    for p in paths:
+        if os.path.isdir(p):
+            files += [os.path.join(p, n) for n in sorted(os.listdir(p))]
+        else:
+            files.append(p)
+
+    inputs = {}
+    for f in files:
+        name = os.path.basename(f)
+        if not os.path.isfile(f) or name.endswith(INDEX_EXT):
+            continue
+        if name.endswith('.refinement'):
+            # {package}_{version}.refinement
+            package, _, version = name[:-len('.refinement')].rpartition('_')
+            inputs[os.path.abspath(f)] = ('refinement', f'{package}-{version}')
+            continue
+        package, version = dataset_name(f)
+        kind = dataset_kind(f)
+        if package != '' and kind in ['perf', 'fuzz']:
+            inputs[os.path.abspath(f)] = (kind, f'{package}-{version}')
+    return inputs
+
+
+def file_state(path: str) -> dict:
+    st = os.stat(path)
+    return { 'size' : st.st_size, 'mtime_ns' : st.st_mtime_ns }
+
+
+def dumps(o) -> str:
+    return json.dumps(o, default=json_default, sort_keys=True)
+
+
+class ExternalMerge:
+    # Sort and dedup of (key, value) pairs on disk. Pairs are kept as
+    # `key<TAB>value` lines of JSON, which sort by key as plain strings. Up
+    # to `run_bytes` of them are sorted in memory and written as a run, the
+    # runs are merged at the end and equal keys combined with `combine`.
+
+    def __init__(self, tmp_dir: str, run_bytes: int, combine):
+        self.tmp_dir = tmp_dir
+        self.run_bytes = run_bytes
+        self.combine = combine
+        self.lines = []
+        self.size = 0
+        self.runs = []
+        self.pairs = 0
+
+
+    def add(self, key, value):
+        line = dumps(key) + '\t' + dumps(value) + '\n'
+        self.lines.append(line)
+        self.size += len(line)
+        self.pairs += 1
+        if self.size >= self.run_bytes:
+            self.flush()
+
+
+    def flush(self):
+        if self.lines == []:
+            return
+        self.lines.sort()
+        self.runs.append(self.write_run(self.lines))
+        self.lines = []
+        self.size = 0
+
+
+    def write_run(self, lines) -> str:
+        fd, path = tempfile.mkstemp(prefix='run-', dir=self.tmp_dir)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.writelines(lines)
+        return path
+
+
+    def read_run(self, path: str):
+        with open(path, 'r', encoding='utf-8') as f:
+            yield from f
+
+
+    def merged_lines(self, extra=None):
+        # all lines in order, from the runs and the sorted iterable `extra`
+        self.flush()
+        runs = self.runs
+        while len(runs) > g_fan_in:
+            merged = self.write_run(heapq.merge(*[self.read_run(r) for r in runs[:g_fan_in]]))
+            for r in runs[:g_fan_in]:
+                os.unlink(r)
+            runs = runs[g_fan_in:] + [merged]
+        self.runs = runs
+        sources = [self.read_run(r) for r in runs]
+        if extra is not None:
+            sources.append(extra)
+        return heapq.merge(*sources)
+
+
+    def merged(self, extra=None):
+        # (key, value) with the values of equal keys combined, in key order
+        key = None
+        value = None
+        for line in self.merged_lines(extra):
+            k, _, v = line.partition('\t')
+            v = json.loads(v)
+            if k == key:
+                value = self.combine(value, v)
+                continue
+            if key is not None:
+                yield json.loads(key), value
+            key = k
+            value = v
+        if key is not None:
+            yield json.loads(key), value
+
+
+def union(a: list, b: list) -> list:
+    return sorted(set(a) | set(b))
+
+
+def combine_perf(a: dict, b: dict) -> dict:
+    return { 'packages' : union(a['packages'], b['packages']),
+             'refined'  : union(a['refined'], b['refined']) }
+
+
+def combine_fuzz(a: dict, b: dict) -> dict:
+    return { 'classified_args' : a['classified_args'],
+             'count'           : a['count'] + b['count'],
+             'packages'        : union(a['packages'], b['packages']) }
+
+
+# Merged records and the (key, value) pairs they are made of. The merged
+# datasets are in key order, so the last merge is read back as one more
+# sorted run when packages are added.
+
+def perf_record(key, value) -> dict:
+    return { 'exe' : key, **value }
+
+
+def perf_pair(record: dict) -> tuple:
+    return record['exe'], { 'packages' : record['packages'], 'refined' : record['refined'] }
+
+
+def fuzz_record(key, value) -> dict:
+    exe, raw_args, incomplete_args, incomplete_envs = key
+    return { 'exe' : exe, 'raw_args' : raw_args, 'incomplete_args' : incomplete_args,
+             'incomplete_envs' : incomplete_envs, **value }
+
+
+def fuzz_pair(record: dict) -> tuple:
+    return ([record['exe'], record['raw_args'], record['incomplete_args'], record['incomplete_envs']],
+            { 'classified_args' : record['classified_args'], 'count' : record['count'],
+              'packages' : record['packages'] })
+
+
+def previous_lines(path: str, to_pair):
+    for record in read_dataset(path):
+        key, value = to_pair(record)
+        yield dumps(key) + '\t' + dumps(value) + '\n'
+
+
+def add_input(path: str, kind: str, package: str, perf: ExternalMerge, fuzz: ExternalMerge) -> int:
+    n = 0
+    if kind == 'refinement':
+        with open(path, 'r') as f:
+            exes = yaml.load(f, Loader=TraceLoader) or []
+        for exe in exes:
+            perf.add(exe, { 'packages' : [package], 'refined' : [package] })
+            n += 1
+    elif kind == 'perf':
+        for exe in read_dataset(path):
+            perf.add(exe, { 'packages' : [package], 'refined' : [] })
+            n += 1
+    else:
+        for record in read_dataset(path):
+            exe, raw_args, classified = fuzz_entry(record)
+            # records of the corpus have no flags
+            incomplete_args, incomplete_envs = False, False
+            if 'raw_args' not in record:
+                incomplete_args, incomplete_envs = record[exe][:2]
+            fuzz.add([exe, raw_args, incomplete_args, incomplete_envs],
+                     { 'classified_args' : [list(c) for c in classified], 'count' : 1,
+                       'packages' : [package] })
+            n += 1
+    return n
+
+
+def write_merged(path: str, pairs, to_record) -> int:
+    tmp = os.path.join(os.path.dirname(path), '.merge-' + os.path.basename(path))
+    with DatasetWriter(tmp, 'jsonl') as w:
+        batch = []
+        for key, value in pairs:
+            batch.append(to_record(key, value))
+            if len(batch) >= 4096:
+                w.write_many(batch)
+                batch = []
+        w.write_many(batch)
+    os.replace(tmp, path)
+    return w.count
+
+
+def load_state(output_dir: str) -> dict:
+    try:
+        with open(os.path.join(output_dir, g_state_name), 'r') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if state.get('version') != g_state_version:
+        return None
+    return state
+
+
+def changes(state: dict, outputs: dict) -> list[str]:
+    # Why the last merge cannot be extended: its outputs were changed since,
+    # or inputs it merged changed or are gone. An input that merely is not
+    # given this time stays merged. A package cannot be taken out of the
+    # merge, everything is merged again then.
+    reasons = []
+    for name, path in outputs.items():
+        if not os.path.exists(path) or state['outputs'].get(name) != { 'path' : path, **file_state(path) }:
+            reasons.append(f'{path} is not the output of the last merge')
+    for path, s in state['inputs'].items():
+        if not os.path.exists(path):
+            reasons.append(f'{path} is gone since the last merge, dropping it')
+        elif file_state(path) != s['file']:
+            reasons.append(f'{path} changed since the last merge')
+    return reasons
+
+
+def save_state(output_dir: str, inputs: dict, outputs: dict):
+    state = { 'version' : g_state_version,
+              'inputs'  : { p : { 'kind' : kind, 'package' : package, 'file' : file_state(p) }
+                            for p, (kind, package) in inputs.items() },
+              'outputs' : { name : { 'path' : path, **file_state(path) } for name, path in outputs.items() } }
+    tmp = os.path.join(output_dir, '.' + g_state_name)
+    with open(tmp, 'w') as f:
+        json.dump(state, f, indent=1)
+    os.replace(tmp, os.path.join(output_dir, g_state_name))
+
+
+###
+### start of program
+###
+
+parser = argparse.ArgumentParser(
+    prog=g_script_name,
+    description='Merge the perf and fuzz datasets and refinements of many packages, with the packages of each entry.')
+parser.add_argument('inputs', nargs='+', help='datasets of datagen, refinement files, or directories of them')
+parser.add_argument('-o', '--output-dir', default='.', help='where perf.jsonl, fuzz.jsonl and the merge state go')
+parser.add_argument('--compress', choices=['gz', 'xz'], help='compress the merged datasets')
+parser.add_argument('--run-size', default='256M', help='memory for sorting, the size of each run on disk')
+parser.add_argument('--tmp-dir', help='where the runs go, the output dir by default')
+parser.add_argument('--rebuild', action='store_true', help='merge all inputs again, those of the last merge too, instead of only new ones')
+
+args = parser.parse_args()
+
+for p in args.inputs:
+    if not os.path.exists(p):
+        notice(f'{p} not found')
+        exit(-1)
+os.makedirs(args.output_dir, exist_ok=True)
+
+inputs = find_inputs(args.inputs)
+ext = dataset_ext('jsonl', args.compress)
+outputs = { 'perf' : os.path.abspath(os.path.join(args.output_dir, 'perf' + ext)),
+            'fuzz' : os.path.abspath(os.path.join(args.output_dir, 'fuzz' + ext)) }
+
+state = load_state(args.output_dir)
+reasons = [] if state is None else changes(state, outputs)
+if state is not None and reasons == [] and not args.rebuild:
+    new = { p : v for p, v in inputs.items() if p not in state['inputs'] }
+    notice(f'{len(state["inputs"])} inputs merged before, {len(new)} new')
+else:
+    new = dict(inputs)
+    if state is not None:
+        for r in reasons:
+            notice(r)
+        # the inputs of the last merge that are still there, with the given ones
+        for path, s in state['inputs'].items():
+            if os.path.exists(path):
+                new.setdefault(path, (s['kind'], s['package']))
+        notice(f'merging all {len(new)} inputs again')
+    state = None
+
+if new == {}:
+    notice('nothing new to merge')
+    exit(0)
+
+start = time.monotonic()
+run_bytes = parse_size(args.run_size)
+with tempfile.TemporaryDirectory(prefix='corpus-merge-', dir=args.tmp_dir or args.output_dir) as tmp_dir:
+    # half of the memory for each
+    perf = ExternalMerge(tmp_dir, run_bytes // 2, combine_perf)
+    fuzz = ExternalMerge(tmp_dir, run_bytes // 2, combine_fuzz)
+    for path, (kind, package) in sorted(new.items()):
+        n = add_input(path, kind, package, perf, fuzz)
+        notice(f'{package} {kind}: {n} entries from {path}')
+
+    previous = state is not None
+    perf_n = write_merged(outputs['perf'],
+                          perf.merged(previous_lines(outputs['perf'], perf_pair) if previous else None),
+                          perf_record)
+    fuzz_n = write_merged(outputs['fuzz'],
+                          fuzz.merged(previous_lines(outputs['fuzz'], fuzz_pair) if previous else None),
+                          fuzz_record)
+
+merged = dict(state['inputs']) if state is not None else {}
+merged = { p : (s['kind'], s['package']) for p, s in merged.items() }
+merged.update(new)
+save_state(args.output_dir, merged, outputs)
+
+elapsed = max(time.monotonic() - start, 1e-9)
+notice(f'{len(new)} inputs, {perf.pairs + fuzz.pairs} entries merged in {elapsed:.1f} s')
+notice(f'{perf_n} executables at {outputs["perf"]}')
+notice(f'{fuzz_n} distinct fuzz records at {outputs["fuzz"]}')
@@ -12,159 +12,32 @@
 
 import os
 import sys
+import time
 import argparse
 import yaml
 import trace_datum
-import socket
 from trace_datum import *
+from exec_rules import *
+from trace_pipeline import *
+from trace_store import TraceStore
 
 
 g_package: str = ''
 g_version: str = ''
 g_true_exes = []
+g_matcher: ExecMatcher = None
 
-ARG_FLAG    = 'op_flag'   # -v, --help
-# TODO -I../lib
-# ARG_OP     = 'op'     # --input bla, --files f1 f2
-ARG_OP_ARG  = 'op_arg' # --quality=9, if=/dev/null
-ARG_NUMBER  = 'op_num'
-ARG_STRING  = 'op_str'
-ARG_PATH    = 'op_path'
-ARG_URL     = 'op_url'
-ARG_IP      = 'op_ip'
-ARG_UNKNOWN = 'op_unknown'
 
-
-def is_number(n):
-    is_number = True
-    try:
-        num = float(n)
-    except ValueError:
-        is_number = False
-    return is_number
-
-
-def is_url(s):
-    for prefix in ['http://', 'https://', 'ftp://', 'file://', 'data://']:
-        if s.startswith(prefix):
-            return True
-    return False
-
-
-def is_ip(s):
-    parts = s.split(':')
-    if len(parts) <= 2:
-        try:
-            ignore = socket.inet_aton(parts[0])
-            return True
-        except OSError:
-            return False
-
-    return False
-
-
-def is_path(s):
-    return False
-
-
-def classify_args(args: list[str]):
-    results = []
-    length = len(args)
-
-    for i in range(length):
-        arg = args[i]
-        
-        try:
-            if arg.startswith('--') or arg.startswith('-'):
-                if '=' in arg:
-                    results.append({ ARG_OP_ARG : arg })
-                else:
-                    results.append({ ARG_FLAG : arg })
-            elif is_url(arg):
-                results.append({ ARG_URL : arg })
-            elif is_number(arg):
-                results.append({ ARG_NUMBER : arg })
-            elif '=' in arg:
-                # dd if=/dev/zero
-                results.append({ ARG_OP_ARG : arg })
-            elif is_ip(arg):
-                results.append({ ARG_IP : arg })
-            elif is_path(arg):
-                results.append({ ARG_PATH : arg })
-            else:
-                # TODO subcommands like `perf report`
-                results.append({ ARG_UNKNOWN : arg })
-        except TypeError:
-            print(f'classify_args error: {arg}')
-            print(f'in \n {args}')
-            
-    return results
-            
-
-def analyze_envs():
-    pass
-
-
-def filter_result(datum: TraceDatum):
-    callee = datum.file_path
-
-    if not g_true_exes == []:
-        if callee not in g_true_exes:
-            return False
-
-    filter_prefixes = ['/bin/', '/usr/', '/sbin/', '/snap/', '/opt/', '/tmp/', '/etc/']
-    for p in filter_prefixes:
-       if callee.startswith(p):
-            return False
-
-    filter_suffixes = ['./conftest', './configure', '.build.command', '/bin/sh', '/.', '.sh'
-                       'config.guess']
-    for p in filter_suffixes:
-       if callee.endswith(p):
-            return False
-
-    filter_infixes = ['./exec.cmd']
-    for p in filter_infixes:
-       if p in callee:
-            return False
-
-    return datum.check_fields()
-
-
-def to_absolute_path(data: list[TraceDatum]):
-    for d in data:
-        exe = d.file_path
-        # caller's working dir
-        pwd = d.working_dir
-
-        # convert to absolute path
-        if not exe.startswith('/'):
-            exe = pwd + '/' + exe
-
-        d.file_path = exe
-
-
-def analyzer_for_fuzz(data: list[TraceDatum]):
-    results = []
-
-    for d in data:
-        # fuzz data should not be deduplicated
-        args_classified = classify_args(d.args[1:])
-        results.append({ d.file_path : [d.incomplete_args, 
-                                        d.incomplete_envs, 
-                                        { 'raw_args' : d.args,
-                                          'classified_args' : args_classified }]})
-
-    return results
-
-
-def analyze(data: list[TraceDatum]):
-    to_absolute_path(data)
-    filtered = list(filter(lambda d: filter_result(d), data))
-    fuzz = analyzer_for_fuzz(filtered)
-    perf = list(set([d.file_path for d in filtered]))
-
-    return fuzz, perf
+def analyze_envs(header: dict) -> str:
+    # how bcc-execve captured the envs, traces without env_mode have all of them
+    env_mode = header.get('env_mode', 'all')
+    if env_mode == 'allowlist':
+        print(f'envs: only {", ".join(header.get("env_allowlist", []))}')
+    elif env_mode == 'hash':
+        print('envs: a hash of all env vars per exec')
+    elif env_mode == 'off':
+        print('envs: not captured, incomplete_envs is always false')
+    return env_mode
 
 
 def check_file(f):
@@ -174,6 +47,42 @@ def check_file(f):
     elif not os.path.isfile(f):
         print(f'{f} is not a file')
 
+def run_datagen_batch(args):
+    if not os.path.exists(args.batch):
+        print(f'{args.batch} not found')
+        exit(-1)
+    check_file(args.rules)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    jobs = find_rawfiles(args.batch)
+    print(f'{len(jobs)} rawfiles from {args.batch}, {args.jobs} jobs')
+
+    counts = { 'done' : 0, 'skipped' : 0, 'failed' : 0 }
+    records = 0
+    size = 0
+    start = time.monotonic()
+    for n, r in enumerate(run_batch(jobs, args.jobs, rules=args.rules, output_dir=args.output_dir,
+                                    columnar=args.columnar, stats=args.stats, force=args.force,
+                                    fmt=args.format, compress=args.compress, index=args.index), 1):
+        counts[r['status']] += 1
+        line = f'[{n}/{len(jobs)}] {r["rawfile"]} {r["status"]}'
+        if r['status'] == 'done':
+            records += r['records']
+            size += r['bytes']
+            line += f', {r["records"]} records in {r["seconds"]:.1f} s'
+        elif r['status'] == 'failed':
+            line += f': {r["error"]}'
+        print(line)
+
+    elapsed = max(time.monotonic() - start, 1e-9)
+    print(f'{counts["done"]} done, {counts["skipped"]} up to date, {counts["failed"]} failed '
+          f'in {elapsed:.1f} s')
+    print(f'{counts["done"] / elapsed:.2f} rawfiles/s, {records / elapsed:,.0f} records/s, '
+          f'{size / elapsed / 2**20:.1f} MiB/s')
+    if counts['failed'] > 0:
+        exit(-1)
+
+
 ###
 ### start of program
 ###
@@ -181,15 +90,57 @@ def check_file(f):
 parser = argparse.ArgumentParser(
     prog='datagen',
     description='Analyze bpftrace data and generate dataset.')
-parser.add_argument('rawfile', help='raw trace files in yaml format')
+parser.add_argument('rawfile', nargs='?', help='raw trace files in yaml or binary format')
 parser.add_argument('--refinement', help='refinement data generated by perf-wrapper')
+parser.add_argument('--rules', default=G_RULES_PATH,
+                    help='rules of executables to leave out, exec-filter.rules by default')
+parser.add_argument('--columnar', action='store_true',
+                    help='load a binary trace into a column table and filter it with NumPy, needs numpy')
+parser.add_argument('--stats', action='store_true',
+                    help='also write counts of execs, executables and flags')
+parser.add_argument('--from-db', metavar='DB',
+                    help='read the trace from a database of trace-import instead of a rawfile')
+parser.add_argument('--trace', type=int,
+                    help='id of the trace in the database of --from-db, the last one imported by default')
+parser.add_argument('--batch', metavar='DIR|MANIFEST',
+                    help='process all rawfiles of a directory, or those listed in a manifest with optional refinements')
+parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                    help='rawfiles processed in parallel in batch mode')
+parser.add_argument('--output-dir', default='.', help='where to write the datasets')
+parser.add_argument('--format', choices=DATASET_FORMATS, default='yaml',
+                    help='yaml, or jsonl for one JSON record per line with a .jsonl extension')
+parser.add_argument('--compress', choices=['gz', 'xz'],
+                    help='compress the datasets, adds the extension to their names')
+parser.add_argument('--index', action='store_true',
+                    help='also write {fuzz dataset}.idx, the offsets of the records of each executable')
+parser.add_argument('--force', action='store_true',
+                    help='also process rawfiles whose datasets are newer than their inputs')
 
 args = parser.parse_args()
 
+if args.index and args.compress is not None:
+    print('--index needs an uncompressed fuzz dataset')
+    exit(-1)
+
+if args.batch is not None:
+    if args.rawfile is not None or args.refinement is not None:
+        print('--batch takes neither a rawfile nor --refinement')
+        exit(-1)
+    run_datagen_batch(args)
+    exit(0)
+elif args.from_db is not None:
+    if args.rawfile is not None:
+        print('--from-db takes no rawfile')
+        exit(-1)
+    check_file(args.from_db)
+elif args.rawfile is None:
+    print('a rawfile, --from-db or --batch is required')
+    exit(-1)
+else:
+    check_file(args.rawfile)
+
 rawfile = args.rawfile
 refinement = args.refinement
-
-check_file(rawfile)
 if refinement is not None:
     check_file(refinement)
     with open(refinement, 'r') as f:
@@ -197,19 +148,40 @@ if refinement is not None:
         g_true_exes = yaml.load(f, Loader=yaml.Loader)
         print(f'loading refinement: {refinement} done')
 
-with open(rawfile, 'r') as f:
-    print(f'loading {rawfile}')
-    data = yaml.load(f, Loader=yaml.Loader)
-    print(f'loading {rawfile} done')
-    g_package = data['package']
-    g_version = data['version']
-    fuzz, perf = analyze(data['data'])
-    
-    fuzz_path = f'{g_package}-{g_version}-fuzz'
-    perf_path = f'{g_package}-{g_version}-perf'
-    with open(fuzz_path, 'w') as f_fuzz:
-        yaml.dump(fuzz, f_fuzz)
-        print(f'{rawfile} fuzz dataset at {fuzz_path}')
-    with open(perf_path, 'w') as f_perf:
-        yaml.dump(perf, f_perf)
-        print(f'{rawfile} perf dataset at {perf_path}')
+check_file(args.rules)
+g_matcher = load_matcher(args.rules, g_true_exes)
+os.makedirs(args.output_dir, exist_ok=True)
+
+if args.from_db is not None:
+    store = TraceStore(args.from_db)
+    trace_id = args.trace if args.trace is not None else store.latest_trace()
+    if trace_id is None:
+        print(f'{args.from_db} has no traces')
+        exit(-1)
+    rawfile = f'{args.from_db}:{trace_id}'
+
+sinks = [FuzzSink(), PerfSink()]
+if args.stats:
+    sinks.append(StatsSink())
+# the fuzz dataset is written while the trace is read, to a temporary file
+# that only exists from here on
+pipeline = Pipeline(g_matcher, sinks, output_dir=args.output_dir,
+                    fmt=args.format, compress=args.compress, stream=True, index=args.index)
+
+print(f'loading {rawfile}')
+if args.from_db is not None:
+    try:
+        pipeline.run(store.open_trace(trace_id, with_envs=False), args.columnar)
+    except ValueError as e:
+        print(e)
+        exit(-1)
+else:
+    pipeline.run_file(rawfile, args.columnar)
+print(f'loading {rawfile} done, {pipeline.records} records, '
+      f'{g_matcher.resolve.cache_info().currsize} distinct paths')
+g_package = pipeline.header.get('package', '')
+g_version = pipeline.header.get('version', '')
+analyze_envs(pipeline.header)
+
+for name, path in pipeline.write(g_package, g_version).items():
+    print(f'{rawfile} {name} dataset at {path}')
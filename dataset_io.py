@@ -0,0 +1,318 @@
+#! /usr/bin/env python3
+
+import os
+import gzip
+import lzma
+import json
+import mmap
+import random
+import shutil
+import tempfile
+import yaml
+from yaml.events import StreamEndEvent, SequenceStartEvent, SequenceEndEvent
+from trace_io import TraceDumper, TraceLoader, compose_node
+
+
+DATASET_FORMATS = ['yaml', 'jsonl']
+COMPRESSIONS = { '.gz' : gzip.open, '.xz' : lzma.open }
+JSONL_EXT = '.jsonl'
+INDEX_EXT = '.idx'
+INDEX_VERSION = 2
+
+
+def dataset_ext(fmt: str = 'yaml', compress: str = None) -> str:
+    # YAML datasets keep their bare names, perf-wrapper and co. expect them
+    ext = JSONL_EXT if fmt == 'jsonl' else ''
+    if compress is not None:
+        ext += '.' + compress
+    return ext
+
+
+def is_compressed(path: str) -> bool:
+    return any(path.endswith(ext) for ext in COMPRESSIONS)
+
+
+def open_output(path: str, mode: str = 'wt'):
+    # compressed by the extension of `path`
+    for ext, opener in COMPRESSIONS.items():
+        if path.endswith(ext):
+            return opener(path, mode, encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+def index_path(dataset: str) -> str:
+    return dataset + INDEX_EXT
+
+
+def dataset_format(path: str) -> str:
+    for ext in COMPRESSIONS:
+        if path.endswith(ext):
+            path = path[:-len(ext)]
+    return 'jsonl' if path.endswith(JSONL_EXT) else 'yaml'
+
+
+def dataset_stem(path: str) -> str:
+    name = os.path.basename(path)
+    for ext in list(COMPRESSIONS) + [JSONL_EXT]:
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+    return name
+
+
+def dataset_name(path: str) -> tuple[str, str]:
+    # package and version of `{package}-{version}-{kind}[.jsonl][.gz|.xz]`
+    parts = dataset_stem(path).rsplit('-', 2)
+    if len(parts) < 3:
+        return '', ''
+    return parts[0], parts[1]
+
+
+def dataset_kind(path: str) -> str:
+    # fuzz, perf or stats
+    return dataset_stem(path).rpartition('-')[2]
+
+
+def read_dataset(path: str):
+    # the records of a dataset one at a time, any format and compression
+    with open_output(path, 'rt') as f:
+        if dataset_format(path) == 'jsonl':
+            for line in f:
+                if line.strip() != '':
+                    yield json.loads(line)
+            return
+
+        loader = TraceLoader(f)
+        try:
+            loader.get_event()
+            if loader.check_event(StreamEndEvent):
+                return
+            loader.get_event()
+            if not loader.check_event(SequenceStartEvent):
+                raise ValueError(f'{path} is not a dataset, its top-level node is not a list')
+            loader.get_event()
+            while not loader.check_event(SequenceEndEvent):
+                yield loader.construct_document(compose_node(loader, {}))
+        finally:
+            loader.dispose()
+
+
+def json_default(o):
+    # args that failed to decode, as str with the bad bytes escaped
+    # like the binary trace does
+    if isinstance(o, bytes):
+        return o.decode('utf-8', 'surrogateescape')
+    raise TypeError(f'{type(o).__name__} is not JSON serializable')
+
+
+class DatasetWriter:
+    # A dataset written one record at a time. For 'yaml' the file is the
+    # same document as yaml.dump() of the list of all records, for 'jsonl'
+    # each record is one line of JSON.
+    #
+    # With `index` the byte range of each record goes to the sidecar
+    # index by the key of the record, which must be a mapping with a single
+    # key like the {exe: [...]} of the fuzz dataset. The index is JSON
+    # Lines, a header then one [key, offset, length] per record. The entries
+    # are written as the records are, to `path` + INDEX_EXT, and moved
+    # behind the header by write_index().
+
+    def __init__(self, path: str, fmt: str = 'yaml', index: bool = False):
+        if fmt not in DATASET_FORMATS:
+            raise ValueError(f'unknown dataset format {fmt}')
+        if index and is_compressed(path):
+            raise ValueError(f'{path}: compressed datasets cannot be indexed')
+        self.path = path
+        self.fmt = fmt
+        self.count = 0
+        self.f = open_output(path)
+        self.index = open(index_path(path), 'w', encoding='utf-8') if index else None
+        self.offset = 0
+
+
+    def write(self, record):
+        self.write_many([record])
+
+
+    def write_many(self, records: list):
+        # one dump per call, so pass records in batches
+        if records == []:
+            return
+        if self.index is not None:
+            self.write_indexed(records)
+        elif self.fmt == 'yaml':
+            yaml.dump(records, self.f, Dumper=TraceDumper)
+        else:
+            self.f.writelines(json.dumps(r, default=json_default) + '\n' for r in records)
+        self.count += len(records)
+
+
+    def write_indexed(self, records: list):
+        # A dump per record, its length is that of the record. The dump of
+        # [r] is the item of r in the dump of the whole list, except that
+        # objects shared by several records are not made aliases.
+        texts = []
+        entries = []
+        for r in records:
+            if self.fmt == 'yaml':
+                text = yaml.dump([r], Dumper=TraceDumper)
+            else:
+                text = json.dumps(r, default=json_default) + '\n'
+            length = len(text.encode('utf-8'))
+            (key,) = r
+            texts.append(text)
+            entries.append(json.dumps([key, self.offset, length]) + '\n')
+            self.offset += length
+        self.f.writelines(texts)
+        self.index.writelines(entries)
+
+
+    def write_index(self, dataset: str):
+        # to the sidecar of `dataset`, where the closed file of this writer
+        # ended up
+        st = os.stat(dataset)
+        header = { 'version' : INDEX_VERSION,
+                   'format'  : self.fmt,
+                   'size'    : st.st_size,
+                   'mtime_ns': st.st_mtime_ns,
+                   'records' : self.count }
+        entries = index_path(self.path)
+        tmp = index_path(dataset) + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f, open(entries, 'r', encoding='utf-8') as e:
+            f.write(json.dumps(header) + '\n')
+            shutil.copyfileobj(e, f)
+        os.replace(tmp, index_path(dataset))
+        if entries != index_path(dataset):
+            os.unlink(entries)
+
+
+    def close(self):
+        if self.count == 0 and self.fmt == 'yaml':
+            self.f.write('[]\n')
+        self.f.close()
+        if self.index is not None:
+            self.index.close()
+
+
+    def discard(self):
+        self.f.close()
+        os.unlink(self.path)
+        if self.index is not None:
+            self.index.close()
+            os.unlink(index_path(self.path))
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def current_umask() -> int:
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+def temporary_writer(output_dir: str, fmt: str = 'yaml', compress: str = None,
+                     index: bool = False) -> DatasetWriter:
+    # a writer for a dataset whose name is only known at the end,
+    # rename its `path` once done
+    fd, path = tempfile.mkstemp(prefix='.datagen-', suffix=dataset_ext(fmt, compress),
+                                dir=output_dir)
+    # mkstemp() makes it 0600, the renamed dataset should be like any other
+    os.fchmod(fd, 0o666 & ~current_umask())
+    os.close(fd)
+    return DatasetWriter(path, fmt, index)
+
+
+def write_dataset(path: str, data, fmt: str = 'yaml'):
+    # a whole dataset at once, a list is written record by record
+    with DatasetWriter(path, fmt) as w:
+        if isinstance(data, list):
+            w.write_many(data)
+        elif fmt == 'yaml':
+            yaml.dump(data, w.f, Dumper=TraceDumper)
+            w.count += 1
+        else:
+            w.write_many([data])
+
+
+class DatasetReader:
+    # Random access to the records of an indexed, uncompressed dataset by
+    # their key, the exe for the fuzz dataset. The file is mapped and only
+    # the records asked for are parsed.
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(index_path(path), 'r', encoding='utf-8') as f:
+            try:
+                header = json.loads(f.readline())
+            except ValueError:
+                header = {}
+            if not isinstance(header, dict) or header.get('version') != INDEX_VERSION:
+                raise ValueError(f'{index_path(path)}: unsupported index version '
+                                 f'{header.get("version") if isinstance(header, dict) else None}')
+
+            st = os.stat(path)
+            if st.st_size != header['size'] or st.st_mtime_ns != header['mtime_ns']:
+                raise ValueError(f'{index_path(path)} is out of date with {path}')
+
+            # key -> [offset, length, offset, length, ...]
+            self.index = {}
+            for line in f:
+                key, offset, length = json.loads(line)
+                self.index.setdefault(key, []).extend((offset, length))
+
+        self.fmt = header['format']
+        self.count = header['records']
+        self.f = open(path, 'rb')
+        # mmap cannot map an empty file
+        self.data = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ) if st.st_size else b''
+
+
+    def keys(self) -> list[str]:
+        return list(self.index)
+
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.index
+
+
+    def count_of(self, key: str) -> int:
+        return len(self.index.get(key, [])) // 2
+
+
+    def parse(self, offset: int, length: int):
+        raw = self.data[offset:offset + length]
+        if self.fmt == 'yaml':
+            return yaml.load(raw, Loader=TraceLoader)[0]
+        return json.loads(raw)
+
+
+    def records(self, key: str) -> list:
+        ranges = self.index.get(key, [])
+        return [self.parse(ranges[i], ranges[i + 1]) for i in range(0, len(ranges), 2)]
+
+
+    def sample(self, key: str, n: int, seed=None) -> list:
+        # up to `n` records of `key`, in dataset order
+        ranges = self.index.get(key, [])
+        picked = sorted(random.Random(seed).sample(range(0, len(ranges), 2),
+                                                   min(n, len(ranges) // 2)))
+        return [self.parse(ranges[i], ranges[i + 1]) for i in picked]
+
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.f.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
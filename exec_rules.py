@@ -0,0 +1,150 @@
+#! /usr/bin/env python3
+
+import os
+import re
+import functools
+from typing import Iterable
+
+
+G_RULES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'exec-filter.rules')
+
+RULE_KINDS = ['prefix', 'suffix', 'infix']
+
+# limits of the rule maps in bcc-execve.c, longer rules stay in userspace
+PREFILTER_PREFIX_LEN   = 64
+PREFILTER_SUFFIX_LEN   = 32
+PREFILTER_MAX_SUFFIXES = 16
+
+
+class ExecRules:
+
+    def __init__(self):
+        self.prefixes: list[str] = []
+        self.suffixes: list[str] = []
+        self.infixes: list[str] = []
+
+
+    def add(self, kind: str, pattern: str):
+        if kind == 'prefix':
+            self.prefixes.append(pattern)
+        elif kind == 'suffix':
+            self.suffixes.append(pattern)
+        elif kind == 'infix':
+            self.infixes.append(pattern)
+        else:
+            raise ValueError(f'unknown rule kind {kind}')
+
+
+    def kernel_prefixes(self) -> list[bytes]:
+        # a relative prefix matches filenames whose absolute path it does not
+        return [p.encode('utf-8') for p in self.prefixes
+                if p.startswith('/') and len(p.encode('utf-8')) <= PREFILTER_PREFIX_LEN]
+
+
+    def kernel_suffixes(self) -> list[bytes]:
+        suffixes = [s.encode('utf-8') for s in self.suffixes
+                    if len(s.encode('utf-8')) <= PREFILTER_SUFFIX_LEN]
+        return suffixes[:PREFILTER_MAX_SUFFIXES]
+
+
+def load_rules(path: str = G_RULES_PATH) -> ExecRules:
+    rules = ExecRules()
+
+    with open(path, 'r') as f:
+        for n, line in enumerate(f, 1):
+            line = line.strip()
+            if line == '' or line.startswith('#'):
+                continue
+            parts = line.split(None, 1)
+            if len(parts) != 2 or parts[0] not in RULE_KINDS:
+                raise ValueError(f'{path}:{n}: bad rule: {line}')
+            rules.add(parts[0], parts[1])
+
+    return rules
+
+
+class ExecMatcher:
+    # ExecRules compiled for matching millions of paths. The prefixes and
+    # suffixes go to one str.startswith() and one str.endswith() call,
+    # which try all of them in C, the infixes are one regex. A set lookup
+    # per distinct rule length measured slower, slicing costs more than
+    # the comparisons. With an `allowlist`, e.g. the refinement of
+    # perf-wrapper, only the paths in it are kept at all.
+    #
+    # resolve() caches its results for the last `cache_size` distinct
+    # (working dir, path) pairs, a build runs the same few over and over.
+
+    def __init__(self, rules: ExecRules, allowlist: Iterable[str] = None,
+                 cache_size: int = 65536):
+        self.prefixes = tuple(rules.prefixes)
+        self.suffixes = tuple(rules.suffixes)
+        self.infix = None
+        if rules.infixes != []:
+            self.infix = re.compile('|'.join(re.escape(p) for p in rules.infixes)).search
+        self.allowlist = None
+        if allowlist:
+            self.allowlist = frozenset(allowlist)
+        self.resolve = functools.lru_cache(maxsize=cache_size)(self.resolve_path)
+
+
+    def filtered(self, exe: str) -> bool:
+        if exe.startswith(self.prefixes) or exe.endswith(self.suffixes):
+            return True
+        return self.infix is not None and self.infix(exe) is not None
+
+
+    def keep(self, exe: str) -> bool:
+        if self.allowlist is not None and exe not in self.allowlist:
+            return False
+        return not self.filtered(exe)
+
+
+    def resolve_path(self, working_dir: str, file_path: str):
+        # Absolute, normalized path of an exec's callee and whether to keep it.
+        # The rules see both spellings, some of them match `./configure`
+        # or `/.`, which normalization removes, while `../` can lead into
+        # a filtered prefix.
+        exe = file_path
+        if not exe.startswith('/'):
+            exe = working_dir + '/' + exe
+        path = '/' + os.path.normpath(exe).lstrip('/')
+
+        if self.allowlist is not None and exe not in self.allowlist and path not in self.allowlist:
+            return path, False
+        if self.filtered(exe):
+            return path, False
+        return path, path == exe or not self.filtered(path)
+
+
+def load_matcher(path: str = G_RULES_PATH, allowlist: Iterable[str] = None,
+                 cache_size: int = 65536) -> ExecMatcher:
+    return ExecMatcher(load_rules(path), allowlist, cache_size)
+
+
+def filtered(rules: ExecRules, exe: str) -> bool:
+    # Whether the absolute path `exe` is left out of the datasets.
+    # Plain loops, the reference for ExecMatcher.
+    for p in rules.prefixes:
+        if exe.startswith(p):
+            return True
+    for p in rules.suffixes:
+        if exe.endswith(p):
+            return True
+    for p in rules.infixes:
+        if p in exe:
+            return True
+    return False
+
+
+def prefiltered(rules: ExecRules, filename: bytes) -> bool:
+    # Reference for the PREFILTER check in bcc-execve.c, on the filename
+    # as passed to execve(). A match implies filtered() on the absolute
+    # path: prefixes only match absolute filenames, and the absolute path
+    # ends with whatever the filename ends with. bench-rules.py checks that.
+    for p in rules.kernel_prefixes():
+        if filename.startswith(p):
+            return True
+    for s in rules.kernel_suffixes():
+        if filename.endswith(s):
+            return True
+    return False
@@ -0,0 +1,199 @@
+#! /usr/bin/env python3
+
+####################################################
+#
+#
+# fuzz record client, hands an invocation to fuzz-collector
+#
+# Author: Mao Yifu, maoif@ios.ac.cn
+#
+#
+####################################################
+
+# Runs on every invocation of a wrapped binary, so it only imports what
+# starting Python imports anyway. json and socket pull in re and enum,
+# which take longer than all the rest, the C modules under them do not.
+# Takes the arguments of perf-fuzz-gen.py. The files among the args are
+# copied right away, the wrapped binary or the test may remove or change
+# them once this returns. The invocation goes to the collector socket, or
+# to the spool directory if no collector is running, in which case one is
+# started that exits again once the invocations stop coming.
+
+import os
+import sys
+import time
+import fcntl
+import _socket
+from _json import encode_basestring_ascii as json_str
+
+
+g_script_name = 'fuzz-client'
+g_perf_dir_env: str = 'TREC_PERF_DIR'
+g_socket_env: str = 'TREC_FUZZ_SOCKET'
+g_hardlink_env: str = 'TREC_FUZZ_HARDLINK'
+g_autostart_env: str = 'TREC_FUZZ_AUTOSTART'
+# seconds a collector started here waits for more invocations
+g_idle_exit = 300
+# fuzz_files.FICLONE
+FICLONE = 0x40049409
+
+
+def notice(msg: str = ''):
+    print(f'[{g_script_name}] {msg}')
+
+
+def probe_args(args: list[str]):
+    # same as fuzz_record.probe_args(), without the exe
+    files = []
+    dirs = []
+    for i, a in enumerate(args[1:], 1):
+        if os.path.isfile(a):
+            files.append(i)
+        elif os.path.isdir(a):
+            dirs.append(i)
+    return files, dirs
+
+
+def json_list(l: list) -> str:
+    # of strings, ints, None and lists of ints
+    return '[' + ', '.join(json_str(s) if type(s) is str else 'null' if s is None else str(s)
+                           for s in l) + ']'
+
+
+def stat_key(st: os.stat_result) -> list[int]:
+    # fuzz_files.stat_key()
+    return [st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns]
+
+
+def copy_file(src: str, dst: str, hardlink: bool) -> list[int]:
+    # a hard link if asked for, else a reflink or a copy in the kernel.
+    # Returns the stat_key() of `src` as it was copied.
+    if hardlink:
+        try:
+            os.link(src, dst)
+            return stat_key(os.stat(dst))
+        except OSError:
+            pass
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        st = os.fstat(s.fileno())
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            return stat_key(st)
+        except OSError:
+            pass
+        pos = 0
+        while pos < st.st_size:
+            n = os.sendfile(d.fileno(), s.fileno(), pos, st.st_size - pos)
+            if n == 0:
+                break
+            pos += n
+    return stat_key(st)
+
+
+def snapshot(path: str, args: list[str], files: list[int]) -> tuple[list, list]:
+    # the copies of the file args at `path` and the stat_key() of each
+    # file, None where copying failed. The collector looks the stat up in
+    # its stat cache and only hashes the copy of a file it does not know.
+    hardlink = os.environ.get(g_hardlink_env, '') not in ['', '0']
+    snapshots = []
+    stats = []
+    for n, i in enumerate(files):
+        dst = os.path.join(path, f'{time.time_ns()}-{os.getpid()}-{n}')
+        try:
+            if n == 0:
+                os.makedirs(path, exist_ok=True)
+            stats.append(copy_file(args[i], dst, hardlink))
+            snapshots.append(dst)
+        except OSError as e:
+            notice(f'failed to copy {args[i]}: {e}')
+            try:
+                os.unlink(dst)
+            except OSError:
+                pass
+            snapshots.append(None)
+            stats.append(None)
+    return snapshots, stats
+
+
+def send(path: str, line: bytes) -> bool:
+    s = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+        s.sendall(line)
+        return True
+    except OSError:
+        return False
+    finally:
+        s.close()
+
+
+def start_collector(socket_path: str, fuzz_path: str):
+    # Unless one holds the lock of collectors, so is running already. The
+    # lock is taken here and handed down as fd 3, no other client starts
+    # one in the meantime.
+    try:
+        fd = os.open(socket_path + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+    except OSError:
+        return
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        # dup2() onto itself would keep close-on-exec
+        os.set_inheritable(fd, True)
+        collector = os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), 'fuzz-collector.py')
+        log = os.path.join(fuzz_path, 'collector.log')
+        os.posix_spawn(sys.executable,
+                       [sys.executable, collector, '--socket', socket_path,
+                        '--idle-exit', str(g_idle_exit), '--lock-fd', '3'],
+                       os.environ,
+                       file_actions=[(os.POSIX_SPAWN_OPEN, 0, os.devnull, os.O_RDONLY, 0),
+                                     (os.POSIX_SPAWN_OPEN, 1, log, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644),
+                                     (os.POSIX_SPAWN_DUP2, 1, 2),
+                                     (os.POSIX_SPAWN_DUP2, fd, 3)],
+                       setsid=True)
+    except BlockingIOError:
+        pass
+    except OSError as e:
+        notice(f'failed to start a fuzz-collector: {e}')
+    finally:
+        os.close(fd)
+
+
+def spool(path: str, line: bytes):
+    os.makedirs(path, exist_ok=True)
+    name = f'{time.time_ns()}-{os.getpid()}.json'
+    tmp = os.path.join(path, '.' + name)
+    with open(tmp, 'wb') as f:
+        f.write(line)
+    os.replace(tmp, os.path.join(path, name))
+
+
+###
+### start of program
+###
+
+args = sys.argv
+
+if len(args) < 4:
+    print(f'Args length less than 4, need at least package name, version and exe path')
+    exit(-1)
+
+if g_perf_dir_env not in os.environ:
+    notice(f'env {g_perf_dir_env} not set')
+    exit(-1)
+
+g_fuzz_path = os.path.join(os.environ[g_perf_dir_env], 'fuzz')
+all_args = args[3:]
+files, dirs = probe_args(all_args)
+snapshots, stats = snapshot(os.path.join(g_fuzz_path, 'snapshots'), all_args, files)
+# the invocation of fuzz_record.invocation() as JSON, with the snapshots
+line = (f'{{"package": {json_str(args[1])}, "version": {json_str(args[2])}, '
+        f'"exe": {json_str(all_args[0])}, "args": {json_list(all_args)}, '
+        f'"cwd": {json_str(os.getcwd())}, "files": {json_list(files)}, '
+        f'"dirs": {json_list(dirs)}, "snapshots": {json_list(snapshots)}, '
+        f'"stats": {json_list(stats)}}}\n').encode('utf-8')
+
+socket_path = os.environ.get(g_socket_env, os.path.join(g_fuzz_path, 'collector.sock'))
+if not send(socket_path, line):
+    spool(os.path.join(g_fuzz_path, 'spool'), line)
+    if os.environ.get(g_autostart_env, 'ON') != 'OFF':
+        start_collector(socket_path, g_fuzz_path)
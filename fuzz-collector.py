@@ -0,0 +1,192 @@
+#! /usr/bin/env python3
+
+####################################################
+#
+#
+# fuzz record collector daemon for fuzz-client
+#
+# Author: Mao Yifu, maoif@ios.ac.cn
+#
+#
+####################################################
+
+import os
+import json
+import time
+import fcntl
+import queue
+import signal
+import socket
+import argparse
+import threading
+import socketserver
+from fuzz_record import *
+from fuzz_corpus import *
+
+
+g_script_name = 'fuzz-collector'
+g_perf_dir_env: str = 'TREC_PERF_DIR'
+g_queue = queue.Queue()
+g_stop = threading.Event()
+
+
+def notice(msg: str = ''):
+    print(f'[{g_script_name}] {msg}', flush=True)
+
+
+class InvocationHandler(socketserver.StreamRequestHandler):
+    # one JSON invocation per line, a client may send several
+
+    def handle(self):
+        for line in self.rfile:
+            if line.strip() != b'':
+                g_queue.put(line)
+
+
+class CollectorServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def collector_running(path: str) -> bool:
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+        return True
+    except OSError:
+        return False
+    finally:
+        s.close()
+
+
+def collect(recorder: FuzzRecorder, corpus: CorpusWriter, spool: str,
+            batch_size: int, interval: float, idle_exit: float = 0):
+    # Records go out in batches of up to `batch_size`, or after at most
+    # `interval` seconds. The spool is checked every `interval` too, for
+    # clients that ran while the collector was being started. With
+    # `idle_exit` it stops after that many seconds without invocations.
+    records = 0
+    last_drain = time.monotonic()
+    last_active = time.monotonic()
+    while not (g_stop.is_set() and g_queue.empty()):
+        batch = []
+        deadline = time.monotonic() + interval
+        while len(batch) < batch_size:
+            try:
+                batch.append(g_queue.get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                break
+
+        invocations = []
+        for line in batch:
+            try:
+                invocations.append(json.loads(line))
+            except ValueError:
+                notice(f'dropping invalid line {line[:80]!r}')
+        out = record_all(recorder, invocations)
+        corpus.write_many(out)
+        records += len(out)
+        if batch != []:
+            last_active = time.monotonic()
+        elif idle_exit > 0 and time.monotonic() - last_active >= idle_exit:
+            notice(f'no invocations for {idle_exit:g} s, stopping')
+            g_stop.set()
+
+        if time.monotonic() - last_drain >= interval:
+            records += drain_spool(recorder, corpus, spool)
+            last_drain = time.monotonic()
+    return records
+
+
+def stop(signum, frame):
+    g_stop.set()
+
+
+def lock_collector(socket_path: str) -> int:
+    # the fd of the lock of collectors on `socket_path`, None if another one has it
+    fd = os.open(socket_path + COLLECTOR_LOCK_EXT, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+
+###
+### start of program
+###
+
+parser = argparse.ArgumentParser(
+    prog=g_script_name,
+    description='Collect fuzz records of fuzz-client into the fuzz corpus.')
+parser.add_argument('--socket', help='Unix socket to listen on, $TREC_PERF_DIR/fuzz/collector.sock by default')
+parser.add_argument('--segment-size', default='64M', help='size at which segments of the corpus are sealed')
+parser.add_argument('--batch', type=int, default=512, help='records written at once')
+parser.add_argument('--interval', type=float, default=1.0,
+                    help='seconds until buffered records are written and the spool is checked')
+parser.add_argument('--files-budget',
+                    help='size limit of the stored file args like 10G, $TREC_FUZZ_FILES_BUDGET by default')
+parser.add_argument('--drain', action='store_true', help='move the spool into the corpus and exit')
+parser.add_argument('--idle-exit', type=float, default=0,
+                    help='stop after this many seconds without invocations, as when started by fuzz-client')
+parser.add_argument('--lock-fd', type=int, help=argparse.SUPPRESS)
+
+args = parser.parse_args()
+
+if g_perf_dir_env not in os.environ:
+    notice(f'env {g_perf_dir_env} not set, quitting...')
+    exit(-1)
+
+g_perf_data_path = os.environ[g_perf_dir_env]
+g_files_path = fuzz_subdir(g_perf_data_path, 'files')
+g_spool_path = fuzz_subdir(g_perf_data_path, SPOOL_DIR)
+g_socket_path = args.socket or fuzz_subdir(g_perf_data_path, COLLECTOR_SOCKET)
+
+try:
+    os.makedirs(g_files_path, exist_ok=True)
+except OSError:
+    notice(f'failed to create {g_files_path}')
+
+store = file_store_from_env(g_files_path)
+if args.files_budget is not None:
+    store.budget = parse_size(args.files_budget)
+recorder = FuzzRecorder(g_files_path, notice=notice, store=store)
+corpus = CorpusWriter(fuzz_subdir(g_perf_data_path), parse_size(args.segment_size))
+
+if args.drain:
+    n = drain_spool(recorder, corpus, g_spool_path)
+    corpus.close()
+    notice(f'{n} spooled invocations written to {corpus.path}')
+    exit(0)
+
+# held until the process exits, after the socket is gone and the spool drained
+# fuzz-client hands down the lock it took to start this one
+g_lock = args.lock_fd if args.lock_fd is not None else lock_collector(g_socket_path)
+if g_lock is None or collector_running(g_socket_path):
+    notice(f'a collector is already listening on {g_socket_path}')
+    exit(-1)
+if os.path.exists(g_socket_path):
+    os.unlink(g_socket_path)
+
+server = CollectorServer(g_socket_path, InvocationHandler)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+signal.signal(signal.SIGTERM, stop)
+signal.signal(signal.SIGINT, stop)
+notice(f'listening on {g_socket_path}, corpus in {corpus.path}')
+
+n = 0
+try:
+    # clients that fell back to the spool before the socket existed
+    n += drain_spool(recorder, corpus, g_spool_path)
+    n += collect(recorder, corpus, g_spool_path, args.batch, args.interval, args.idle_exit)
+finally:
+    server.shutdown()
+    server.server_close()
+    os.unlink(g_socket_path)
+    # what came in while shutting down, and clients that found no socket
+    while not g_queue.empty():
+        n += collect(recorder, corpus, g_spool_path, args.batch, 0)
+    n += drain_spool(recorder, corpus, g_spool_path)
+    corpus.close()
+
+notice(f'{n} records written to {corpus.path}')
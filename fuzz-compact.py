@@ -0,0 +1,166 @@
+#! /usr/bin/env python3
+
+####################################################
+#
+#
+# compact the fuzz corpus and convert old fuzz record files into it
+#
+# Author: Mao Yifu, maoif@ios.ac.cn
+#
+#
+####################################################
+
+import os
+import fcntl
+import argparse
+import yaml
+from trace_io import TraceLoader
+from fuzz_files import parse_size
+from fuzz_record import *
+from fuzz_corpus import *
+
+
+g_script_name = 'fuzz-compact'
+g_perf_dir_env: str = 'TREC_PERF_DIR'
+# old files handled at once, each is a record
+g_convert_chunk = 10000
+
+
+def notice(msg: str = ''):
+    print(f'[{g_script_name}] {msg}')
+
+
+def old_record_files(fuzz_dir: str) -> list[str]:
+    # fuzz-{time.time()} of perf-fuzz-gen, one YAML record each
+    return sorted(os.path.join(fuzz_dir, n) for n in os.listdir(fuzz_dir)
+                  if n.startswith('fuzz-') and os.path.isfile(os.path.join(fuzz_dir, n)))
+
+
+def read_old(path: str) -> list[dict]:
+    with open(path, 'rb') as f:
+        record = yaml.load(f, Loader=TraceLoader)
+    return [] if record is None else [record]
+
+
+def convert(fuzz_dir: str, max_bytes: int) -> tuple[int, int]:
+    # Appends the old records to the corpus and removes their files, a
+    # chunk at a time. Returns the number of files and records.
+    files = old_record_files(fuzz_dir)
+    corpus = CorpusWriter(fuzz_dir, max_bytes)
+    n = 0
+    try:
+        for start in range(0, len(files), g_convert_chunk):
+            chunk = files[start:start + g_convert_chunk]
+            records = []
+            done = []
+            for path in chunk:
+                try:
+                    records += read_old(path)
+                    done.append(path)
+                except (OSError, ValueError, yaml.YAMLError) as e:
+                    notice(f'skipping {path}: {e}')
+            corpus.write_many(records)
+            for path in done:
+                os.unlink(path)
+            n += len(done)
+    finally:
+        corpus.close()
+    return n, corpus.count
+
+
+def drain(fuzz_dir: str, max_bytes: int) -> int:
+    # The invocations fuzz-client spooled when no collector was running. A
+    # running collector drains them itself, and holds the lock meanwhile.
+    fd = os.open(os.path.join(fuzz_dir, COLLECTOR_SOCKET + COLLECTOR_LOCK_EXT), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            notice('a fuzz-collector is running, leaving the spool to it')
+            return 0
+        recorder = FuzzRecorder(os.path.join(fuzz_dir, 'files'), notice=notice)
+        corpus = CorpusWriter(fuzz_dir, max_bytes)
+        try:
+            return drain_spool(recorder, corpus, os.path.join(fuzz_dir, SPOOL_DIR))
+        finally:
+            corpus.close()
+    finally:
+        os.close(fd)
+
+
+def compact(path: str, target: int) -> tuple[int, int]:
+    # Merges runs of consecutive sealed segments of one package into
+    # segments of up to `target` bytes. The merged segment takes the name of
+    # the first one, which keeps the order of the names. Returns the number
+    # of segments before and after.
+    segments = sealed_segments(path)
+    groups = []
+    size = 0
+    for seg in segments:
+        s = os.path.getsize(seg)
+        if groups == [] or size + s > target:
+            groups.append([])
+            size = 0
+        groups[-1].append(seg)
+        size += s
+
+    for group in groups:
+        if len(group) < 2:
+            continue
+        tmp = os.path.join(path, '.compact-' + os.path.basename(group[0]))
+        with open(tmp, 'wb') as out:
+            for seg in group:
+                with open(seg, 'rb') as f:
+                    data = f.read()
+                if data and not data.endswith(b'\n'):
+                    data += b'\n'
+                out.write(data)
+            out.flush()
+            os.fsync(out.fileno())
+        # a crash between here and the last unlink leaves records twice,
+        # never loses them
+        os.replace(tmp, group[0])
+        for seg in group[1:]:
+            os.unlink(seg)
+    return len(segments), len(groups)
+
+
+###
+### start of program
+###
+
+parser = argparse.ArgumentParser(
+    prog=g_script_name,
+    description='Merge the sealed segments of the fuzz corpus, and move the old fuzz-* record files and the spool of fuzz-client into it.')
+parser.add_argument('--target-size', default='256M', help='size of the merged segments')
+parser.add_argument('--segment-size', default='64M', help='size at which converted records are sealed')
+parser.add_argument('--seal', action='store_true',
+                    help='also seal and merge the active segments no writer holds')
+parser.add_argument('--no-convert', action='store_true', help='leave old fuzz-* files and the spool alone')
+
+args = parser.parse_args()
+
+if g_perf_dir_env not in os.environ:
+    notice(f'env {g_perf_dir_env} not set, quitting...')
+    exit(-1)
+
+g_fuzz_path = os.path.join(os.environ[g_perf_dir_env], 'fuzz')
+if not os.path.isdir(g_fuzz_path):
+    notice(f'{g_fuzz_path} is not a dir, quitting...')
+    exit(-1)
+
+if not args.no_convert:
+    files, records = convert(g_fuzz_path, parse_size(args.segment_size))
+    notice(f'converted {files} old files, {records} records')
+    notice(f'{drain(g_fuzz_path, parse_size(args.segment_size))} spooled invocations written')
+
+corpus_root = os.path.join(g_fuzz_path, CORPUS_DIR)
+packages = sorted(os.listdir(corpus_root)) if os.path.isdir(corpus_root) else []
+for p in packages:
+    path = os.path.join(corpus_root, p)
+    if args.seal:
+        a = SegmentAppender(path)
+        a.seal()
+        a.close()
+    before, after = compact(path, parse_size(args.target_size))
+    notice(f'{p}: {before} segments, {after} after compaction')
@@ -0,0 +1,157 @@
+#! /usr/bin/env python3
+
+####################################################
+#
+#
+# minimize fuzz datasets by the shape of the arguments
+#
+# Author: Mao Yifu, maoif@ios.ac.cn
+#
+#
+####################################################
+
+import os
+import time
+import hashlib
+import argparse
+from dataset_io import *
+from fuzz_corpus import *
+
+
+g_script_name = 'fuzz-minimize'
+
+
+def notice(msg: str = ''):
+    print(f'[{g_script_name}] {msg}')
+
+
+def arg_str(a) -> str:
+    # args that failed to decode are bytes, the slot dicts need str keys
+    if isinstance(a, bytes):
+        return a.decode('utf-8', 'surrogateescape')
+    return str(a)
+
+
+def signature(exe: str, kinds: list[str]) -> bytes:
+    # of a shape in the output, groups are found by (exe, kinds)
+    h = hashlib.blake2b(digest_size=16)
+    h.update('\0'.join([exe] + kinds).encode('utf-8', 'surrogateescape'))
+    return h.digest()
+
+
+class ShapeGroup:
+    # the invocations of one exe with the same kinds of args, i.e.
+    # op_flag op_num op_file, in that order
+    __slots__ = ('exe', 'kinds', 'count', 'representatives', 'seen', 'values', 'other')
+
+    def __init__(self, exe: str, kinds: list[str]):
+        self.exe = exe
+        self.kinds = kinds
+        self.count = 0
+        self.representatives = []
+        # the args of the representatives, to keep distinct ones
+        self.seen = set()
+        # per slot, value -> count and the count of values beyond the limit
+        self.values = [{} for _ in kinds]
+        self.other = [0] * len(kinds)
+
+
+    def add(self, raw_args: list, args: list[str], max_representatives: int, max_values: int):
+        self.count += 1
+        if len(self.representatives) < max_representatives:
+            key = tuple(args)
+            if key not in self.seen:
+                self.seen.add(key)
+                self.representatives.append(raw_args)
+        for i, a in enumerate(args):
+            values = self.values[i]
+            if a in values:
+                values[a] += 1
+            elif len(values) < max_values:
+                values[a] = 1
+            else:
+                self.other[i] += 1
+
+
+    def to_record(self) -> dict:
+        return { 'exe'             : self.exe,
+                 'signature'       : signature(self.exe, self.kinds).hex(),
+                 'shape'           : self.kinds,
+                 'count'           : self.count,
+                 'representatives' : self.representatives,
+                 'slots'           : [{ 'kind' : k, 'values' : v, 'other' : o }
+                                      for k, v, o in zip(self.kinds, self.values, self.other)] }
+
+
+class Minimizer:
+    # Records are folded into their ShapeGroup as they are read, so memory
+    # grows with the number of distinct shapes and the limits, never with
+    # the number of records.
+
+    def __init__(self, max_representatives: int = 4, max_values: int = 64):
+        self.max_representatives = max_representatives
+        self.max_values = max_values
+        # (exe, kinds) -> ShapeGroup
+        self.groups = {}
+        self.records = 0
+        self.skipped = 0
+
+
+    def add(self, record: dict):
+        try:
+            exe, raw_args, classified = fuzz_entry(record)
+        except (KeyError, TypeError, ValueError, AttributeError):
+            self.skipped += 1
+            return
+        kinds = tuple(k for k, _ in classified)
+        group = self.groups.get((exe, kinds))
+        if group is None:
+            group = self.groups[(exe, kinds)] = ShapeGroup(exe, list(kinds))
+        group.add(raw_args, [a if type(a) is str else arg_str(a) for _, a in classified],
+                  self.max_representatives, self.max_values)
+        self.records += 1
+
+
+    def results(self) -> list[dict]:
+        # by exe, the most frequent shapes first
+        ordered = sorted(self.groups.values(), key=lambda g: (g.exe, -g.count))
+        return [group.to_record() for group in ordered]
+
+
+###
+### start of program
+###
+
+parser = argparse.ArgumentParser(
+    prog=g_script_name,
+    description='Group fuzz records by executable and argument shape, keep representatives, counts and values per slot.')
+parser.add_argument('inputs', nargs='+', help='fuzz datasets of datagen, or fuzz corpus directories')
+parser.add_argument('-o', '--output', required=True,
+                    help='minimized dataset, compressed if it ends with .gz or .xz')
+parser.add_argument('--format', choices=DATASET_FORMATS, help='by default jsonl if the output name has .jsonl, else yaml')
+parser.add_argument('-r', '--representatives', type=int, default=4, help='distinct invocations kept per shape')
+parser.add_argument('--max-values', type=int, default=64, help='distinct values counted per slot, the rest go to `other`')
+
+args = parser.parse_args()
+
+for path in args.inputs:
+    if not os.path.exists(path):
+        notice(f'{path} not found')
+        exit(-1)
+
+minimizer = Minimizer(args.representatives, args.max_values)
+start = time.monotonic()
+for path in args.inputs:
+    notice(f'reading {path}')
+    for record in read_fuzz_records(path):
+        minimizer.add(record)
+
+results = minimizer.results()
+write_dataset(args.output, results, args.format or dataset_format(args.output))
+elapsed = max(time.monotonic() - start, 1e-9)
+notice(f'{minimizer.records} records, {len(results)} shapes of '
+       f'{len({r["exe"] for r in results})} executables in {elapsed:.1f} s, '
+       f'{minimizer.records / elapsed:,.0f} records/s')
+if minimizer.skipped > 0:
+    notice(f'{minimizer.skipped} records skipped, not fuzz records')
+notice(f'minimized dataset at {args.output}')
@@ -0,0 +1,205 @@
+#! /usr/bin/env python3
+
+import os
+import json
+import time
+import fcntl
+from dataset_io import JSONL_EXT, json_default, read_dataset
+
+
+# $TREC_PERF_DIR/fuzz/corpus/{package}-{version}/ holds the fuzz records of a
+# package as JSON Lines: the active-{pid}-{time_ns}.jsonl that writers append
+# to, one for each process writing at the same time, and the sealed
+# seg-{time_ns}-{pid}.jsonl that they become once big enough. Sealed
+# segments never change, except that fuzz-compact merges them.
+CORPUS_DIR = 'corpus'
+ACTIVE_PREFIX = 'active-'
+SEALED_PREFIX = 'seg-'
+SEGMENT_SIZE = 64 << 20
+
+
+def corpus_path(fuzz_dir: str, package: str, version: str) -> str:
+    return os.path.join(fuzz_dir, CORPUS_DIR, f'{package}-{version}')
+
+
+def active_name() -> str:
+    return f'{ACTIVE_PREFIX}{os.getpid()}-{time.time_ns()}{JSONL_EXT}'
+
+
+def sealed_name() -> str:
+    return f'{SEALED_PREFIX}{time.time_ns()}-{os.getpid()}{JSONL_EXT}'
+
+
+def segments(path: str, prefix: str) -> list[str]:
+    # oldest first for sealed ones
+    try:
+        names = os.listdir(path)
+    except FileNotFoundError:
+        return []
+    return [os.path.join(path, n) for n in sorted(names)
+            if n.startswith(prefix) and n.endswith(JSONL_EXT)]
+
+
+def sealed_segments(path: str) -> list[str]:
+    return segments(path, SEALED_PREFIX)
+
+
+def active_segments(path: str) -> list[str]:
+    return segments(path, ACTIVE_PREFIX)
+
+
+def write_all(fd: int, data: bytes):
+    while data:
+        n = os.write(fd, data)
+        data = data[n:]
+
+
+class SegmentAppender:
+    # Appends to an active segment of one package that no other process
+    # writes to. It holds an flock on it from the first append until
+    # close(), writers in other processes meanwhile take another one. An
+    # active segment that nobody holds is taken over by the next writer
+    # instead of creating one, so short-lived writers like perf-fuzz-gen do
+    # not leave a file each. It is sealed by a rename once it has
+    # `max_bytes`, and the next append takes another.
+
+    def __init__(self, path: str, max_bytes: int = SEGMENT_SIZE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.active = None
+        self.fd = None
+        os.makedirs(path, exist_ok=True)
+
+
+    def take(self, active: str, flags: int = 0) -> bool:
+        # `active` if no other writer holds it and it was not sealed meanwhile
+        try:
+            fd = os.open(active, os.O_WRONLY | os.O_APPEND | flags, 0o644)
+        except (FileNotFoundError, FileExistsError):
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            if os.stat(active).st_ino == os.fstat(fd).st_ino:
+                self.active = active
+                self.fd = fd
+                return True
+        except (BlockingIOError, FileNotFoundError):
+            pass
+        os.close(fd)
+        return False
+
+
+    def open(self):
+        for active in active_segments(self.path):
+            if self.take(active):
+                return
+        while not self.take(os.path.join(self.path, active_name()), os.O_CREAT | os.O_EXCL):
+            pass
+
+
+    def append(self, data: bytes):
+        if self.fd is None:
+            self.open()
+        write_all(self.fd, data)
+        if os.fstat(self.fd).st_size >= self.max_bytes:
+            self.seal_held()
+
+
+    def seal_held(self):
+        os.rename(self.active, os.path.join(self.path, sealed_name()))
+        self.close()
+
+
+    def seal(self) -> int:
+        # Seals the active segments no writer holds whatever their size,
+        # and removes empty ones. Returns the number sealed.
+        self.close()
+        n = 0
+        for active in active_segments(self.path):
+            if not self.take(active):
+                continue
+            if os.fstat(self.fd).st_size == 0:
+                os.unlink(self.active)
+                self.close()
+            else:
+                self.seal_held()
+                n += 1
+        return n
+
+
+    def close(self):
+        # the active segment stays, for the next writer
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+            self.active = None
+
+
+class CorpusWriter:
+    # fuzz records of any package to their corpus under `fuzz_dir`
+
+    def __init__(self, fuzz_dir: str, max_bytes: int = SEGMENT_SIZE):
+        self.fuzz_dir = fuzz_dir
+        self.path = os.path.join(fuzz_dir, CORPUS_DIR)
+        self.max_bytes = max_bytes
+        self.appenders = {}
+        self.count = 0
+
+
+    def appender(self, package: str, version: str) -> SegmentAppender:
+        key = (package, version)
+        if key not in self.appenders:
+            self.appenders[key] = SegmentAppender(corpus_path(self.fuzz_dir, package, version),
+                                                  self.max_bytes)
+        return self.appenders[key]
+
+
+    def write_many(self, records: list[dict]):
+        # one append per package
+        lines = {}
+        for r in records:
+            lines.setdefault((str(r['package']), str(r['version'])), []).append(
+                json.dumps(r, default=json_default) + '\n')
+        for (package, version), l in lines.items():
+            self.appender(package, version).append(''.join(l).encode('utf-8'))
+        self.count += len(records)
+
+
+    def write(self, record: dict):
+        self.write_many([record])
+
+
+    def close(self):
+        for a in self.appenders.values():
+            a.close()
+        self.appenders = {}
+
+
+def corpus_files(path: str) -> list[str]:
+    # the segments of a corpus, of one package or all of them, oldest first
+    files = []
+    for root, dirs, names in os.walk(path):
+        dirs.sort()
+        for prefix in [SEALED_PREFIX, ACTIVE_PREFIX]:
+            files += [os.path.join(root, n) for n in sorted(names)
+                      if n.startswith(prefix) and n.endswith(JSONL_EXT)]
+    return files
+
+
+def read_fuzz_records(path: str):
+    # the records of a fuzz dataset of datagen or of a corpus directory
+    if not os.path.isdir(path):
+        yield from read_dataset(path)
+        return
+    for f in corpus_files(path):
+        yield from read_dataset(f)
+
+
+def fuzz_entry(record: dict) -> tuple:
+    # (exe, raw_args, [(kind, arg), ...]) of a record of either format:
+    # {exe: [incomplete_args, incomplete_envs, {raw_args, classified_args}]}
+    # of datagen, or the flat records of perf-fuzz-gen in the corpus
+    if 'raw_args' in record:
+        return record['exe'], record['raw_args'], [tuple(c) for c in record['classified_args']]
+    ((exe, (_, _, detail)),) = record.items()
+    return exe, detail['raw_args'], [next(iter(c.items())) for c in detail['classified_args']]
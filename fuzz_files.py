@@ -0,0 +1,242 @@
+#! /usr/bin/env python3
+
+import os
+import stat
+import time
+import fcntl
+import shutil
+import sqlite3
+import hashlib
+import tempfile
+
+
+# ioctl of Linux that makes `dst` share the extents of `src`, on btrfs, XFS and co.
+FICLONE = 0x40049409
+HASH_CHUNK = 1 << 20
+BLOB_INDEX = 'index.db'
+
+G_BUDGET_ENV = 'TREC_FUZZ_FILES_BUDGET'
+G_HARDLINK_ENV = 'TREC_FUZZ_HARDLINK'
+
+# `blobs` is what is stored, `stat_cache` the hash of files already seen,
+# valid as long as their size and mtime did not change
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS blobs (
+    hash      TEXT PRIMARY KEY,
+    size      INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS blobs_last_used ON blobs(last_used);
+CREATE TABLE IF NOT EXISTS stat_cache (
+    dev       INTEGER NOT NULL,
+    ino       INTEGER NOT NULL,
+    size      INTEGER NOT NULL,
+    mtime_ns  INTEGER NOT NULL,
+    hash      TEXT NOT NULL,
+    PRIMARY KEY (dev, ino)
+) WITHOUT ROWID;
+'''
+
+
+def parse_size(s: str) -> int:
+    # 4096, 512K, 10G
+    units = { 'K' : 1 << 10, 'M' : 1 << 20, 'G' : 1 << 30, 'T' : 1 << 40 }
+    s = s.strip().upper().removesuffix('B')
+    if s != '' and s[-1] in units:
+        return int(float(s[:-1]) * units[s[-1]])
+    return int(s)
+
+
+def hash_file(f) -> str:
+    h = hashlib.sha256()
+    while True:
+        chunk = f.read(HASH_CHUNK)
+        if not chunk:
+            return h.hexdigest()
+        h.update(chunk)
+
+
+def stat_key(st: os.stat_result) -> tuple[int, int, int, int]:
+    # what the stat cache knows a file by
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def reflink(src: str, dst: str) -> bool:
+    try:
+        with open(src, 'rb') as s, open(dst, 'wb') as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        return True
+    except OSError:
+        return False
+
+
+class FileStore:
+    # Content-addressed copies of the files among the args of wrapped
+    # binaries, at `path`/{hash[:2]}/{hash} with the SHA-256 of the content.
+    # A file is stored once however often and under whatever name it is
+    # passed, a file seen before with the same inode, size and mtime is
+    # not even read again.
+    #
+    # Blobs are reflinks where the file system has them and copies
+    # otherwise. With `hardlink` they are hard links to the file if it is on
+    # the same file system, which costs no space but changes along with the
+    # file. With a `budget` in bytes the least recently used blobs are
+    # removed once the store gets bigger.
+
+    def __init__(self, path: str, budget: int = None, hardlink: bool = False):
+        self.path = path
+        self.budget = budget
+        self.hardlink = hardlink
+        os.makedirs(path, exist_ok=True)
+        # several perf-fuzz-gen may run at once
+        self.db = sqlite3.connect(os.path.join(path, BLOB_INDEX), timeout=30)
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.executescript(SCHEMA)
+
+
+    def close(self):
+        self.db.close()
+
+
+    def blob_path(self, h: str) -> str:
+        return os.path.join(self.path, h[:2], h)
+
+
+    def cached(self, key: tuple) -> str:
+        # the hash of the file with the stat_key() `key`, None if not seen or evicted
+        row = self.db.execute('SELECT hash FROM stat_cache WHERE dev = ? AND ino = ? AND size = ? AND mtime_ns = ?',
+                              key).fetchone()
+        if row is None or not os.path.exists(self.blob_path(row[0])):
+            return None
+        return row[0]
+
+
+    def store(self, path: str) -> str:
+        # the hash of the content of `path`, stored if it is not yet
+        st = os.stat(path)
+        if not stat.S_ISREG(st.st_mode):
+            raise ValueError(f'{path} is not a regular file')
+
+        h = self.cached(stat_key(st))
+        added = h is None
+        if added:
+            h = self.ingest(path, st)
+
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO stat_cache VALUES (?, ?, ?, ?, ?)', (*stat_key(st), h))
+            self.db.execute('INSERT INTO blobs VALUES (?, ?, ?) '
+                            'ON CONFLICT(hash) DO UPDATE SET last_used = excluded.last_used',
+                            (h, st.st_size, time.time()))
+        if added:
+            self.evict(keep=h)
+        return h
+
+
+    def adopt(self, path: str, origin: tuple = None) -> str:
+        # Like store() for a private snapshot of a file, e.g. one fuzz-client
+        # made, which becomes the blob or is removed. `origin` is the
+        # stat_key() of the file it was taken of, whose hash is looked up in
+        # and added to the stat cache, the snapshot is only read on a miss.
+        h = self.cached(origin) if origin is not None else None
+        added = False
+        if h is not None:
+            os.unlink(path)
+            size = origin[2]
+        else:
+            with open(path, 'rb') as f:
+                h = hash_file(f)
+                size = os.fstat(f.fileno()).st_size
+            blob = self.blob_path(h)
+            added = not os.path.exists(blob)
+            if added:
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                try:
+                    os.replace(path, blob)
+                except OSError:
+                    # another file system
+                    shutil.copyfile(path, blob)
+                    os.unlink(path)
+            else:
+                os.unlink(path)
+
+        with self.db:
+            if origin is not None:
+                self.db.execute('INSERT OR REPLACE INTO stat_cache VALUES (?, ?, ?, ?, ?)', (*origin, h))
+            self.db.execute('INSERT INTO blobs VALUES (?, ?, ?) '
+                            'ON CONFLICT(hash) DO UPDATE SET last_used = excluded.last_used',
+                            (h, size, time.time()))
+        if added:
+            self.evict(keep=h)
+        return h
+
+
+    def ingest(self, path: str, st: os.stat_result) -> str:
+        if self.hardlink:
+            with open(path, 'rb') as f:
+                h = hash_file(f)
+            blob = self.blob_path(h)
+            if os.path.exists(blob):
+                return h
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            try:
+                os.link(path, blob)
+                return h
+            except FileExistsError:
+                return h
+            except OSError:
+                # another file system, copy after all
+                pass
+
+        # the hash is of the copy, which cannot change underneath
+        fd, tmp = tempfile.mkstemp(prefix='.blob-', dir=self.path)
+        os.close(fd)
+        try:
+            if not reflink(path, tmp):
+                shutil.copyfile(path, tmp)
+            with open(tmp, 'rb') as f:
+                h = hash_file(f)
+            blob = self.blob_path(h)
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            if os.path.exists(blob):
+                os.unlink(tmp)
+            else:
+                os.replace(tmp, blob)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        return h
+
+
+    def size(self) -> int:
+        (n,) = self.db.execute('SELECT coalesce(sum(size), 0) FROM blobs').fetchone()
+        return n
+
+
+    def evict(self, keep: str = None):
+        # least recently used blobs first, never `keep`
+        if self.budget is None:
+            return
+        total = self.size()
+        if total <= self.budget:
+            return
+        with self.db:
+            for h, size in self.db.execute('SELECT hash, size FROM blobs ORDER BY last_used').fetchall():
+                if total <= self.budget:
+                    break
+                if h == keep:
+                    continue
+                try:
+                    os.unlink(self.blob_path(h))
+                except FileNotFoundError:
+                    pass
+                self.db.execute('DELETE FROM blobs WHERE hash = ?', (h,))
+                self.db.execute('DELETE FROM stat_cache WHERE hash = ?', (h,))
+                total -= size
+
+
+def file_store_from_env(path: str) -> FileStore:
+    # $TREC_FUZZ_FILES_BUDGET like 10G, and $TREC_FUZZ_HARDLINK=1
+    budget = os.environ.get(G_BUDGET_ENV)
+    return FileStore(path, parse_size(budget) if budget else None,
+                     os.environ.get(G_HARDLINK_ENV, '') not in ['', '0'])
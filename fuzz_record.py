@@ -0,0 +1,147 @@
+#! /usr/bin/env python3
+
+import os
+import time
+import json
+from arg_classify import *
+from fuzz_files import *
+
+
+FUZZ_URL_PREFIXES = URL_PREFIXES + ['ws://', 'socks4://', 'socks4a://', 'socks5://', 'socks5h://']
+
+# under $TREC_PERF_DIR/fuzz. A collector holds an flock on its socket
+# path + COLLECTOR_LOCK_EXT while it runs. fuzz-client copies the file
+# args to SNAPSHOT_DIR before the wrapped binary runs.
+COLLECTOR_SOCKET = 'collector.sock'
+COLLECTOR_LOCK_EXT = '.lock'
+COLLECTOR_LOG = 'collector.log'
+SPOOL_DIR = 'spool'
+SNAPSHOT_DIR = 'snapshots'
+
+
+def fuzz_subdir(perf_dir: str, *names: str) -> str:
+    return os.path.join(perf_dir, 'fuzz', *names)
+
+
+def probe_args(args: list[str]) -> tuple[list[int], list[int]]:
+    # indices of the args that are files or dirs, seen from the invocation
+    # itself since they may be gone by the time the record is made. `args`
+    # starts with the exe, which is not one of them.
+    files = []
+    dirs = []
+    for i, a in enumerate(args[1:], 1):
+        if os.path.isfile(a):
+            files.append(i)
+        elif os.path.isdir(a):
+            dirs.append(i)
+    return files, dirs
+
+
+def invocation(package: str, version: str, args: list[str]) -> dict:
+    # what the wrapped binary got, `args` starts with the exe.
+    # fuzz-client.py builds the same without importing this module.
+    files, dirs = probe_args(args)
+    return { 'package' : package, 'version' : version, 'exe' : args[0], 'args' : args,
+             'cwd' : os.getcwd(), 'files' : files, 'dirs' : dirs }
+
+
+class FuzzRecorder:
+    # Turns invocations into the fuzz records of perf-fuzz-gen. The files
+    # among the args go to the FileStore at `files_path`, `files` of a
+    # record maps each of them to its blob. `snapshots` of an invocation
+    # are copies of its files, in the order of `files`, taken when the
+    # files may be gone by the time the record is made. They are stored
+    # instead of the files and removed, `stats` has the stat_key() of each
+    # file when it was copied, so that known files are not hashed again.
+
+    def __init__(self, files_path: str, notice=print, store: FileStore = None):
+        self.notice = notice
+        self.classifier = ArgClassifier(FUZZ_URL_PREFIXES, notice=notice)
+        self.store = store or file_store_from_env(files_path)
+
+
+    def record(self, inv: dict) -> dict:
+        args = inv['args']
+        cwd = inv.get('cwd') or '.'
+        files = { args[i] for i in inv.get('files', []) }
+        dirs = { args[i] for i in inv.get('dirs', []) }
+        snapshots = {}
+        stats = inv.get('stats') or [None] * len(inv.get('snapshots', []))
+        for i, snapshot, st in zip(inv.get('files', []), inv.get('snapshots', []), stats):
+            if snapshot is not None:
+                snapshots.setdefault(args[i], []).append((snapshot, tuple(st) if st else None))
+        blobs = {}
+
+        def classify_file(arg: str):
+            if arg in files:
+                if arg in blobs:
+                    return ARG_FILE
+                try:
+                    if snapshots.get(arg):
+                        blobs[arg] = self.store.adopt(*snapshots[arg].pop())
+                    else:
+                        blobs[arg] = self.store.store(os.path.join(cwd, arg))
+                except (OSError, ValueError) as e:
+                    self.notice(f'failed to store {arg}: {e}')
+                return ARG_FILE
+            if arg in dirs:
+                return ARG_DIR
+            # TODO maybe subcommands like `perf report`
+            return ARG_UNKNOWN
+
+        try:
+            classified = [[ kind, arg ] for kind, arg in self.classifier.classify(args[1:], classify_file)]
+        finally:
+            # those of an arg given twice, or of an invocation that failed
+            for left in snapshots.values():
+                for snapshot, _ in left:
+                    remove_snapshot(snapshot)
+        return { 'package' : inv['package'], 'version' : inv['version'], 'exe' : inv['exe'],
+                 'raw_args' : args,
+                 'classified_args' : classified,
+                 'files' : blobs }
+
+
+def remove_snapshot(path: str):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def read_spool(spool: str) -> list[tuple[str, dict]]:
+    # (path, invocation) of the complete spool files, oldest first
+    try:
+        names = sorted(n for n in os.listdir(spool) if not n.startswith('.'))
+    except FileNotFoundError:
+        return []
+    spooled = []
+    for name in names:
+        path = os.path.join(spool, name)
+        try:
+            with open(path, 'r') as f:
+                spooled.append((path, json.load(f)))
+        except (OSError, ValueError):
+            continue
+    return spooled
+
+
+def record_all(recorder: FuzzRecorder, invocations: list) -> list:
+    records = []
+    for inv in invocations:
+        try:
+            records.append(recorder.record(inv))
+        except (KeyError, IndexError, TypeError) as e:
+            recorder.notice(f'dropping malformed invocation: {type(e).__name__}: {e}')
+    return records
+
+
+def drain_spool(recorder: FuzzRecorder, corpus, spool: str) -> int:
+    # the spool files are removed once their records are in `corpus`, a CorpusWriter
+    spooled = read_spool(spool)
+    if spooled == []:
+        return 0
+    corpus.write_many(record_all(recorder, [inv for _, inv in spooled]))
+    for path, _ in spooled:
+        os.unlink(path)
+    return len(spooled)
@@ -17,59 +17,15 @@ import yaml
 import trace_datum
 import socket
 from trace_datum import *
+from exec_rules import *
+from trace_pipeline import *
 
 
 g_script_name = 'perf-filter'
 g_package: str = ''
 g_version: str = ''
 g_true_exes = []
-
-
-def filter_result(datum: TraceDatum):
-    callee = datum.file_path
-
-    if not g_true_exes == []:
-        if callee not in g_true_exes:
-            return False
-
-    filter_prefixes = ['/bin/', '/usr/', '/sbin/', '/snap/', '/opt/', '/tmp/', '/etc/', '/var/']
-    for p in filter_prefixes:
-       if callee.startswith(p):
-            return False
-
-    filter_suffixes = ['./conftest', './configure', '.build.command', '/bin/sh', '/.', '.sh'
-                       'config.guess']
-    for p in filter_suffixes:
-       if callee.endswith(p):
-            return False
-
-    filter_infixes = ['./exec.cmd']
-    for p in filter_infixes:
-       if p in callee:
-            return False
-
-    return datum.check_fields()
-
-
-def to_absolute_path(data: list[TraceDatum]):
-    for d in data:
-        exe = d.file_path
-        # caller's working dir
-        pwd = d.working_dir
-
-        # convert to absolute path
-        if not exe.startswith('/'):
-            exe = pwd + '/' + exe
-
-        d.file_path = exe
-
-
-def analyze(data: list[TraceDatum]):
-    to_absolute_path(data)
-    filtered = filter(lambda d: filter_result(d), data)
-    perf = list(set([d.file_path for d in filtered]))
-
-    return perf
+g_matcher: ExecMatcher = None
 
 
 def check_file(f):
@@ -86,8 +42,16 @@ def check_file(f):
 parser = argparse.ArgumentParser(
     prog=g_script_name,
     description='Analyze bpftrace data and generate dataset.')
-parser.add_argument('rawfile', help='raw trace files in yaml format')
+parser.add_argument('rawfile', help='raw trace files in yaml or binary format')
 parser.add_argument('--refinement', help='refinement data generated by perf-wrapper')
+parser.add_argument('--rules', default=G_RULES_PATH,
+                    help='rules of executables to leave out, exec-filter.rules by default')
+parser.add_argument('--columnar', action='store_true',
+                    help='load a binary trace into a column table and filter it with NumPy, needs numpy')
+parser.add_argument('--format', choices=DATASET_FORMATS, default='yaml',
+                    help='yaml, or jsonl for one JSON record per line with a .jsonl extension')
+parser.add_argument('--compress', choices=['gz', 'xz'],
+                    help='compress the dataset, adds the extension to its name')
 
 args = parser.parse_args()
 
@@ -102,15 +66,17 @@ if refinement is not None:
         g_true_exes = yaml.load(f, Loader=yaml.Loader)
         print(f'loading refinement: {refinement} done')
 
-with open(rawfile, 'r') as f:
-    print(f'loading {rawfile}')
-    data = yaml.load(f, Loader=yaml.Loader)
-    print(f'loading {rawfile} done')
-    g_package = data['package']
-    g_version = data['version']
-    perf = analyze(data['data'])
-    
-    perf_path = f'{g_package}-{g_version}-perf'
-    with open(perf_path, 'w') as f_perf:
-        yaml.dump(perf, f_perf)
-        print(f'{rawfile} perf dataset at {perf_path}')
+check_file(args.rules)
+g_matcher = load_matcher(args.rules, g_true_exes)
+
+pipeline = Pipeline(g_matcher, [PerfSink()], fmt=args.format, compress=args.compress)
+
+print(f'loading {rawfile}')
+pipeline.run_file(rawfile, args.columnar)
+print(f'loading {rawfile} done, {pipeline.records} records, '
+      f'{g_matcher.resolve.cache_info().currsize} distinct paths')
+g_package = pipeline.header.get('package', '')
+g_version = pipeline.header.get('version', '')
+
+for name, path in pipeline.write(g_package, g_version).items():
+    print(f'{rawfile} {name} dataset at {path}')
@@ -68,7 +68,7 @@ def wrap(exe: str) -> bool:
 
 mkdir -p {g_perf_data_path}/errors/
 
-/usr/bin/rvbench-tools/perf-fuzz-gen.py $RPM_PACKAGE_NAME $RPM_PACKAGE_VERSION {exe} "$@"
+/usr/bin/rvbench-tools/fuzz-client.py $RPM_PACKAGE_NAME $RPM_PACKAGE_VERSION {exe} "$@"
 
 SUFIX=$(date +%N_%F_%T)
 perf record -F 9999 -e instructions:u -g --user-callchains \\
@@ -0,0 +1,47 @@
+#! /usr/bin/env python3
+
+####################################################
+#
+#
+# convert raw traces between YAML and binary format
+#
+# Author: Mao Yifu, maoif@ios.ac.cn
+#
+#
+####################################################
+
+import os
+import argparse
+from trace_io import *
+
+
+def check_file(f):
+    if not os.path.exists(f):
+        print(f'{f} not found')
+        exit(-1)
+    elif not os.path.isfile(f):
+        print(f'{f} is not a file')
+
+###
+### start of program
+###
+
+parser = argparse.ArgumentParser(
+    prog='trace-convert',
+    description='Convert raw trace files between YAML and binary format.')
+parser.add_argument('input', help='raw trace file, YAML or binary')
+parser.add_argument('output', help=f'converted trace file, binary if it ends with {TRACE_EXT} or {TRACE_EXT}.gz')
+parser.add_argument('-f', '--format', choices=['yaml', 'bin'], help='output format, overrides the file name')
+
+args = parser.parse_args()
+
+check_file(args.input)
+reader = open_trace(args.input)
+# the header has to be written first
+reader.read_header()
+
+print(f'converting {args.input}')
+with open_trace_writer(args.output, reader.header, args.format) as writer:
+    for d in reader:
+        writer.write(d)
+print(f'converting {args.input} done, {writer.count} records in {args.output}')
@@ -0,0 +1,91 @@
+#! /usr/bin/env python3
+
+####################################################
+#
+#
+# import raw traces and fuzz datasets into a SQLite trace store
+#
+# Author: Mao Yifu, maoif@ios.ac.cn
+#
+#
+####################################################
+
+import os
+import time
+import argparse
+import itertools
+from trace_io import *
+from trace_store import *
+
+
+def check_file(f):
+    if not os.path.exists(f):
+        print(f'{f} not found')
+        exit(-1)
+    elif not os.path.isfile(f):
+        print(f'{f} is not a file')
+
+
+def datum_fields(d: TraceDatum) -> tuple:
+    # what the store keeps of a datum
+    if d is None:
+        return None
+    d.prepare()
+    return (d.pid_tgid, d.comm, d.file_path, d.working_dir, d.flags, d.args, d.envs)
+
+
+def verify(store: TraceStore, trace_id: int, f: str) -> int:
+    # the number of datums read back from the store that differ from those of `f`
+    diffs = 0
+    for n, (a, b) in enumerate(itertools.zip_longest(open_trace(f), store.open_trace(trace_id))):
+        a, b = datum_fields(a), datum_fields(b)
+        if a != b:
+            if diffs == 0:
+                print(f'record {n} differs: {a} in {f}, {b} in the store')
+            diffs += 1
+    return diffs
+
+###
+### start of program
+###
+
+parser = argparse.ArgumentParser(
+    prog='trace-import',
+    description='Import raw traces and fuzz datasets into a SQLite database for queries and datagen --from-db.')
+parser.add_argument('db', help='the database, created if missing')
+parser.add_argument('files', nargs='*', help='raw trace files in yaml or binary format, or fuzz datasets with --dataset')
+parser.add_argument('--dataset', action='store_true', help='the files are fuzz datasets of datagen')
+parser.add_argument('--package', help='package of the fuzz datasets, from their names by default')
+parser.add_argument('--version', help='version of the fuzz datasets, from their names by default')
+parser.add_argument('--list', action='store_true', help='list the traces and datasets in the database')
+parser.add_argument('--verify', action='store_true',
+                    help='read each imported trace back and compare it with its file, args that are not UTF-8 included')
+
+args = parser.parse_intermixed_args()
+
+for f in args.files:
+    check_file(f)
+
+with TraceStore(args.db) as store:
+    for f in args.files:
+        print(f'importing {f}')
+        start = time.monotonic()
+        if args.dataset:
+            n = store.import_dataset(f, args.package, args.version)
+            records = store.db.execute('SELECT records FROM datasets WHERE id = ?', (n,)).fetchone()[0]
+            print(f'importing {f} done, dataset {n}, {records} records in {time.monotonic() - start:.1f} s')
+        else:
+            n = store.import_trace(open_trace(f), f)
+            records = store.db.execute('SELECT records FROM traces WHERE id = ?', (n,)).fetchone()[0]
+            print(f'importing {f} done, trace {n}, {records} records in {time.monotonic() - start:.1f} s')
+            if args.verify:
+                diffs = verify(store, n, f)
+                print(f'verifying {f}: {diffs} records differ')
+                if diffs > 0:
+                    exit(-1)
+
+    if args.list:
+        for n, source, package, version, records in store.traces():
+            print(f'trace {n}: {package}-{version}, {records} records from {source}')
+        for n, source, package, version, records in store.datasets():
+            print(f'dataset {n}: {package}-{version}, {records} records from {source}')
@@ -0,0 +1,220 @@
+#! /usr/bin/env python3
+
+import time
+import hashlib
+from collections import OrderedDict
+from trace_datum import *
+from trace_events import *
+
+
+class TraceConsumer:
+    # Userspace side of the tracer: assembles ring buffer events into
+    # TraceDatums and writes the completed ones. Event sources call the
+    # record_* methods with a buffer and the position of a record in it,
+    # then flush() once per poll.
+    #
+    # Entries whose events_basic record got lost never complete. They are
+    # evicted after `inflight_ttl` seconds, or earlier when there are more
+    # than `inflight_max` of them, and written to `evicted_writer` if any.
+    #
+    # `env_mode` is one of ENV_MODES. In 'allowlist' mode only the
+    # variables named in `env_allowlist` are kept, in 'hash' mode the envs
+    # are replaced by a single hash of all of them and `envs_hashed` is set,
+    # so that it is not taken for a NAME=value. Evicted datums get the same.
+
+    def __init__(self, writer, inflight_ttl: float = 10.0, inflight_max: int = 65536,
+                 evicted_writer = None, env_mode: str = 'all', env_allowlist = None):
+        self.writer = writer
+        self.evicted_writer = evicted_writer
+        self.inflight_ttl = inflight_ttl
+        self.inflight_max = inflight_max
+        self.env_mode = env_mode
+        self.env_allowlist = frozenset(env_allowlist or [])
+
+        self.trace_data: dict[int, TraceDatum] = {}
+        # arrival time of the entries in trace_data, oldest first
+        self.arrival: OrderedDict[int, float] = OrderedDict()
+        # events of the current poll
+        self.batch = EventBatch()
+
+        self.events = 0
+        self.completed = 0
+        self.written = 0
+        self.evicted = 0
+        # completed datums with each of the F_* flags set
+        self.flag_counts = [0] * (F_PREFILTERED + 1)
+        # called with each completed TraceDatum, for measurements
+        self.on_complete = None
+
+
+    def get_trace_datum(self, pid_tgid, creator) -> TraceDatum:
+        d = self.trace_data.get(pid_tgid)
+        if d is None:
+            d = TraceDatum()
+            d.pid_tgid = pid_tgid
+            d.creator = creator
+            self.trace_data[pid_tgid] = d
+            self.arrival[pid_tgid] = time.monotonic()
+        return d
+
+
+    def pop_trace_datum(self, pid_tgid) -> TraceDatum:
+        self.arrival.pop(pid_tgid, None)
+        return self.trace_data.pop(pid_tgid, None)
+
+
+    def inflight(self) -> int:
+        return len(self.trace_data)
+
+
+    def received(self) -> int:
+        # events so far, including those of the current poll
+        return self.events + len(self.batch)
+
+
+    # Callbacks only decode, the events are applied in flush().
+
+    def record_basic(self, buf, pos: int):
+        self.batch.basics.append(decode_basic(buf, pos))
+
+
+    def record_arg(self, buf, pos: int):
+        self.batch.args.append(decode_arg(buf, pos))
+
+
+    def record_env(self, buf, pos: int):
+        self.batch.envs.append(decode_arg(buf, pos))
+
+
+    def record_path_part(self, buf, pos: int):
+        self.batch.path_parts.append(decode_path_part(buf, pos))
+
+
+    def record_packed(self, buf, pos: int):
+        # the whole exec in one record, see struct data_packed
+        d = decode_packed(buf, pos)
+        d.creator = 'record_packed'
+        self.events += 1
+        self.complete_trace_datum(d)
+
+
+    def filter_envs(self, d: TraceDatum):
+        if self.env_mode == 'allowlist':
+            # the kernel only compares hashes of the names
+            d.envs = [e for e in d.envs if env_name(e) in self.env_allowlist]
+        elif self.env_mode == 'hash':
+            d.envs = [hash_envs(d.envs)]
+            d.envs_hashed = True
+
+
+    def complete_trace_datum(self, d: TraceDatum):
+        self.completed += 1
+        if d.flags:
+            for f in range(len(self.flag_counts)):
+                if d.flags & (1 << f):
+                    self.flag_counts[f] += 1
+        d.prepare()
+        self.filter_envs(d)
+        if d.check_fields():
+            self.writer.write(d)
+            self.written += 1
+        if self.on_complete is not None:
+            self.on_complete(d)
+
+
+    def evict_orphans(self, now: float):
+        while len(self.arrival) > 0:
+            ids, arrival = next(iter(self.arrival.items()))
+            if now - arrival < self.inflight_ttl and len(self.arrival) <= self.inflight_max:
+                break
+
+            self.arrival.popitem(last=False)
+            d = self.trace_data.pop(ids)
+            self.evicted += 1
+            if self.evicted_writer is not None:
+                d.prepare()
+                self.filter_envs(d)
+                self.evicted_writer.write(d)
+
+
+    def flush(self):
+        # Called after each poll rather than from record_basic(), as the ring
+        # buffers are consumed one after another and the args of an exec may
+        # be handled after its events_basic record within the same poll.
+        self.events += len(self.batch)
+        for ids in self.batch.apply(self.get_trace_datum):
+            d = self.pop_trace_datum(ids)
+            if d is None:
+                continue
+            self.complete_trace_datum(d)
+
+        self.evict_orphans(time.monotonic())
+        # hand the records to the OS, so they survive the tracer being killed
+        self.writer.flush()
+
+
+    def close(self):
+        self.flush()
+        # what is left never got its events_basic record
+        self.evict_orphans(float('inf'))
+        self.writer.close()
+        if self.evicted_writer is not None:
+            self.evicted_writer.close()
+
+
+def env_name(env) -> str:
+    if isinstance(env, bytes):
+        env = env.decode('utf-8', 'surrogateescape')
+    return env.split('=', 1)[0]
+
+
+def hash_envs(envs: list) -> str:
+    h = hashlib.sha256()
+    for e in envs:
+        if isinstance(e, str):
+            e = e.encode('utf-8', 'surrogateescape')
+        h.update(e)
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+class TraceStats:
+    # Rates since the previous report, to see whether loss goes down
+    # under load. `dropped` is the number of execs the kernel side could
+    # not submit at all, if the source can tell.
+
+    def __init__(self, consumer: TraceConsumer, source):
+        self.consumer = consumer
+        self.source = source
+        self.last = self.snapshot()
+
+
+    def snapshot(self):
+        c = self.consumer
+        dropped = self.source.dropped() if hasattr(self.source, 'dropped') else 0
+        return (time.monotonic(), c.received(), c.completed, c.evicted, dropped, list(c.flag_counts))
+
+
+    def report(self) -> str:
+        now = self.snapshot()
+        t0, events0, completed0, evicted0, dropped0, flags0 = self.last
+        t1, events1, completed1, evicted1, dropped1, flags1 = now
+        self.last = now
+
+        elapsed = max(t1 - t0, 1e-9)
+        completed = completed1 - completed0
+
+        def rate(n):
+            return 100.0 * n / completed if completed > 0 else 0.0
+
+        flags = [f1 - f0 for f0, f1 in zip(flags0, flags1)]
+        line = (f'{(events1 - events0) / elapsed:,.0f} events/s, '
+                f'{completed / elapsed:,.0f} execs/s, '
+                f'fail arg/env/path {rate(flags[F_FAIL_ARG]):.2f}%/'
+                f'{rate(flags[F_FAIL_ENV]):.2f}%/{rate(flags[F_FAIL_PATH]):.2f}%, '
+                f'prefiltered {rate(flags[F_PREFILTERED]):.2f}%, '
+                f'dropped {dropped1 - dropped0}, evicted {evicted1 - evicted0}, '
+                f'in flight {self.consumer.inflight()}')
+        if hasattr(self.source, 'timeout'):
+            line += f', poll timeout {self.source.timeout} ms'
+        return line
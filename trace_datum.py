@@ -1,5 +1,6 @@
 #! /usr/bin/env python3
 
+import sys
 import yaml
 
 
@@ -8,12 +9,53 @@ F_FAIL_ENV         = 1
 F_FAIL_PATH        = 2
 F_INCOMPLETE_ARGS  = 3
 F_INCOMPLETE_ENVS  = 4
+F_PREFILTERED      = 5
+# set in userspace, not by bcc-execve.c: `envs` is [hash_envs() of all of them]
+F_ENVS_HASHED      = 6
 
 G_TRACEDATUM_TAG = u'!!bcc_trace_datum'
 
+# boolean attributes of TraceDatum, by flag
+G_FLAG_NAMES = ['fail_arg', 'fail_env', 'fail_path', 'incomplete_args', 'incomplete_envs']
+
+
+def intern_str(s):
+    # args and envs that failed to decode stay bytes
+    if type(s) is str:
+        return sys.intern(s)
+    return s
+
+
+def flag_property(flag: int):
+    mask = 1 << flag
+
+    def get(self) -> bool:
+        return self.flags & mask == mask
+
+    def set(self, value: bool):
+        if value:
+            self.flags |= mask
+        else:
+            self.flags &= ~mask
+
+    return property(get, set)
+
 
 class TraceDatum(yaml.YAMLObject):
+    # A trace holds millions of these, so there is no per-instance dict and
+    # the booleans are derived from `flags`. Strings that repeat across the
+    # execs of a build, i.e. comm, file_path, working_dir, path parts and
+    # envs, are interned by the decoders, see intern_str().
     yaml_tag = G_TRACEDATUM_TAG
+    __slots__ = ('pid_tgid', 'comm', 'file_path', 'args', 'envs', 'path_parts',
+                 'working_dir', 'creator', 'flags')
+
+    fail_arg        = flag_property(F_FAIL_ARG)
+    fail_env        = flag_property(F_FAIL_ENV)
+    fail_path       = flag_property(F_FAIL_PATH)
+    incomplete_args = flag_property(F_INCOMPLETE_ARGS)
+    incomplete_envs = flag_property(F_INCOMPLETE_ENVS)
+    envs_hashed     = flag_property(F_ENVS_HASHED)
 
     def __init__(self):
         self.pid_tgid = False
@@ -25,11 +67,35 @@ class TraceDatum(yaml.YAMLObject):
         self.working_dir = False
         self.creator = ""
         self.flags = 0
-        self.fail_arg = False
-        self.fail_env = False
-        self.fail_path = False
-        self.incomplete_args = False
-        self.incomplete_envs = False
+
+
+    def __getstate__(self):
+        # what yaml.dump() writes, the same keys as before __slots__
+        return {'pid_tgid'        : self.pid_tgid,
+                'comm'            : self.comm,
+                'file_path'       : self.file_path,
+                'args'            : self.args,
+                'envs'            : self.envs,
+                'path_parts'      : self.path_parts,
+                'working_dir'     : self.working_dir,
+                'creator'         : self.creator,
+                'flags'           : self.flags,
+                'fail_arg'        : self.fail_arg,
+                'fail_env'        : self.fail_env,
+                'fail_path'       : self.fail_path,
+                'incomplete_args' : self.incomplete_args,
+                'incomplete_envs' : self.incomplete_envs}
+
+
+    def __setstate__(self, state: dict):
+        self.__init__()
+        for k in self.__slots__:
+            if k in state:
+                setattr(self, k, state[k])
+        # the booleans only add to `flags`
+        for k in G_FLAG_NAMES:
+            if state.get(k):
+                setattr(self, k, True)
 
 
     def __str__(self):
@@ -87,47 +153,28 @@ dir:      {self.working_dir}
             return
 
         self.path_parts.reverse()
-        self.working_dir = "/" + "/".join(self.path_parts)
-
-
-    def parse_flags(self):
-        if self.flags & (1 << F_FAIL_ARG) == (1 << F_FAIL_ARG):
-            self.fail_arg = True
-
-        if self.flags & (1 << F_FAIL_ENV) == (1 << F_FAIL_ENV):
-            self.fail_env = True
-
-        if self.flags & (1 << F_FAIL_PATH) == (1 << F_FAIL_PATH):
-            self.fail_path = True
-
-        if self.flags & (1 << F_INCOMPLETE_ARGS) == (1 << F_INCOMPLETE_ARGS):
-            self.incomplete_args = True
-
-        if self.flags & (1 << F_INCOMPLETE_ENVS) == (1 << F_INCOMPLETE_ENVS):
-            self.incomplete_envs = True
+        self.working_dir = sys.intern("/" + "/".join(self.path_parts))
 
 
     def prepare(self):
-        self.parse_flags()
         self.assemble_working_dir()
 
 
 def trace_datum_constructor(loader, node):
-    value = loader.construct_mapping(node)
+    value = loader.construct_mapping(node, deep=True)
 
     d = TraceDatum()
     d.pid_tgid = value['pid_tgid']
-    d.comm = value['comm']
-    d.file_path = value['file_path']
+    d.comm = intern_str(value['comm'])
+    d.file_path = intern_str(value['file_path'])
     d.args = value['args']
-    d.envs = value['envs']
-    d.working_dir = value['working_dir']
+    d.envs = [intern_str(e) for e in value['envs']]
+    d.working_dir = intern_str(value['working_dir'])
     d.flags = value['flags']
-    d.fail_arg = value['fail_arg']
-    d.fail_env = value['fail_env']
-    d.fail_path = value['fail_path']
-    d.incomplete_args = value['incomplete_args']
-    d.incomplete_envs = value['incomplete_envs']
+    # redundant with flags, but files may have been edited
+    for k in G_FLAG_NAMES:
+        if value.get(k):
+            setattr(d, k, True)
     d.path_parts = []
     d.creator = ''
 
@@ -0,0 +1,182 @@
+#! /usr/bin/env python3
+
+import re
+import sys
+import ctypes
+import struct
+from trace_datum import *
+
+
+TASK_COMM_LEN = 16
+PATH_SIZE = 256
+MAX_STR_SIZE = 4096 - 8
+MAX_PATH_READ = 32
+
+# ENV_MODE_* in bcc-execve.c, by value
+ENV_MODES = ['all', 'allowlist', 'hash', 'off']
+ENV_NAME_MAX = 32
+
+# Layouts of the structs in bcc-execve.c. The string fields are decoded
+# straight from the ring buffer memory up to their first NUL, instead of
+# going through the ctypes structs of `b[...].event()`.
+BASIC_HEAD = struct.Struct('<QI')           # struct data_basic
+BASIC_COMM = BASIC_HEAD.size
+BASIC_FILENAME = BASIC_COMM + TASK_COMM_LEN
+BASIC_SIZE = BASIC_FILENAME + PATH_SIZE
+BASIC = struct.Struct(f'<QI{TASK_COMM_LEN}s{PATH_SIZE}s')
+PID_TGID = struct.Struct('<Q')              # data_arg, data_env
+PATH_PART = struct.Struct(f'<Q{MAX_PATH_READ}s')    # data_path_part
+
+NUL = re.compile(b'\0')
+
+# struct data_packed in bcc-execve.c, up to `data`
+PACKED_HEAD = struct.Struct(f'<QIHHHH{TASK_COMM_LEN}s{PATH_SIZE}s')
+
+
+def env_name_hash(name: bytes) -> int:
+    # env_allowed() in bcc-execve.c
+    h = 2166136261
+    for ch in name[:ENV_NAME_MAX]:
+        h = ((h ^ ch) * 16777619) & 0xffffffff
+    return h
+
+
+def c_str(b: bytes) -> bytes:
+    n = b.find(b'\0')
+    if n < 0:
+        return b
+    return b[:n]
+
+
+def decode_str(b: bytes):
+    # same as record_arg() and record_env(), keep what does not decode
+    try:
+        return b.decode('utf-8')
+    except UnicodeDecodeError:
+        return b
+
+
+# ctypes array types by record size, the records of a ring buffer all
+# have the same one except packed ones
+record_types = {}
+
+
+def record_view(data: int, size: int):
+    # The `size` bytes of a ring buffer record at address `data` as a
+    # ctypes array, which the decoders read in place without copying.
+    # Slices stop at `size` rather than reading whatever memory follows.
+    # A memoryview over it measured slower than the array itself.
+    t = record_types.get(size)
+    if t is None:
+        t = record_types[size] = ctypes.c_char * size
+    return t.from_address(data)
+
+
+# bound methods, these run several times per exec
+find_nul = NUL.search
+unpack_basic = BASIC.unpack_from
+unpack_pid = PID_TGID.unpack_from
+unpack_path_part = PATH_PART.unpack_from
+
+
+# The decoders take a buffer and the position of the record in it, a
+# record_view() or a recorded blob and usually 0. They return plain
+# tuples, and raise ValueError for records shorter than their layout.
+
+def check_size(buf, pos: int, size: int):
+    if pos < 0 or len(buf) - pos < size:
+        raise ValueError(f'record of {len(buf) - pos} bytes, at least {size} expected')
+
+
+def str_at(buf, start: int, end: int) -> bytes:
+    m = find_nul(buf, start, end)
+    if m is not None:
+        end = m.start()
+    return buf[start:end]
+
+
+def decode_basic(buf, pos: int = 0):
+    # the fixed struct in one unpack, short enough that cutting the
+    # strings at their NUL afterwards beats searching the buffer
+    check_size(buf, pos, BASIC_SIZE)
+    pid_tgid, flags, comm, filename = unpack_basic(buf, pos)
+    return pid_tgid, flags, str(comm.partition(b'\0')[0], 'utf-8'), str(filename.partition(b'\0')[0], 'utf-8')
+
+
+def decode_arg(buf, pos: int = 0):
+    # also for data_env, the string ends at the end of the record at the latest
+    check_size(buf, pos, PID_TGID.size)
+    s = str_at(buf, pos + PID_TGID.size, pos + PID_TGID.size + MAX_STR_SIZE)
+    try:
+        arg = str(s, 'utf-8')
+    except UnicodeDecodeError:
+        arg = bytes(s)
+    return unpack_pid(buf, pos)[0], arg
+
+
+def decode_path_part(buf, pos: int = 0):
+    # fixed size like data_basic
+    check_size(buf, pos, PATH_PART.size)
+    pid_tgid, part = unpack_path_part(buf, pos)
+    return pid_tgid, str(part.partition(b'\0')[0], 'utf-8')
+
+
+class EventBatch:
+    # Events decoded during one poll of the ring buffers, applied to the
+    # in-flight datums once the poll returns. The parts of an exec are
+    # applied before any basic record, whatever ring buffer got consumed
+    # first.
+
+    def __init__(self):
+        self.basics = []
+        self.args = []
+        self.envs = []
+        self.path_parts = []
+
+
+    def __len__(self):
+        return len(self.basics) + len(self.args) + len(self.envs) + len(self.path_parts)
+
+
+    def apply(self, get_trace_datum) -> list[int]:
+        # returns the pid_tgid of the completed datums
+        for ids, arg in self.args:
+            get_trace_datum(ids, 'record_arg').args.append(arg)
+        for ids, env in self.envs:
+            get_trace_datum(ids, 'record_env').envs.append(intern_str(env))
+        for ids, part in self.path_parts:
+            get_trace_datum(ids, 'record_path_part').path_parts.append(sys.intern(part))
+
+        completed = []
+        for ids, flags, comm, filename in self.basics:
+            d = get_trace_datum(ids, 'record_basic')
+            d.comm = sys.intern(comm)
+            d.file_path = sys.intern(filename)
+            d.flags = flags
+            completed.append(ids)
+
+        self.basics.clear()
+        self.args.clear()
+        self.envs.clear()
+        self.path_parts.clear()
+
+        return completed
+
+
+def decode_packed(buf, pos: int = 0) -> TraceDatum:
+    check_size(buf, pos, PACKED_HEAD.size)
+    pid_tgid, flags, argc, envc, depth, length, comm, filename = PACKED_HEAD.unpack_from(buf, pos)
+    start = pos + PACKED_HEAD.size
+    check_size(buf, start, length)
+    parts = bytes(buf[start:start + length]).split(b'\0')
+
+    d = TraceDatum()
+    d.pid_tgid = pid_tgid
+    d.flags = flags
+    d.comm = sys.intern(c_str(comm).decode('utf-8'))
+    d.file_path = sys.intern(c_str(filename).decode('utf-8'))
+    d.args = [decode_str(a) for a in parts[:argc]]
+    d.envs = [intern_str(decode_str(e)) for e in parts[argc:argc + envc]]
+    d.path_parts = [sys.intern(p.decode('utf-8')) for p in parts[argc + envc:argc + envc + depth]]
+
+    return d
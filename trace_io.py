@@ -0,0 +1,477 @@
+#! /usr/bin/env python3
+
+import os
+import gzip
+import json
+import struct
+import yaml
+from yaml.events import *
+from yaml.nodes import ScalarNode, SequenceNode, MappingNode
+from trace_datum import *
+
+
+# libyaml is an order of magnitude faster than the pure-Python loader,
+# fall back to the latter if PyYAML was built without it.
+try:
+    from yaml import CLoader as TraceLoader
+except ImportError:
+    from yaml import Loader as TraceLoader
+
+try:
+    from yaml import CDumper as TraceDumper
+except ImportError:
+    from yaml import Dumper as TraceDumper
+
+# yaml.add_constructor() and the YAMLObject metaclass do not reach
+# the C loader and dumper
+TraceLoader.add_constructor(G_TRACEDATUM_TAG, trace_datum_constructor)
+TraceDumper.add_representer(TraceDatum, TraceDatum.to_yaml)
+
+# Binary trace layout, all integers little endian:
+#
+#   magic, u32 format version
+#   u32 length, header as JSON
+#   u32 length, record       (repeated until EOF)
+#
+# A record is the fixed part below followed by comm, file_path,
+# working_dir, args and envs. Each string is a u32 length and its
+# UTF-8 bytes; STR_RAW in the length marks args or envs that were kept
+# as raw bytes because they failed to decode.
+TRACE_MAGIC = b'BCCTRACE'
+TRACE_FORMAT_VERSION = 1
+TRACE_EXT = '.trb'
+
+RECORD_FIXED = struct.Struct('<QIHH')   # pid_tgid, flags, #args, #envs
+U32 = struct.Struct('<I')
+STR_RAW = 1 << 31
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def compose_node(loader, anchors: dict):
+    # Build the node of the next value from parser events only.
+    # The C loader has no public composer for a single sub-node,
+    # so we cannot use loader.compose_node().
+    event = loader.get_event()
+
+    if isinstance(event, AliasEvent):
+        if event.anchor not in anchors:
+            raise ValueError(f'alias *{event.anchor} at {event.start_mark} is not of the same record')
+        return anchors[event.anchor]
+
+    if isinstance(event, ScalarEvent):
+        tag = event.tag
+        if tag is None or tag == '!':
+            tag = loader.resolve(ScalarNode, event.value, event.implicit)
+        node = ScalarNode(tag, event.value, event.start_mark, event.end_mark,
+                          style=event.style)
+    elif isinstance(event, SequenceStartEvent):
+        tag = event.tag
+        if tag is None or tag == '!':
+            tag = loader.resolve(SequenceNode, None, event.implicit)
+        node = SequenceNode(tag, [], event.start_mark, None,
+                            flow_style=event.flow_style)
+        if event.anchor is not None:
+            anchors[event.anchor] = node
+        while not loader.check_event(SequenceEndEvent):
+            node.value.append(compose_node(loader, anchors))
+        node.end_mark = loader.get_event().end_mark
+        return node
+    elif isinstance(event, MappingStartEvent):
+        tag = event.tag
+        if tag is None or tag == '!':
+            tag = loader.resolve(MappingNode, None, event.implicit)
+        node = MappingNode(tag, [], event.start_mark, None,
+                           flow_style=event.flow_style)
+        if event.anchor is not None:
+            anchors[event.anchor] = node
+        while not loader.check_event(MappingEndEvent):
+            key = compose_node(loader, anchors)
+            value = compose_node(loader, anchors)
+            node.value.append((key, value))
+        node.end_mark = loader.get_event().end_mark
+        return node
+    else:
+        raise ValueError(f'unexpected YAML event {event}')
+
+    if event.anchor is not None:
+        anchors[event.anchor] = node
+    return node
+
+
+def skip_node(loader):
+    level = 0
+    while True:
+        event = loader.get_event()
+        if isinstance(event, (SequenceStartEvent, MappingStartEvent)):
+            level += 1
+        elif isinstance(event, (SequenceEndEvent, MappingEndEvent)):
+            level -= 1
+        if level == 0:
+            return
+
+
+class TraceReader:
+    # Iterates over the `data:` sequence of a raw trace file one TraceDatum
+    # at a time, so memory use does not depend on the size of the file.
+    #
+    # Keys other than `data` end up in `header`. Older traces have them
+    # sorted after `data`, in which case `package` and `version` are only
+    # known once the iteration is over.
+
+    def __init__(self, path: str):
+        self.path = path
+        self.header = {}
+        self.count = 0
+
+
+    @property
+    def package(self) -> str:
+        return self.header.get('package', '')
+
+
+    @property
+    def version(self) -> str:
+        return self.header.get('version', '')
+
+
+    def __iter__(self):
+        with open(self.path, 'rb') as f:
+            loader = TraceLoader(f)
+            try:
+                yield from self.walk(loader)
+            finally:
+                loader.dispose()
+
+
+    def walk(self, loader):
+        anchors = {}
+
+        loader.get_event()
+        if loader.check_event(StreamEndEvent):
+            return
+
+        loader.get_event()
+        if not loader.check_event(MappingStartEvent):
+            raise ValueError(f'{self.path} is not a raw trace file')
+        loader.get_event()
+
+        while not loader.check_event(MappingEndEvent):
+            key = loader.construct_document(compose_node(loader, anchors))
+            if key != 'data':
+                value = compose_node(loader, anchors)
+                self.header[key] = loader.construct_document(value)
+                continue
+
+            if not loader.check_event(SequenceStartEvent):
+                # `data: null`, nothing was traced
+                compose_node(loader, anchors)
+                continue
+
+            loader.get_event()
+            while not loader.check_event(SequenceEndEvent):
+                d = loader.construct_document(compose_node(loader, anchors))
+                # a datum has lists of its own, no alias refers to the
+                # anchors of an earlier one, which would only pile up
+                anchors.clear()
+                self.count += 1
+                yield d
+            loader.get_event()
+
+
+    def read_header(self):
+        # Fill in `header` without constructing any TraceDatum. Keys before
+        # `data` are read as they come. Older traces have them sorted after
+        # it, those are read from the end of the file, and only if that
+        # fails is all of `data` parsed to get past it.
+        with open(self.path, 'rb') as f:
+            loader = TraceLoader(f)
+            try:
+                loader.get_event()
+                if loader.check_event(StreamEndEvent):
+                    return self.header
+
+                loader.get_event()
+                if not loader.check_event(MappingStartEvent):
+                    raise ValueError(f'{self.path} is not a raw trace file')
+                loader.get_event()
+
+                while not loader.check_event(MappingEndEvent):
+                    key = loader.construct_document(compose_node(loader, {}))
+                    if key != 'data':
+                        value = compose_node(loader, {})
+                        self.header[key] = loader.construct_document(value)
+                        continue
+                    if 'package' in self.header and 'version' in self.header:
+                        break
+                    tail = self.read_tail_header()
+                    if tail is not None:
+                        self.header.update(tail)
+                        break
+                    skip_node(loader)
+            finally:
+                loader.dispose()
+
+        return self.header
+
+
+    def read_tail_header(self, size: int = 1 << 16):
+        # The keys after `data` are the lines at the end of the file that
+        # start in the first column, the items of `data` start with `-` and
+        # their fields are indented. None if they are not all in the last
+        # `size` bytes.
+        with open(self.path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            start = max(0, f.tell() - size)
+            f.seek(start)
+            lines = f.read().splitlines(keepends=True)
+        if start > 0:
+            # may start in the middle of a line
+            lines = lines[1:]
+
+        while lines != [] and lines[-1].strip() == b'':
+            lines.pop()
+        n = len(lines)
+        while n > 0 and lines[n - 1][:1] not in b' \t-#':
+            n -= 1
+        if n == 0 and start > 0 or n == len(lines):
+            return None
+        try:
+            header = yaml.load(b''.join(lines[n:]), Loader=TraceLoader)
+        except yaml.YAMLError:
+            return None
+        if not isinstance(header, dict):
+            return None
+        header.pop('data', None)
+        return header
+
+
+def encode_str(buf: bytearray, s):
+    if isinstance(s, str):
+        b = s.encode('utf-8', 'surrogateescape')
+        buf += U32.pack(len(b))
+    else:
+        b = bytes(s)
+        buf += U32.pack(len(b) | STR_RAW)
+    buf += b
+
+
+def decode_str(buf, pos: int):
+    (n,) = U32.unpack_from(buf, pos)
+    pos += U32.size
+    if n & STR_RAW:
+        n &= ~STR_RAW
+        return bytes(buf[pos:pos + n]), pos + n
+    return str(buf[pos:pos + n], 'utf-8', 'surrogateescape'), pos + n
+
+
+def encode_datum(d: TraceDatum) -> bytes:
+    buf = bytearray(RECORD_FIXED.pack(d.pid_tgid, d.flags, len(d.args), len(d.envs)))
+    encode_str(buf, d.comm or '')
+    encode_str(buf, d.file_path or '')
+    encode_str(buf, d.working_dir or '')
+    for a in d.args:
+        encode_str(buf, a)
+    for e in d.envs:
+        encode_str(buf, e)
+    return bytes(buf)
+
+
+def decode_datum(buf) -> TraceDatum:
+    pid_tgid, flags, nargs, nenvs = RECORD_FIXED.unpack_from(buf, 0)
+    pos = RECORD_FIXED.size
+
+    d = TraceDatum()
+    d.pid_tgid = pid_tgid
+    d.flags = flags
+    d.comm, pos = decode_str(buf, pos)
+    d.file_path, pos = decode_str(buf, pos)
+    d.working_dir, pos = decode_str(buf, pos)
+    for _ in range(nargs):
+        a, pos = decode_str(buf, pos)
+        d.args.append(a)
+    for _ in range(nenvs):
+        e, pos = decode_str(buf, pos)
+        d.envs.append(intern_str(e))
+
+    # same as the YAML schema, which has False for missing values
+    d.comm = intern_str(d.comm) or False
+    d.file_path = intern_str(d.file_path) or False
+    d.working_dir = intern_str(d.working_dir) or False
+
+    return d
+
+
+def open_binary(path: str):
+    with open(path, 'rb') as f:
+        compressed = f.read(2) == GZIP_MAGIC
+
+    if compressed:
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+class BinaryTraceReader:
+    # Same interface as TraceReader. A record cut short at the end of the
+    # file, e.g. by a crash of the tracer, ends the iteration and sets
+    # `truncated`.
+
+    def __init__(self, path: str):
+        self.path = path
+        self.header = {}
+        self.count = 0
+        self.truncated = False
+
+
+    @property
+    def package(self) -> str:
+        return self.header.get('package', '')
+
+
+    @property
+    def version(self) -> str:
+        return self.header.get('version', '')
+
+
+    def read_record(self, f):
+        try:
+            n = f.read(U32.size)
+            if len(n) < U32.size:
+                self.truncated = len(n) != 0
+                return None
+            (n,) = U32.unpack(n)
+            buf = f.read(n)
+        except EOFError:
+            # gzip stream without its trailer
+            self.truncated = True
+            return None
+        if len(buf) < n:
+            self.truncated = True
+            return None
+        return buf
+
+
+    def read_preamble(self, f):
+        magic = f.read(len(TRACE_MAGIC))
+        if magic != TRACE_MAGIC:
+            raise ValueError(f'{self.path} is not a binary trace file')
+        (fmt,) = U32.unpack(f.read(U32.size))
+        if fmt != TRACE_FORMAT_VERSION:
+            raise ValueError(f'{self.path}: unsupported format version {fmt}')
+        header = self.read_record(f)
+        if header is None:
+            raise ValueError(f'{self.path}: missing header')
+        self.header = json.loads(header)
+
+
+    def read_header(self):
+        with open_binary(self.path) as f:
+            self.read_preamble(f)
+        return self.header
+
+
+    def __iter__(self):
+        with open_binary(self.path) as f:
+            self.read_preamble(f)
+            while True:
+                buf = self.read_record(f)
+                if buf is None:
+                    break
+                self.count += 1
+                yield decode_datum(buf)
+
+
+class BinaryTraceWriter:
+
+    def __init__(self, path: str, header: dict):
+        self.path = path
+        self.count = 0
+        self.raw = open(path, 'wb')
+        self.f = self.raw
+        if path.endswith('.gz'):
+            self.f = gzip.GzipFile(fileobj=self.raw, mode='wb', compresslevel=6)
+        h = json.dumps(header).encode('utf-8')
+        self.f.write(TRACE_MAGIC + U32.pack(TRACE_FORMAT_VERSION) + U32.pack(len(h)) + h)
+
+
+    def write(self, d: TraceDatum):
+        buf = encode_datum(d)
+        self.f.write(U32.pack(len(buf)) + buf)
+        self.count += 1
+
+
+    def flush(self):
+        # also a sync flush point for gzip, the data so far stays readable
+        self.f.flush()
+
+
+    def close(self):
+        if self.f is not self.raw:
+            self.f.close()
+        self.raw.flush()
+        os.fsync(self.raw.fileno())
+        self.raw.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class YamlTraceWriter:
+    # Writes the same document as yaml.dump() of
+    # {'package': ..., 'version': ..., 'data': [...]},
+    # but one datum at a time and with the header first.
+
+    def __init__(self, path: str, header: dict):
+        self.path = path
+        self.count = 0
+        self.f = open(path, 'w')
+        yaml.dump(header, self.f, Dumper=TraceDumper, sort_keys=False)
+        self.f.write('data:')
+
+
+    def write(self, d: TraceDatum):
+        if self.count == 0:
+            self.f.write('\n')
+        yaml.dump([d], self.f, Dumper=TraceDumper)
+        self.count += 1
+
+
+    def close(self):
+        if self.count == 0:
+            self.f.write(' []\n')
+        self.f.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def is_binary_path(path: str) -> bool:
+    return path.endswith(TRACE_EXT) or path.endswith(TRACE_EXT + '.gz')
+
+
+def open_trace(path: str):
+    with open(path, 'rb') as f:
+        magic = f.read(len(TRACE_MAGIC))
+
+    if magic == TRACE_MAGIC or magic.startswith(GZIP_MAGIC):
+        return BinaryTraceReader(path)
+    return TraceReader(path)
+
+
+def open_trace_writer(path: str, header: dict, fmt: str = None):
+    # `fmt` is 'yaml' or 'bin', by default derived from the file name
+    if fmt is None:
+        fmt = 'bin' if is_binary_path(path) else 'yaml'
+
+    if fmt == 'bin':
+        return BinaryTraceWriter(path, header)
+    return YamlTraceWriter(path, header)
@@ -0,0 +1,398 @@
+#! /usr/bin/env python3
+
+import os
+import time
+import yaml
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from collections import Counter
+from typing import Iterable
+from trace_datum import *
+from trace_io import *
+from exec_rules import *
+from arg_classify import *
+from dataset_io import *
+
+
+def batched(data: Iterable, n: int):
+    it = iter(data)
+    while True:
+        batch = list(itertools.islice(it, n))
+        if batch == []:
+            return
+        yield batch
+
+
+class ExecBatch:
+    # Columns of the execs that passed the filter, as the sinks get them.
+    # `args` is None when no sink needs them.
+
+    def __init__(self, exes: list[str], flags: list[int], args: list[list] = None):
+        self.exes = exes
+        self.flags = flags
+        self.args = args
+
+
+    def __len__(self):
+        return len(self.exes)
+
+
+    def flag(self, flag: int) -> list[bool]:
+        mask = 1 << flag
+        return [f & mask == mask for f in self.flags]
+
+
+class FuzzSink:
+    # the fuzz dataset, one entry per exec. With a `writer` the entries go
+    # straight to it rather than to `results`.
+    name = 'fuzz'
+    needs_args = True
+    streams = True
+
+    def __init__(self, classifier: ArgClassifier = None, writer: DatasetWriter = None):
+        self.classifier = classifier or ArgClassifier()
+        self.writer = writer
+        self.results = []
+
+
+    def add(self, batch: ExecBatch):
+        classified = self.classifier.classify_batch(a[1:] for a in batch.args)
+        results = [] if self.writer is not None else self.results
+        for exe, incomplete_args, incomplete_envs, raw_args, args_classified in zip(
+                batch.exes, batch.flag(F_INCOMPLETE_ARGS), batch.flag(F_INCOMPLETE_ENVS),
+                batch.args, classified):
+            # fuzz data should not be deduplicated
+            results.append({ exe : [incomplete_args,
+                                         incomplete_envs,
+                                         { 'raw_args' : raw_args,
+                                           'classified_args' : [{ kind : arg } for kind, arg in args_classified] }]})
+        if self.writer is not None:
+            self.writer.write_many(results)
+
+
+    def result(self, pipeline: 'Pipeline'):
+        return self.results
+
+
+class PerfSink:
+    # the perf dataset, every distinct executable once
+    name = 'perf'
+    needs_args = False
+    streams = False
+
+    def __init__(self):
+        self.exes = set()
+
+
+    def add(self, batch: ExecBatch):
+        self.exes.update(batch.exes)
+
+
+    def result(self, pipeline: 'Pipeline'):
+        return list(self.exes)
+
+
+class StatsSink:
+    # counts of a run, to see what a trace holds without reading the datasets
+    name = 'stats'
+    needs_args = False
+    streams = False
+
+    def __init__(self):
+        self.execs = 0
+        self.per_exe = Counter()
+        self.flag_counts = [0] * len(G_FLAG_NAMES)
+
+
+    def add(self, batch: ExecBatch):
+        self.execs += len(batch)
+        self.per_exe.update(batch.exes)
+        for flags in batch.flags:
+            if flags:
+                for f in range(len(self.flag_counts)):
+                    if flags & (1 << f):
+                        self.flag_counts[f] += 1
+
+
+    def result(self, pipeline: 'Pipeline'):
+        return { 'package'  : pipeline.header.get('package', ''),
+                 'version'  : pipeline.header.get('version', ''),
+                 'env_mode' : pipeline.header.get('env_mode', 'all'),
+                 'records'  : pipeline.records,
+                 'execs'    : self.execs,
+                 'exes'     : len(self.per_exe),
+                 'flags'    : dict(zip(G_FLAG_NAMES, self.flag_counts)),
+                 'execs_per_exe' : dict(self.per_exe.most_common()) }
+
+
+class Pipeline:
+    # One pass over a raw trace: check_fields(), path resolution and the
+    # rules of `matcher`, then each sink gets the execs that are left in
+    # batches of `batch_size`. A sink has a `name`, `needs_args`, `streams`,
+    # add() and result(), see the sinks above.
+    #
+    # The datasets are written to `output_dir` in `fmt`, compressed with
+    # `compress`. With `stream` the sinks that can write theirs while the
+    # trace is read, to a temporary file that write() renames. With `index`
+    # streamed datasets also get the sidecar index of DatasetReader.
+
+    def __init__(self, matcher: ExecMatcher, sinks: list, batch_size: int = 4096,
+                 output_dir: str = '.', fmt: str = 'yaml', compress: str = None,
+                 stream: bool = False, index: bool = False):
+        self.matcher = matcher
+        self.sinks = sinks
+        self.batch_size = batch_size
+        self.output_dir = output_dir
+        self.fmt = fmt
+        self.compress = compress
+        self.records = 0
+        self.header = {}
+
+        if stream:
+            for sink in sinks:
+                if sink.streams and sink.writer is None:
+                    sink.writer = temporary_writer(output_dir, fmt, compress, index)
+
+
+    def resolve_paths(self, data: Iterable[TraceDatum]):
+        # callees as absolute, normalized paths, datums that are filtered out are dropped
+        resolve = self.matcher.resolve
+        for d in data:
+            self.records += 1
+            if not d.check_fields():
+                continue
+            exe, keep = resolve(d.working_dir, d.file_path)
+            if keep:
+                d.file_path = exe
+                yield d
+
+
+    def feed(self, batch: ExecBatch):
+        for sink in self.sinks:
+            sink.add(batch)
+
+
+    def run(self, data: Iterable[TraceDatum], columnar: bool = False):
+        # `data` is a trace reader or any iterable of TraceDatum
+        with_args = any(sink.needs_args for sink in self.sinks)
+
+        try:
+            if columnar and isinstance(data, BinaryTraceReader):
+                self.run_columnar(data, with_args)
+            else:
+                for datums in batched(self.resolve_paths(data), self.batch_size):
+                    self.feed(ExecBatch([d.file_path for d in datums],
+                                        [d.flags for d in datums],
+                                        [d.args for d in datums] if with_args else None))
+        except BaseException:
+            self.discard()
+            raise
+
+        # complete only now for traces that have it after `data`
+        self.header = getattr(data, 'header', {})
+
+
+    def run_columnar(self, data: BinaryTraceReader, with_args: bool):
+        # Filtering and dedup run on a TraceTable, needs numpy. It is loaded
+        # without a TraceDatum per record, which is what makes it faster, so
+        # other traces always take the default path.
+        from trace_table import TraceTable
+
+        table = TraceTable.from_binary(data, with_args)
+        self.records += len(table)
+        rows = table.resolve(self.matcher)
+        for start in range(0, len(rows), self.batch_size):
+            r = rows[start:start + self.batch_size]
+            self.feed(ExecBatch(table.exe_paths(r),
+                                table.flags[r].tolist(),
+                                table.args_of(r) if with_args else None))
+
+
+    def run_file(self, path: str, columnar: bool = False):
+        data = open_trace(path)
+        self.run(data, columnar)
+        return data
+
+
+    def results(self) -> dict:
+        return { sink.name : sink.result(self) for sink in self.sinks }
+
+
+    def streamed(self) -> list:
+        return [sink for sink in self.sinks if getattr(sink, 'writer', None) is not None]
+
+
+    def discard(self):
+        # drop the temporary files of streamed datasets
+        for sink in self.streamed():
+            sink.writer.discard()
+            sink.writer = None
+
+
+    def write(self, package: str, version: str) -> dict:
+        # each result to `{package}-{version}-{name}`, returns the paths
+        paths = {}
+        ext = dataset_ext(self.fmt, self.compress)
+        for sink in self.sinks:
+            path = output_path(self.output_dir, package, version, sink.name) + ext
+            if getattr(sink, 'writer', None) is not None:
+                sink.writer.close()
+                os.replace(sink.writer.path, path)
+                if sink.writer.index is not None:
+                    sink.writer.write_index(path)
+            else:
+                write_dataset(path, sink.result(self), self.fmt)
+            paths[sink.name] = path
+        return paths
+
+
+# Batch mode: many rawfiles on a process pool
+
+RAWFILE_EXTS = ['.yaml', '.yml', TRACE_EXT, TRACE_EXT + '.gz']
+
+
+def output_path(output_dir: str, package: str, version: str, name: str) -> str:
+    return os.path.join(output_dir, f'{package}-{version}-{name}')
+
+
+def find_rawfiles(path: str) -> list[tuple[str, str]]:
+    # (rawfile, refinement) of a directory of traces or of a manifest with
+    # a rawfile and optionally its refinement per line, relative to the
+    # manifest. A missing refinement is looked up later as
+    # {package}_{version}.refinement next to the rawfile, as perf-wrapper
+    # names it.
+    if os.path.isdir(path):
+        return [(os.path.join(path, f), None) for f in sorted(os.listdir(path))
+                if any(f.endswith(ext) for ext in RAWFILE_EXTS)
+                and os.path.isfile(os.path.join(path, f))]
+
+    jobs = []
+    base = os.path.dirname(path)
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line == '' or line.startswith('#'):
+                continue
+            parts = line.split()
+            rawfile = os.path.join(base, parts[0])
+            refinement = os.path.join(base, parts[1]) if len(parts) > 1 else None
+            jobs.append((rawfile, refinement))
+    return jobs
+
+
+def up_to_date(outputs: list[str], inputs: list[str]) -> bool:
+    try:
+        oldest = min(os.path.getmtime(o) for o in outputs)
+    except OSError:
+        return False
+    return all(os.path.getmtime(i) <= oldest for i in inputs)
+
+
+def job_result(rawfile: str, error: str = '') -> dict:
+    return { 'rawfile' : rawfile, 'status' : 'failed', 'records' : 0, 'seconds' : 0.0,
+             'bytes' : 0, 'error' : error }
+
+
+def run_job(rawfile: str, refinement: str, rules: str, output_dir: str,
+            columnar: bool = False, stats: bool = False, force: bool = False,
+            fmt: str = 'yaml', compress: str = None, index: bool = False,
+            header: dict = None) -> dict:
+    # what datagen.py does for one rawfile, in a pool worker. `header` is
+    # that of the rawfile if it was read already.
+    result = job_result(rawfile)
+    start = time.monotonic()
+
+    try:
+        result['bytes'] = os.path.getsize(rawfile)
+        if header is None:
+            header = open_trace(rawfile).read_header()
+        package = header.get('package', '')
+        version = header.get('version', '')
+        result['package'] = package
+        result['version'] = version
+
+        if refinement is None:
+            guess = os.path.join(os.path.dirname(rawfile), f'{package}_{version}.refinement')
+            if os.path.isfile(guess):
+                refinement = guess
+
+        names = ['fuzz', 'perf'] + (['stats'] if stats else [])
+        outputs = [output_path(output_dir, package, version, n) + dataset_ext(fmt, compress)
+                   for n in names]
+        if index:
+            outputs.append(index_path(outputs[0]))
+        inputs = [rawfile, rules] + ([refinement] if refinement is not None else [])
+        if not force and up_to_date(outputs, inputs):
+            result['status'] = 'skipped'
+            return result
+
+        true_exes = []
+        if refinement is not None:
+            with open(refinement, 'r') as f:
+                true_exes = yaml.load(f, Loader=yaml.Loader) or []
+
+        sinks = [FuzzSink(), PerfSink()] + ([StatsSink()] if stats else [])
+        pipeline = Pipeline(load_matcher(rules, true_exes), sinks, output_dir=output_dir,
+                            fmt=fmt, compress=compress, stream=True, index=index)
+        pipeline.run_file(rawfile, columnar)
+        pipeline.write(package, version)
+
+        result['records'] = pipeline.records
+        result['status'] = 'done'
+    except Exception as e:
+        result['error'] = f'{type(e).__name__}: {e}'
+    finally:
+        result['seconds'] = time.monotonic() - start
+
+    return result
+
+
+def read_header(rawfile: str) -> dict:
+    return open_trace(rawfile).read_header()
+
+
+def read_headers(jobs: list[tuple[str, str]], pool) -> dict:
+    # rawfile -> header, read on `pool` as a legacy YAML trace without its
+    # header at the end is read whole. Rawfiles that cannot be read are
+    # left to their job.
+    futures = { pool.submit(read_header, rawfile) : rawfile for rawfile, _ in jobs }
+    headers = {}
+    for future in as_completed(futures):
+        try:
+            headers[futures[future]] = future.result()
+        except Exception:
+            pass
+    return headers
+
+
+def run_batch(jobs: list[tuple[str, str]], workers: int, **options):
+    # results of run_job() in the order they complete. Workers are forked,
+    # the CLIs run their main code at import and must not be re-imported.
+    #
+    # Rawfiles of the same package and version would write the same
+    # datasets, they all fail rather than overwrite each other. The headers
+    # are read first for that, each only once.
+    context = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        headers = read_headers(jobs, pool)
+        same = {}
+        for rawfile, _ in jobs:
+            if rawfile in headers:
+                h = headers[rawfile]
+                same.setdefault((h.get('package', ''), h.get('version', '')), []).append(rawfile)
+        duplicates = {}
+        for (package, version), rawfiles in same.items():
+            if len(rawfiles) > 1:
+                for rawfile in rawfiles:
+                    duplicates[rawfile] = (f'{package}-{version} is also the package of '
+                                           f'{", ".join(r for r in rawfiles if r != rawfile)}')
+
+        for rawfile, _ in jobs:
+            if rawfile in duplicates:
+                yield job_result(rawfile, duplicates[rawfile])
+
+        futures = [pool.submit(run_job, rawfile, refinement, header=headers.get(rawfile), **options)
+                   for rawfile, refinement in jobs if rawfile not in duplicates]
+        for future in as_completed(futures):
+            yield future.result()
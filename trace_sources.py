@@ -0,0 +1,245 @@
+#! /usr/bin/env python3
+
+import time
+import struct
+from trace_events import *
+from exec_rules import ExecRules
+
+
+# Kinds of ring buffer records, indexing RING_BUFFERS
+EVENT_BASIC     = 0
+EVENT_ARG       = 1
+EVENT_ENV       = 2
+EVENT_PATH_PART = 3
+EVENT_PACKED    = 4
+
+RING_BUFFERS = ['events_basic', 'events_arg', 'events_env', 'events_path_part', 'events_packed']
+
+# Captured events: magic, then a kind and a size before each raw record
+CAPTURE_MAGIC = b'BCCEVENT'
+CAPTURE_RECORD = struct.Struct('<BI')
+
+# sizeof() of the structs in bcc-execve.c, as submitted by the kernel
+BASIC_RECORD_SIZE = 288
+ARG_RECORD_SIZE = PID_TGID.size + MAX_STR_SIZE
+PATH_PART_RECORD_SIZE = PID_TGID.size + MAX_PATH_READ
+
+
+def record_method(consumer, kind: int):
+    return [consumer.record_basic,
+            consumer.record_arg,
+            consumer.record_env,
+            consumer.record_path_part,
+            consumer.record_packed][kind]
+
+
+class EventCapture:
+    # Saves raw records as they arrive, for ReplayEventSource
+
+    def __init__(self, path: str):
+        self.path = path
+        self.f = open(path, 'wb')
+        self.f.write(CAPTURE_MAGIC)
+
+
+    def write(self, kind: int, buf):
+        self.f.write(CAPTURE_RECORD.pack(kind, len(buf)))
+        self.f.write(buf)
+
+
+    def close(self):
+        self.f.close()
+
+
+def read_capture(path: str):
+    with open(path, 'rb') as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f'{path} is not an event capture')
+        while True:
+            head = f.read(CAPTURE_RECORD.size)
+            if len(head) < CAPTURE_RECORD.size:
+                return
+            kind, size = CAPTURE_RECORD.unpack(head)
+            buf = f.read(size)
+            if len(buf) < size:
+                return
+            yield kind, buf
+
+
+def pack_record(pid_tgid: int, s: bytes, size: int) -> bytes:
+    return (PID_TGID.pack(pid_tgid) + s + b'\0').ljust(size, b'\0')
+
+
+def synthetic_events(execs: int, args: int = 8, envs: int = 40, depth: int = 5):
+    # Records in the order the split capture submits them:
+    # args, envs and the working dir leaf first, then the basic record.
+    env = [f'RPM_BUILD_VAR_{i}=/home/abuild/rpmbuild/BUILD/value{i}'.encode() for i in range(envs)]
+    path = [f'dir{i}'.encode() for i in range(depth)]
+    for n in range(execs):
+        pid_tgid = ((n + 1) * 2654435761) & 0xffffffffffffffff
+        exe = f'./tool{n % 97}'.encode()
+        yield EVENT_ARG, pack_record(pid_tgid, exe, ARG_RECORD_SIZE)
+        for i in range(1, args):
+            yield EVENT_ARG, pack_record(pid_tgid, f'--option{i}={n}'.encode(), ARG_RECORD_SIZE)
+        for e in env:
+            yield EVENT_ENV, pack_record(pid_tgid, e, ARG_RECORD_SIZE)
+        for p in path:
+            yield EVENT_PATH_PART, pack_record(pid_tgid, p, PATH_PART_RECORD_SIZE)
+        basic = BASIC_HEAD.pack(pid_tgid, 0) + b'make'.ljust(TASK_COMM_LEN, b'\0') + exe
+        yield EVENT_BASIC, basic.ljust(BASIC_RECORD_SIZE, b'\0')
+
+
+class BccEventSource:
+    # Events from the BPF program in bcc-execve.c
+    #
+    # Each poll blocks on the ring buffers' epoll fd for at most `timeout`
+    # ms, then keeps consuming without blocking while events come in, up to
+    # `max_batch` of them. The timeout drops to `min_timeout` as soon as
+    # there is traffic, so that completed execs are flushed and orphans
+    # evicted promptly, and doubles up to `max_timeout` while idle.
+    #
+    # With `prefilter` rules, execs they match are reduced to their basic
+    # record by the kernel. The env capture mode is that of the consumer.
+
+    def __init__(self, consumer, src_file: str = 'bcc-execve.c', packed: bool = False,
+                 capture: EventCapture = None, min_timeout: int = 10,
+                 max_timeout: int = 1000, max_batch: int = 65536,
+                 prefilter: ExecRules = None):
+        # only needed here, everything else runs without BCC and root
+        from bcc import BPF
+
+        self.consumer = consumer
+        self.capture = capture
+        self.done = False
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.max_batch = max_batch
+        self.timeout = min_timeout
+
+        cflags = []
+        if packed:
+            cflags.append('-DPACKED_RECORD')
+        if prefilter is not None:
+            cflags.append('-DPREFILTER')
+        cflags.append(f'-DENV_MODE={ENV_MODES.index(consumer.env_mode)}')
+        self.b = BPF(src_file=src_file, cflags=cflags)
+
+        if packed:
+            kinds = [EVENT_PACKED]
+        else:
+            # If things go well, events_basic is the last callback
+            # in a sequence of events during an execve().
+            kinds = [EVENT_BASIC, EVENT_ARG, EVENT_ENV, EVENT_PATH_PART]
+
+        if prefilter is not None:
+            self.load_prefilter(prefilter)
+        if consumer.env_mode == 'allowlist':
+            allowlist = self.b['env_allowlist']
+            for name in consumer.env_allowlist:
+                h = env_name_hash(name.encode('utf-8'))
+                allowlist[allowlist.Key(h)] = allowlist.Leaf(1)
+
+        for kind in kinds:
+            self.b[RING_BUFFERS[kind]].open_ring_buffer(self.callback(kind))
+
+
+    def load_prefilter(self, rules: ExecRules):
+        prefixes = self.b['prefilter_prefixes']
+        for p in rules.kernel_prefixes():
+            key = prefixes.Key()
+            key.prefixlen = len(p) * 8
+            key.data = p
+            prefixes[key] = prefixes.Leaf(1)
+
+        suffixes = self.b['prefilter_suffixes']
+        for i, p in enumerate(rules.kernel_suffixes()):
+            leaf = suffixes.Leaf()
+            leaf.len = len(p)
+            leaf.data = p
+            suffixes[suffixes.Key(i)] = leaf
+
+
+    def callback(self, kind: int):
+        record = record_method(self.consumer, kind)
+        capture = self.capture
+
+        if capture is None:
+            def cb(ctx, data, size):
+                record(record_view(data, size), 0)
+        else:
+            def cb(ctx, data, size):
+                view = record_view(data, size)
+                capture.write(kind, view)
+                record(view, 0)
+
+        return cb
+
+
+    def poll(self):
+        consumer = self.consumer
+        start = consumer.received()
+
+        self.b.ring_buffer_poll(self.timeout)
+        n = consumer.received()
+        while n != start and n - start < self.max_batch:
+            self.b.ring_buffer_consume()
+            last, n = n, consumer.received()
+            if n == last:
+                break
+
+        consumer.flush()
+
+        if n == start:
+            self.timeout = min(self.timeout * 2, self.max_timeout)
+        else:
+            self.timeout = self.min_timeout
+
+
+    def dropped(self) -> int:
+        # execs whose events_basic record could not be reserved
+        return self.b['drop_counts'][0].value
+
+
+class ReplayEventSource:
+    # Feeds captured or synthetic (kind, record) pairs to the consumer,
+    # `rate` events per second, or as fast as it takes them if 0.
+    # Each poll hands over up to `batch` events that are due.
+    # `batch_time` is when the first event of the last poll was due.
+
+    def __init__(self, consumer, events, rate: float = 0, batch: int = 256):
+        self.consumer = consumer
+        self.events = iter(events)
+        self.rate = rate
+        self.batch = batch
+        self.done = False
+        self.sent = 0
+        self.started = None
+        self.batch_time = 0.0
+
+
+    def poll(self):
+        now = time.monotonic()
+        if self.started is None:
+            self.started = now
+
+        n = self.batch
+        if self.rate > 0:
+            due = self.started + self.sent / self.rate
+            if due > now:
+                time.sleep(due - now)
+            self.batch_time = due
+            n = min(n, max(1, int((time.monotonic() - self.started) * self.rate) - self.sent))
+        else:
+            self.batch_time = now
+
+        consumer = self.consumer
+        for _ in range(n):
+            event = next(self.events, None)
+            if event is None:
+                self.done = True
+                break
+            kind, buf = event
+            record_method(consumer, kind)(buf, 0)
+            self.sent += 1
+
+        consumer.flush()
@@ -0,0 +1,346 @@
+#! /usr/bin/env python3
+
+import os
+import sys
+import json
+import sqlite3
+import itertools
+from trace_datum import *
+from trace_io import *
+from dataset_io import read_dataset, dataset_name
+
+
+# Raw traces and fuzz datasets in one SQLite database. Args, envs and
+# classified args have a row each with their position, missing values of a
+# TraceDatum are NULL. Values that are not UTF-8 are BLOBs, see db_value().
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS traces (
+    id          INTEGER PRIMARY KEY,
+    source      TEXT NOT NULL,
+    package     TEXT,
+    version     TEXT,
+    header      TEXT NOT NULL,
+    records     INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS execs (
+    id          INTEGER PRIMARY KEY,
+    trace_id    INTEGER NOT NULL REFERENCES traces(id),
+    pid_tgid    INTEGER,
+    comm        TEXT,
+    file_path   TEXT,
+    working_dir TEXT,
+    flags       INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS args (
+    exec_id     INTEGER NOT NULL REFERENCES execs(id),
+    pos         INTEGER NOT NULL,
+    value,
+    PRIMARY KEY (exec_id, pos)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS envs (
+    exec_id     INTEGER NOT NULL REFERENCES execs(id),
+    pos         INTEGER NOT NULL,
+    value,
+    PRIMARY KEY (exec_id, pos)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS datasets (
+    id          INTEGER PRIMARY KEY,
+    source      TEXT NOT NULL,
+    package     TEXT,
+    version     TEXT,
+    records     INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS fuzz (
+    id              INTEGER PRIMARY KEY,
+    dataset_id      INTEGER NOT NULL REFERENCES datasets(id),
+    exe             TEXT NOT NULL,
+    incomplete_args INTEGER NOT NULL,
+    incomplete_envs INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS fuzz_args (
+    fuzz_id     INTEGER NOT NULL REFERENCES fuzz(id),
+    pos         INTEGER NOT NULL,
+    value,
+    PRIMARY KEY (fuzz_id, pos)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS classified_args (
+    fuzz_id     INTEGER NOT NULL REFERENCES fuzz(id),
+    pos         INTEGER NOT NULL,
+    kind        TEXT NOT NULL,
+    value,
+    PRIMARY KEY (fuzz_id, pos)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS execs_trace       ON execs(trace_id);
+CREATE INDEX IF NOT EXISTS execs_file_path   ON execs(file_path);
+CREATE INDEX IF NOT EXISTS execs_comm        ON execs(comm);
+CREATE INDEX IF NOT EXISTS execs_working_dir ON execs(working_dir);
+CREATE INDEX IF NOT EXISTS execs_flags       ON execs(flags);
+CREATE INDEX IF NOT EXISTS args_value        ON args(value);
+CREATE INDEX IF NOT EXISTS fuzz_dataset      ON fuzz(dataset_id);
+CREATE INDEX IF NOT EXISTS fuzz_exe          ON fuzz(exe);
+CREATE INDEX IF NOT EXISTS classified_kind   ON classified_args(kind, value);
+'''
+
+IMPORT_CHUNK = 10000
+# before the bytes of a str with surrogate escapes, no arg, env or path
+# has a NUL
+ESCAPED_STR = b'\0'
+
+
+def db_value(s):
+    # Args and envs that failed to decode are bytes, and are stored as they
+    # are. SQLite cannot store the lone surrogates of strs that have them,
+    # e.g. those of a binary trace, those are stored as their bytes after
+    # ESCAPED_STR.
+    if s is False or s is None:
+        return None
+    if type(s) is str and not s.isascii():
+        try:
+            s.encode('utf-8')
+        except UnicodeEncodeError:
+            return ESCAPED_STR + s.encode('utf-8', 'surrogateescape')
+    return s
+
+
+def py_value(v):
+    # inverse of db_value() for args and envs, NULL aside
+    if type(v) is bytes and v.startswith(ESCAPED_STR):
+        return v[len(ESCAPED_STR):].decode('utf-8', 'surrogateescape')
+    return v
+
+
+def py_str(s):
+    # inverse of db_value() for the TEXT columns, which never hold bytes
+    if s is None:
+        return False
+    if type(s) is bytes:
+        s = s.removeprefix(ESCAPED_STR).decode('utf-8', 'surrogateescape')
+    return sys.intern(s)
+
+
+class TraceStore:
+
+    def __init__(self, path: str):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.execute('PRAGMA synchronous = NORMAL')
+        self.db.executescript(SCHEMA)
+
+
+    def close(self):
+        self.db.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+    def next_id(self, table: str) -> int:
+        (n,) = self.db.execute(f'SELECT coalesce(max(id), 0) + 1 FROM {table}').fetchone()
+        return n
+
+
+    def import_trace(self, reader, source: str) -> int:
+        # One transaction, an import that fails leaves nothing behind.
+        # Returns the id of the trace.
+        header = dict(reader.read_header())
+        db = self.db
+        with db:
+            cur = db.execute('INSERT INTO traces (source, package, version, header) VALUES (?, ?, ?, ?)',
+                             (source, header.get('package'), header.get('version'), '{}'))
+            trace_id = cur.lastrowid
+            exec_id = self.next_id('execs')
+            records = 0
+
+            it = iter(reader)
+            while True:
+                chunk = list(itertools.islice(it, IMPORT_CHUNK))
+                if chunk == []:
+                    break
+                execs = []
+                args = []
+                envs = []
+                for d in chunk:
+                    d.prepare()
+                    execs.append((exec_id, trace_id, d.pid_tgid or None, db_value(d.comm),
+                                  db_value(d.file_path), db_value(d.working_dir), d.flags))
+                    args.extend((exec_id, i, db_value(a)) for i, a in enumerate(d.args))
+                    envs.extend((exec_id, i, db_value(e)) for i, e in enumerate(d.envs))
+                    exec_id += 1
+                db.executemany('INSERT INTO execs VALUES (?, ?, ?, ?, ?, ?, ?)', execs)
+                db.executemany('INSERT INTO args VALUES (?, ?, ?)', args)
+                db.executemany('INSERT INTO envs VALUES (?, ?, ?)', envs)
+                records += len(chunk)
+
+            # older YAML traces have the header after the data
+            header.update(reader.header)
+            db.execute('UPDATE traces SET package = ?, version = ?, header = ?, records = ? WHERE id = ?',
+                       (header.get('package'), header.get('version'), json.dumps(header),
+                        records, trace_id))
+        return trace_id
+
+
+    def import_dataset(self, path: str, package: str = None, version: str = None) -> int:
+        # a fuzz dataset of datagen, package and version from its name
+        # unless given. Returns the id of the dataset.
+        if package is None or version is None:
+            p, v = dataset_name(path)
+            package = p if package is None else package
+            version = v if version is None else version
+
+        db = self.db
+        with db:
+            cur = db.execute('INSERT INTO datasets (source, package, version) VALUES (?, ?, ?)',
+                             (path, package, version))
+            dataset_id = cur.lastrowid
+            fuzz_id = self.next_id('fuzz')
+            records = 0
+
+            it = read_dataset(path)
+            while True:
+                chunk = list(itertools.islice(it, IMPORT_CHUNK))
+                if chunk == []:
+                    break
+                fuzz = []
+                raw_args = []
+                classified = []
+                for record in chunk:
+                    ((exe, (incomplete_args, incomplete_envs, detail)),) = record.items()
+                    fuzz.append((fuzz_id, dataset_id, exe, incomplete_args, incomplete_envs))
+                    raw_args.extend((fuzz_id, i, db_value(a))
+                                    for i, a in enumerate(detail['raw_args']))
+                    for i, c in enumerate(detail['classified_args']):
+                        ((kind, arg),) = c.items()
+                        classified.append((fuzz_id, i, kind, db_value(arg)))
+                    fuzz_id += 1
+                db.executemany('INSERT INTO fuzz VALUES (?, ?, ?, ?, ?)', fuzz)
+                db.executemany('INSERT INTO fuzz_args VALUES (?, ?, ?)', raw_args)
+                db.executemany('INSERT INTO classified_args VALUES (?, ?, ?, ?)', classified)
+                records += len(chunk)
+
+            db.execute('UPDATE datasets SET records = ? WHERE id = ?', (records, dataset_id))
+        return dataset_id
+
+
+    def traces(self) -> list[tuple]:
+        # (id, source, package, version, records) of each trace
+        return self.db.execute('SELECT id, source, package, version, records FROM traces ORDER BY id').fetchall()
+
+
+    def datasets(self) -> list[tuple]:
+        return self.db.execute('SELECT id, source, package, version, records FROM datasets ORDER BY id').fetchall()
+
+
+    def latest_trace(self) -> int:
+        (n,) = self.db.execute('SELECT max(id) FROM traces').fetchone()
+        return n
+
+
+    def open_trace(self, trace_id: int, with_envs: bool = True) -> 'StoreTraceReader':
+        return StoreTraceReader(self, trace_id, with_envs)
+
+
+    # Common questions, as (trace_id, file_path, comm, working_dir) of
+    # the execs. Anything else is plain SQL on `db`.
+
+    def exec_rows(self, rows) -> list[tuple]:
+        # the paths that are not UTF-8 as str again
+        return [tuple(v if type(v) is not bytes else py_str(v) for v in row) for row in rows]
+
+
+    def execs_with_arg(self, arg: str) -> list[tuple]:
+        rows = self.db.execute('''SELECT DISTINCT e.trace_id, e.file_path, e.comm, e.working_dir
+                                  FROM args a JOIN execs e ON e.id = a.exec_id
+                                  WHERE a.value = ?''', (db_value(arg),))
+        return self.exec_rows(rows)
+
+
+    def execs_in(self, working_dir: str) -> list[tuple]:
+        rows = self.db.execute('''SELECT trace_id, file_path, comm, working_dir FROM execs
+                                  WHERE working_dir = ?''', (db_value(working_dir),))
+        return self.exec_rows(rows)
+
+
+    def execs_with_flag(self, flag: int) -> list[tuple]:
+        mask = 1 << flag
+        rows = self.db.execute('''SELECT trace_id, file_path, comm, working_dir FROM execs
+                                  WHERE flags & ? = ?''', (mask, mask))
+        return self.exec_rows(rows)
+
+
+class StoreTraceReader:
+    # Same interface as TraceReader, the execs of one trace of a TraceStore
+    # in the order they were imported. Args and envs are read in key order
+    # alongside the execs instead of a query per exec.
+
+    def __init__(self, store: TraceStore, trace_id: int, with_envs: bool = True):
+        self.store = store
+        self.trace_id = trace_id
+        self.with_envs = with_envs
+        self.header = {}
+        self.count = 0
+
+
+    @property
+    def package(self) -> str:
+        return self.header.get('package', '')
+
+
+    @property
+    def version(self) -> str:
+        return self.header.get('version', '')
+
+
+    def read_header(self):
+        row = self.store.db.execute('SELECT header FROM traces WHERE id = ?',
+                                    (self.trace_id,)).fetchone()
+        if row is None:
+            raise ValueError(f'{self.store.path}: no trace {self.trace_id}')
+        self.header = json.loads(row[0])
+        return self.header
+
+
+    def values(self, table: str, lo: int, hi: int):
+        # (exec_id, values) for the execs in [lo, hi] that have any
+        rows = self.store.db.execute(f'SELECT exec_id, value FROM {table} '
+                                     'WHERE exec_id BETWEEN ? AND ? ORDER BY exec_id, pos', (lo, hi))
+        for exec_id, group in itertools.groupby(rows, key=lambda r: r[0]):
+            yield exec_id, [v if type(v) is not bytes else py_value(v) for _, v in group]
+
+
+    def __iter__(self):
+        self.read_header()
+        db = self.store.db
+        lo, hi = db.execute('SELECT min(id), max(id) FROM execs WHERE trace_id = ?',
+                            (self.trace_id,)).fetchone()
+        if lo is None:
+            return
+
+        args = self.values('args', lo, hi)
+        envs = self.values('envs', lo, hi) if self.with_envs else iter(())
+        next_args = next(args, None)
+        next_envs = next(envs, None)
+
+        for exec_id, pid_tgid, comm, file_path, working_dir, flags in db.execute(
+                'SELECT id, pid_tgid, comm, file_path, working_dir, flags FROM execs '
+                'WHERE trace_id = ? ORDER BY id', (self.trace_id,)):
+            d = TraceDatum()
+            d.pid_tgid = pid_tgid or False
+            d.comm = py_str(comm)
+            d.file_path = py_str(file_path)
+            d.working_dir = py_str(working_dir)
+            d.flags = flags
+            if next_args is not None and next_args[0] == exec_id:
+                d.args = next_args[1]
+                next_args = next(args, None)
+            if next_envs is not None and next_envs[0] == exec_id:
+                d.envs = [intern_str(e) for e in next_envs[1]]
+                next_envs = next(envs, None)
+            self.count += 1
+            yield d
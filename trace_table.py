@@ -0,0 +1,186 @@
+#! /usr/bin/env python3
+
+import numpy as np
+from array import array
+from trace_datum import *
+from trace_io import *
+
+
+class StringDict:
+    # dictionary encoding of a string column, whole chunks at a time
+
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+
+    def __len__(self):
+        return len(self.values)
+
+
+    def encode(self, column: list) -> map:
+        codes = self.codes
+        for s in dict.fromkeys(column):
+            if s not in codes:
+                codes[s] = len(self.values)
+                self.values.append(s)
+        return map(codes.__getitem__, column)
+
+
+    def decode(self, fn):
+        # values that were encoded as they came, e.g. as raw bytes, to `fn` of them
+        self.values = list(map(fn, self.values))
+        self.codes = { v : i for i, v in enumerate(self.values) }
+
+
+    def present(self) -> np.ndarray:
+        # values that are not the False or '' of a missing TraceDatum field
+        return np.array([bool(s) for s in self.values], dtype=bool)
+
+
+class TraceTable:
+    # Binary trace data as columns, one row per exec. comm, file_path and
+    # working_dir are codes into StringDicts, missing values included.
+    # The args of row i are arg_codes[arg_offsets[i]:arg_offsets[i + 1]].
+    # Envs are not kept, the analysis never looks at them.
+    #
+    # Checking, resolving and filtering run on the distinct
+    # (file_path, working_dir) pairs and are mapped back to the rows
+    # with NumPy, instead of once per TraceDatum.
+
+    def __init__(self):
+        self.comms = StringDict()
+        self.paths = StringDict()
+        self.dirs = StringDict()
+        self.args = StringDict()
+        # resolved absolute paths, see resolve()
+        self.exes = StringDict()
+
+        self.pid_tgid = np.zeros(0, dtype=np.uint64)
+        self.flags = np.zeros(0, dtype=np.uint32)
+        self.comm = np.zeros(0, dtype=np.int32)
+        self.file_path = np.zeros(0, dtype=np.int32)
+        self.working_dir = np.zeros(0, dtype=np.int32)
+        self.arg_codes = np.zeros(0, dtype=np.int32)
+        self.arg_offsets = np.zeros(1, dtype=np.int64)
+        self.exe = np.zeros(0, dtype=np.int32)
+
+
+    def __len__(self):
+        return len(self.pid_tgid)
+
+
+    @classmethod
+    def from_binary(cls, reader: BinaryTraceReader, with_args: bool = True,
+                    chunk: int = 65536) -> 'TraceTable':
+        # Straight from the records of a binary trace, without a TraceDatum
+        # per record. The strings are encoded as the bytes of the record,
+        # length included so that raw ones stay apart, and only the
+        # distinct ones are decoded at the end. Envs are skipped unread.
+        t = cls()
+        pid_tgid = array('Q')
+        flags = array('I')
+        comm = array('i')
+        file_path = array('i')
+        working_dir = array('i')
+        arg_codes = array('i')
+        arg_counts = array('q', [0])
+
+        unpack_fixed = RECORD_FIXED.unpack_from
+        unpack_len = U32.unpack_from
+        fixed = RECORD_FIXED.size
+        mask = ~STR_RAW
+
+        with open_binary(reader.path) as f:
+            reader.read_preamble(f)
+            done = False
+            while not done:
+                comms, paths, dirs, args = [], [], [], []
+                for _ in range(chunk):
+                    buf = reader.read_record(f)
+                    if buf is None:
+                        done = True
+                        break
+                    reader.count += 1
+                    ids, fl, nargs, _ = unpack_fixed(buf, 0)
+                    pid_tgid.append(ids)
+                    flags.append(fl)
+                    arg_counts.append(nargs)
+
+                    pos = fixed
+                    end = pos + 4 + (unpack_len(buf, pos)[0] & mask)
+                    comms.append(buf[pos:end])
+                    pos = end
+                    end = pos + 4 + (unpack_len(buf, pos)[0] & mask)
+                    paths.append(buf[pos:end])
+                    pos = end
+                    end = pos + 4 + (unpack_len(buf, pos)[0] & mask)
+                    dirs.append(buf[pos:end])
+                    if with_args:
+                        pos = end
+                        for _ in range(nargs):
+                            end = pos + 4 + (unpack_len(buf, pos)[0] & mask)
+                            args.append(buf[pos:end])
+                            pos = end
+
+                comm.extend(t.comms.encode(comms))
+                file_path.extend(t.paths.encode(paths))
+                working_dir.extend(t.dirs.encode(dirs))
+                arg_codes.extend(t.args.encode(args))
+
+        # same values as decode_datum()
+        field = lambda b: intern_str(decode_str(b, 0)[0]) or False
+        t.comms.decode(field)
+        t.paths.decode(field)
+        t.dirs.decode(field)
+        t.args.decode(lambda b: decode_str(b, 0)[0])
+
+        t.pid_tgid = np.frombuffer(pid_tgid, dtype=np.uint64)
+        t.flags = np.frombuffer(flags, dtype=np.uint32)
+        t.comm = np.frombuffer(comm, dtype=np.int32)
+        t.file_path = np.frombuffer(file_path, dtype=np.int32)
+        t.working_dir = np.frombuffer(working_dir, dtype=np.int32)
+        t.arg_codes = np.frombuffer(arg_codes, dtype=np.int32)
+        t.arg_offsets = np.cumsum(np.frombuffer(arg_counts, dtype=np.int64))
+        t.exe = np.full(len(t), -1, dtype=np.int32)
+        return t
+
+
+    def valid(self) -> np.ndarray:
+        # TraceDatum.check_fields() of every row
+        return ((self.pid_tgid != 0) & self.comms.present()[self.comm]
+                & self.paths.present()[self.file_path] & (np.diff(self.arg_offsets) > 0)
+                & self.dirs.present()[self.working_dir])
+
+
+    def resolve(self, matcher) -> np.ndarray:
+        # Rows that pass check_fields() and `matcher`, an ExecMatcher.
+        # Sets `exe` of the valid rows to the code of the resolved path.
+        rows = np.flatnonzero(self.valid())
+        ndirs = max(len(self.dirs), 1)
+        key = self.file_path[rows].astype(np.int64) * ndirs + self.working_dir[rows]
+        pairs, inverse = np.unique(key, return_inverse=True)
+
+        resolved = []
+        for k in pairs.tolist():
+            p, w = divmod(k, ndirs)
+            resolved.append(matcher.resolve(self.dirs.values[w], self.paths.values[p]))
+
+        exe = np.fromiter(self.exes.encode([path for path, _ in resolved]), dtype=np.int32,
+                          count=len(resolved))
+        keep = np.array([ok for _, ok in resolved], dtype=bool)
+        self.exe[rows] = exe[inverse]
+        return rows[keep[inverse]]
+
+
+    def exe_paths(self, rows: np.ndarray) -> list[str]:
+        values = self.exes.values
+        return [values[c] for c in self.exe[rows].tolist()]
+
+
+    def args_of(self, rows: np.ndarray) -> list[list]:
+        values = self.args.values
+        codes = self.arg_codes
+        offsets = self.arg_offsets
+        return [[values[c] for c in codes[offsets[i]:offsets[i + 1]].tolist()]
+                for i in rows.tolist()]